@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/lineage.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmark for the identification of distfile lineages, on synthetic
+    packages with hundreds of versions, compared with the character based
+    matching used before `distpatch.lineage`.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from distpatch.lineage import Lineage
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the identification of distfile lineages')
+parser.add_argument('-n', '--versions', dest='versions', metavar='N',
+                    type=int, default=300, help='Number of versions of each ' \
+                    'package (default: 300)')
+parser.add_argument('-r', '--repeat', dest='repeat', metavar='N', type=int,
+                    default=3, help='Number of runs, the best is reported ' \
+                    '(default: 3)')
+parser.add_argument('--no-legacy', dest='no_legacy', action='store_true',
+                    help='Skip the old implementation')
+
+
+def legacy_identify(distfiles):
+    # the algorithm of Package._lineage_identification before
+    # distpatch.lineage, working on lists of distfiles.
+    rv = []
+    diffs = []
+    taken = {}
+    for ebuild_id in range(len(distfiles) - 1):
+        for src_distfile in distfiles[ebuild_id]:
+            avg_distfile = None
+            max_avg = 0.0
+            avgs = {}
+            for dest_distfile in distfiles[ebuild_id + 1]:
+                prefix = ''
+                suffix = ''
+                for i in range(min(len(src_distfile), len(dest_distfile))):
+                    if src_distfile[i] == dest_distfile[i]:
+                        prefix += src_distfile[i]
+                    else:
+                        break
+                for i in range(min(len(src_distfile), len(dest_distfile))):
+                    if src_distfile[-i - 1] == dest_distfile[-i - 1]:
+                        suffix = src_distfile[-i - 1] + suffix
+                    else:
+                        break
+                avg = float(len(prefix) + len(suffix)) / 2
+                if avg in avgs:
+                    if avg_distfile == avgs[avg]:
+                        avg_distfile = None
+                    continue
+                avgs[avg] = dest_distfile
+                if avg > max_avg:
+                    avg_distfile = dest_distfile
+                    max_avg = avg
+            if avg_distfile is not None and src_distfile != avg_distfile:
+                diffs.append((max_avg, (ebuild_id, src_distfile,
+                                        avg_distfile)))
+    for avg, diff in diffs:
+        if diff[2] in taken:
+            if taken[diff[2]][0] > avg:
+                continue
+            rv = [i for i in rv if i[2] != diff[2]]
+        rv.append(diff)
+        taken[diff[2]] = (avg, diff)
+    return rv
+
+
+def packages(versions):
+    r = random.Random(versions)
+    langs = ['%s-%s' % (a, b) for a in ('de', 'en', 'es', 'fr', 'pt', 'ru',
+                                        'zh', 'ja', 'it', 'nl')
+             for b in ('DE', 'US', 'ES', 'FR', 'BR', 'RU', 'CN')]
+    rv = {}
+
+    # one tarball per version
+    rv['simple'] = [['simple-1.%i.tar.gz' % i] for i in range(versions)]
+
+    # main tarball, docs and language packs, some of them just in a few
+    # versions
+    lineage = []
+    for i in range(versions):
+        version = '%i.%i.%i' % (i // 100, (i // 10) % 10, i % 10)
+        distfiles = ['office-%s.tar.xz' % version,
+                     'office-docs-%s.tar.bz2' % version]
+        for lang in langs:
+            if r.random() < 0.9:
+                distfiles.append('office-l10n-%s-%s.tar.xz' % (lang, version))
+        lineage.append(distfiles)
+    rv['l10n'] = lineage
+
+    # fonts, firmware: many files with numbered names, bumped separately
+    names = ['font%02i' % i for i in range(60)]
+    current = dict([(name, 1) for name in names])
+    lineage = []
+    for i in range(versions):
+        for name in r.sample(names, 5):
+            current[name] += 1
+        lineage.append(['%s-%i.tar.gz' % (name, current[name]) \
+                        for name in names])
+    rv['fonts'] = lineage
+    return rv
+
+
+def best_of(repeat, function, *args):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        rv = function(*args)
+        times.append(time.time() - start)
+    return min(times), rv
+
+
+def main():
+    args = parser.parse_args()
+    print('%-8s %9s %8s %12s %12s %8s' % ('package', 'distfiles', 'pairs',
+                                          'legacy (s)', 'lineage (s)',
+                                          'speedup'))
+    for name, distfiles in sorted(packages(args.versions).items()):
+        count = sum(map(len, distfiles))
+        new_time, rv = best_of(args.repeat,
+                               lambda x: Lineage().identify(x), distfiles)
+        if args.no_legacy:
+            print('%-8s %9i %8i %12s %12.4f %8s' % (name, count, len(rv), '-',
+                                                    new_time, '-'))
+            continue
+        old_time, old_rv = best_of(args.repeat, legacy_identify, distfiles)
+        print('%-8s %9i %8i %12.4f %12.4f %7.1fx' % (name, count, len(rv),
+                                                     old_time, new_time,
+                                                     old_time / new_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/lineages.py
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Generator of synthetic version lineages: a series of tarballs of text
+    files, where each version changes a fraction of the files of the previous
+    one, and the tree of the stand-in portage (see benchmarks/stubs) with an
+    ebuild for each version.
+
+    Tarballs are built in memory and compressed with fixed timestamps, the
+    same arguments always generate the same distfiles.
+
+    Usage: lineages.py [options] OUTPUT_DIR
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import argparse
+import bz2
+import gzip
+import io
+import json
+import lzma
+import os
+import random
+import tarfile
+
+from collections import OrderedDict
+
+category = 'bench'
+
+compressors = OrderedDict([
+    ('gz', lambda data: gzip.compress(data, 6, mtime=0)),
+    ('bz2', lambda data: bz2.compress(data, 9)),
+    ('xz', lambda data: lzma.compress(data, preset=6)),
+])
+
+parser = argparse.ArgumentParser(
+    description='Generate synthetic version lineages for the benchmarks')
+parser.add_argument('output_dir', metavar='OUTPUT_DIR',
+                    help='Directory to write the distfiles to')
+parser.add_argument('-N', '--name', dest='name', default='foo',
+                    help='Name of the package (default: foo)')
+parser.add_argument('-n', '--versions', dest='versions', metavar='N',
+                    type=int, default=5, help='Number of versions ' \
+                    '(default: 5)')
+parser.add_argument('-m', '--members', dest='members', metavar='N',
+                    type=int, default=32, help='Number of files in each ' \
+                    'tarball (default: 32)')
+parser.add_argument('-S', '--member-size', dest='member_size',
+                    metavar='BYTES', type=int, default=32 * 1024,
+                    help='Average size of the files (default: 32768)')
+parser.add_argument('-c', '--churn', dest='churn', metavar='FRACTION',
+                    type=float, default=0.1, help='Fraction of the files ' \
+                    'changed by each version (default: 0.1)')
+parser.add_argument('-z', '--compressor', dest='compressor',
+                    choices=list(compressors.keys()), default='gz',
+                    help='Compressor of the tarballs (default: gz)')
+parser.add_argument('--seed', dest='seed', type=int, default=0,
+                    help='Seed of the random generator (default: 0)')
+parser.add_argument('-t', '--tree', dest='tree', metavar='FILE',
+                    help='JSON file with the tree of the stand-in portage ' \
+                    'to add the ebuilds to')
+
+
+class _Text(object):
+    # random source code-like text, compressible like the real thing.
+
+    def __init__(self, r):
+        self.r = r
+        self.words = [''.join(r.choice('abcdefghijklmnopqrstuvwxyz_') \
+                              for j in range(r.randint(2, 10))) \
+                      for i in range(2000)]
+
+    def __call__(self, size):
+        lines = []
+        length = 0
+        while length < size:
+            line = '    ' * self.r.randint(0, 3) + \
+                   ' '.join(self.r.choices(self.words,
+                                           k=self.r.randint(1, 12)))
+            lines.append(line)
+            length += len(line) + 1
+        return ('\n'.join(lines) + '\n').encode('ascii')[:size]
+
+
+def _tarball(prefix, members):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo('%s/%s' % (prefix, name))
+            info.size = len(data)
+            info.mtime = 0
+            info.mode = 0o644
+            info.uname = info.gname = 'root'
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def generate(output_dir, name='foo', versions=5, members=32,
+             member_size=32 * 1024, churn=0.1, compressor='gz', seed=0):
+    """Writes the distfiles of `versions` versions of the package `name` to
+    `output_dir`. Each version rewrites a quarter of a `churn` fraction of
+    the files of the previous one, and may add or remove a file. Returns an
+    OrderedDict with the SRC_URI of each CPV, to be added to the tree.
+    """
+    r = random.Random('%s-%s' % (name, seed))
+    text = _Text(r)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    files = OrderedDict()
+    for i in range(members):
+        files['src/file%04i.c' % i] = text(r.randint(member_size // 2,
+                                                     member_size * 3 // 2))
+    tree = OrderedDict()
+    for version in range(versions):
+        if version > 0:
+            for key in list(files.keys()):
+                if r.random() >= churn:
+                    continue
+                data = files[key]
+                size = len(data) // 4
+                start = r.randint(0, len(data) - size)
+                files[key] = data[:start] + text(r.randint(size // 2,
+                                                           size * 3 // 2)) + \
+                             data[start + size:]
+            if r.random() < churn:
+                files['src/file%04i.c' % len(files)] = text(member_size)
+            if r.random() < churn / 2 and len(files) > 1:
+                del files[r.choice(list(files.keys()))]
+        pv = '%s-1.%i' % (name, version)
+        distfile = '%s.tar.%s' % (pv, compressor)
+        data = compressors[compressor](_tarball(pv, files))
+        with open(os.path.join(output_dir, distfile), 'wb') as fp:
+            fp.write(data)
+        tree['%s/%s' % (category, pv)] = 'mirror://bench/%s' % distfile
+    return tree
+
+
+def write_tree(fname, tree):
+    """Adds the given CPVs to the JSON file with the tree of the stand-in
+    portage.
+    """
+    rv = {}
+    if os.path.exists(fname):
+        with open(fname) as fp:
+            rv = json.load(fp)
+    rv.update(tree)
+    with open(fname, 'w') as fp:
+        json.dump(rv, fp, indent=1, sort_keys=True)
+
+
+def main():
+    args = parser.parse_args()
+    tree = generate(args.output_dir, args.name, args.versions, args.members,
+                    args.member_size, args.churn, args.compressor, args.seed)
+    if args.tree is not None:
+        write_tree(args.tree, tree)
+    for cpv, src_uri in tree.items():
+        print('%s %s' % (cpv, src_uri))
+
+if __name__ == '__main__':
+    main()
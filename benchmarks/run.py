@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/run.py
+    ~~~~~~~~~~~~~~~~~
+
+    Benchmark suite for distpatch, reporting the results as JSON, to track
+    regressions between revisions.
+
+    Everything runs in a temporary directory, with the stand-in portage from
+    benchmarks/stubs, the stand-in diffball tools from benchmarks/bin and
+    synthetic lineages from benchmarks/lineages.py. The scenarios are:
+
+    - deltadb: DeltaDB add, compaction, parsing and lookups, for each
+      backend, with thousands of synthetic records.
+    - diff: `Diff.generate` for the consecutive versions of a lineage, for
+      each compressor.
+    - patch: `Patch.reconstruct` of the last version of each lineage from
+      the first one, with the deltas generated by the diff scenario. The
+      reconstructed distfile isn't recompressed, then it is, streaming the
+      output of patcher and writing the uncompressed distfile to disk.
+    - chains: chain resolution on a synthetic DeltaDB, with the planner and
+      with the chain index.
+    - presets: `Diff.generate` for each xz preset of the deltas, and with
+      xz(1) multithreaded if `--xz-threads` is given, reporting the time and
+      the total size of the deltas, to tune the mirror. The uncompressed
+      distfiles are cached, the times are of differ and compression.
+
+    Each measurement reports the best and the median of the runs, in
+    seconds.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+from shutil import copyfile, rmtree
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(bench_dir, 'stubs'))
+
+from lineages import compressors, generate, write_tree
+
+scenarios = ['deltadb', 'diff', 'patch', 'chains', 'presets']
+
+parser = argparse.ArgumentParser(
+    description='Run the distpatch benchmarks, reporting the results as JSON')
+parser.add_argument('-s', '--scenario', dest='scenarios', action='append',
+                    choices=scenarios, help='Scenario to run, may be used ' \
+                    'more than once (default: all)')
+parser.add_argument('-o', '--output', dest='output', metavar='FILE',
+                    help='File to write the results to (default: stdout)')
+parser.add_argument('-r', '--repeat', dest='repeat', metavar='N', type=int,
+                    default=3, help='Number of runs of each measurement ' \
+                    '(default: 3)')
+parser.add_argument('--records', dest='records', metavar='N', type=int,
+                    default=20000, help='Number of records of the ' \
+                    'synthetic DeltaDB (default: 20000)')
+parser.add_argument('--queries', dest='queries', metavar='N', type=int,
+                    default=1000, help='Number of lookups and chain ' \
+                    'resolutions (default: 1000)')
+parser.add_argument('-z', '--compressor', dest='compressors',
+                    action='append', choices=list(compressors.keys()),
+                    help='Compressor of the lineages, may be used more ' \
+                    'than once (default: all)')
+parser.add_argument('-n', '--versions', dest='versions', metavar='N',
+                    type=int, default=5, help='Number of versions of each ' \
+                    'lineage (default: 5)')
+parser.add_argument('-m', '--members', dest='members', metavar='N',
+                    type=int, default=32, help='Number of files in each ' \
+                    'tarball (default: 32)')
+parser.add_argument('-S', '--member-size', dest='member_size',
+                    metavar='BYTES', type=int, default=32 * 1024,
+                    help='Average size of the files (default: 32768)')
+parser.add_argument('-c', '--churn', dest='churn', metavar='FRACTION',
+                    type=float, default=0.1, help='Fraction of the files ' \
+                    'changed by each version (default: 0.1)')
+parser.add_argument('-p', '--preset', dest='presets', metavar='PRESET',
+                    action='append', help='xz preset of the deltas for the ' \
+                    'presets scenario, e.g. 9e, may be used more than once ' \
+                    '(default: 0-9)')
+parser.add_argument('--xz-threads', dest='xz_threads', metavar='N', type=int,
+                    help='Also run the presets scenario with xz(1), using N ' \
+                    'threads, 0 for one per processor')
+parser.add_argument('-k', '--keep', dest='keep', action='store_true',
+                    help='Keep the temporary directory')
+
+
+def setup_environment(work_dir):
+    # must run before distpatch is imported, the caches are created on import
+    distdir = os.path.join(work_dir, 'distdir')
+    os.makedirs(os.path.join(distdir, 'patches'))
+    os.environ.update({
+        'DISTPATCH_BENCH_TREE': os.path.join(work_dir, 'tree.json'),
+        'DISTPATCH_BENCH_DISTDIR': distdir,
+        'DISTPATCH_BENCH_MIRROR': os.path.join(work_dir, 'mirror'),
+        'DIFFBALL_BINDIR': os.path.join(bench_dir, 'bin'),
+        'DISTPATCH_CHKSUM_CACHE': os.path.join(work_dir, 'chksums.sqlite'),
+        'DISTPATCH_UNCOMPRESSED_CACHE': os.path.join(work_dir,
+                                                     'uncompressed'),
+    })
+
+
+def timed(func, repeat, setup=None):
+    """Runs `func` `repeat` times, after `setup`, returning the best and
+    the median times, and the return value of the last run.
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        rv = func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[0], times[len(times) // 2], rv
+
+
+class Results(object):
+
+    def __init__(self):
+        self.results = []
+
+    def add(self, scenario, name, best, median, **extra):
+        result = OrderedDict([('scenario', scenario), ('name', name),
+                              ('best', best), ('median', median)])
+        result.update(sorted(extra.items()))
+        self.results.append(result)
+        sys.stderr.write('%-40s %10.4f %10.4f\n' % ('%s.%s' % (scenario, name),
+                                                    best, median))
+
+
+def _chksums(r, size=None):
+    return dict(md5=r.getrandbits(128), sha1=r.getrandbits(160),
+                sha256=r.getrandbits(256), rmd160=r.getrandbits(160),
+                size=size or r.randint(10 ** 5, 10 ** 8))
+
+
+def synthetic_records(count, versions=10, prefix='pkg', seed=0):
+    """Returns `count` DeltaDBRecord objects, for packages named `prefix`
+    and a number, with `versions` versions each, with deltas between
+    consecutive versions and skipping one version.
+    """
+    from distpatch.deltadb import DeltaDBFile, DeltaDBRecord
+    r = random.Random(seed)
+    rv = []
+    package = 0
+    while len(rv) < count:
+        fnames = ['%s%i-%i.tar.gz' % (prefix, package, i) \
+                  for i in range(versions)]
+        files = [DeltaDBFile(i, chksums=_chksums(r), uchksums=_chksums(r)) \
+                 for i in fnames]
+        pairs = [(i, i + 1) for i in range(versions - 1)] + \
+                [(i, i + 2) for i in range(versions - 2)]
+        for src, dest in pairs:
+            delta = '%s-%s.switching.xz' % (fnames[src], fnames[dest])
+            size = files[dest].chksums.size.to_long() // r.randint(5, 50)
+            rv.append(DeltaDBRecord(files[src], files[dest],
+                                    DeltaDBFile(delta,
+                                                chksums=_chksums(r, size),
+                                                uchksums=_chksums(r))))
+            if len(rv) == count:
+                break
+        package += 1
+    return rv
+
+
+def _remove(*fnames):
+    for fname in fnames:
+        for suffix in ('', '.journal', '.lock', '.chains'):
+            if os.path.exists(fname + suffix):
+                os.unlink(fname + suffix)
+
+
+def _deltadb_fname(work_dir, backend):
+    return os.path.join(work_dir, 'deltadb-%s%s' % (
+        backend, backend == 'sqlite' and '.sqlite' or ''))
+
+
+def bench_deltadb(work_dir, args, results):
+    from distpatch.deltadb import open_deltadb
+    records = synthetic_records(args.records)
+    extra = synthetic_records(100, prefix='new', seed=1)
+    r = random.Random(0)
+    dests = [r.choice(records).dest.fname for i in range(args.queries)]
+    for backend in ('text', 'sqlite'):
+        fname = _deltadb_fname(work_dir, backend)
+
+        def add_many():
+            db = open_deltadb(fname, backend)
+            db.add_many(records)
+            return db
+
+        best, median, db = timed(add_many, args.repeat,
+                                 lambda: _remove(fname))
+        results.add('deltadb', '%s.add_many' % backend, best, median,
+                    records=len(records))
+        best, median, rv = timed(db.compact, args.repeat)
+        results.add('deltadb', '%s.compact' % backend, best, median,
+                    records=len(records))
+
+        def parse():
+            db = open_deltadb(fname, backend)
+            return len(db)
+
+        best, median, rv = timed(parse, args.repeat)
+        results.add('deltadb', '%s.parse' % backend, best, median,
+                    records=len(records))
+
+        def lookup():
+            db = open_deltadb(fname, backend)
+            for dest in dests:
+                db.get_by_dest(dest)[0].delta.chksums
+
+        best, median, rv = timed(lookup, args.repeat)
+        results.add('deltadb', '%s.lookup' % backend, best, median,
+                    records=len(records), queries=len(dests))
+
+        def add():
+            db = open_deltadb(fname, backend)
+            for record in extra:
+                db.add(record)
+
+        def restore():
+            _remove(fname)
+            copyfile(fname + '.orig', fname)
+
+        copyfile(fname, fname + '.orig')
+        best, median, rv = timed(add, args.repeat, restore)
+        results.add('deltadb', '%s.add' % backend, best, median,
+                    records=len(records), added=len(extra))
+        _remove(fname, fname + '.orig')
+
+
+class Lineages(object):
+    """Synthetic lineages shared by the diff and patch scenarios."""
+
+    def __init__(self, work_dir, args):
+        self.work_dir = work_dir
+        self.args = args
+        self.compressors = args.compressors or list(compressors.keys())
+        self.atoms = OrderedDict()
+        self.deltas = {}
+        self.deltas_dir = os.path.join(work_dir, 'deltas')
+        self._generated = False
+
+    def generate(self):
+        # the stand-in portage loads the tree once, everything is written
+        # before the first diff.
+        if self._generated:
+            return
+        mirror = os.environ['DISTPATCH_BENCH_MIRROR']
+        tree = OrderedDict()
+        for compressor in self.compressors:
+            name = 'lineage%s' % compressor
+            tree.update(generate(mirror, name, self.args.versions,
+                                 self.args.members, self.args.member_size,
+                                 self.args.churn, compressor))
+            self.atoms[compressor] = 'bench/%s' % name
+
+        # old enough for the checksums cache
+        mtime = time.time() - 3600
+        for fname in os.listdir(mirror):
+            os.utime(os.path.join(mirror, fname), (mtime, mtime))
+        write_tree(os.environ['DISTPATCH_BENCH_TREE'], tree)
+        self._generated = True
+
+    def diffs(self, compressor):
+        from distpatch.package import Package
+        from distpatch.deltadb import open_deltadb
+        self.generate()
+        package = Package(open_deltadb(os.path.join(self.work_dir,
+                                                    'deltadb-lineages')))
+        package.diff(self.atoms[compressor])
+        package.fetch_distfiles()
+        return package.diffs
+
+    def generate_deltas(self, compressor, diffs):
+        for diff in diffs:
+            diff.generate(self.deltas_dir, force=True)
+        self.deltas[compressor] = [diff.dbrecord for diff in diffs]
+        return self.deltas[compressor]
+
+
+def _clean_uncompressed_cache():
+    from distpatch.cache import uncompressed_cache
+    if os.path.isdir(uncompressed_cache.directory):
+        rmtree(uncompressed_cache.directory)
+
+
+def bench_diff(lineages, args, results):
+    for compressor in lineages.compressors:
+        diffs = lineages.diffs(compressor)
+        best, median, dbrecords = timed(
+            lambda: lineages.generate_deltas(compressor, diffs), args.repeat,
+            _clean_uncompressed_cache)
+        size = sum([i.dest.uchksums.size.to_long() for i in dbrecords])
+        delta_size = sum([i.delta.chksums.size.to_long() for i in dbrecords])
+        results.add('diff', compressor, best, median, diffs=len(dbrecords),
+                    bytes=size, delta_bytes=delta_size,
+                    throughput=size / best)
+
+
+def bench_patch(lineages, args, results):
+    from distpatch.patch import Patch
+    output_dir = os.path.join(lineages.work_dir, 'reconstructed')
+    for compressor in lineages.compressors:
+        if compressor not in lineages.deltas:
+            _clean_uncompressed_cache()
+            lineages.generate_deltas(compressor,
+                                     lineages.diffs(compressor))
+        patch = Patch(*lineages.deltas[compressor])
+
+        def setup():
+            if os.path.isdir(output_dir):
+                rmtree(output_dir)
+            os.makedirs(output_dir)
+
+        best, median, rv = timed(
+            lambda: patch.reconstruct(lineages.deltas_dir, output_dir, False),
+            args.repeat, setup)
+        size = patch.dest.uchksums.size.to_long()
+        results.add('patch', compressor, best, median,
+                    deltas=len(patch.dbrecords), bytes=size,
+                    throughput=size / best)
+        for streaming in (True, False):
+            Patch.streaming = streaming
+            try:
+                best, median, rv = timed(
+                    lambda: patch.reconstruct(lineages.deltas_dir,
+                                              output_dir),
+                    args.repeat, setup)
+            finally:
+                Patch.streaming = True
+            results.add('patch', '%s.%s' % (compressor, streaming and \
+                                            'streaming' or 'files'),
+                        best, median, deltas=len(patch.dbrecords),
+                        bytes=size, throughput=size / best,
+                        identical=os.path.exists(os.path.join(
+                            output_dir, patch.dest.fname)))
+
+
+def bench_presets(lineages, args, results):
+    from distpatch.diff import Diff
+    from distpatch.helpers import parse_xz_preset
+    presets = args.presets or [str(i) for i in range(10)]
+    threads = [None]
+    if args.xz_threads is not None:
+        threads.append(args.xz_threads)
+    diffs = OrderedDict([(i, lineages.diffs(i)) for i in lineages.compressors])
+
+    # fill the uncompressed cache
+    for compressor, value in diffs.items():
+        lineages.generate_deltas(compressor, value)
+
+    def generate_deltas():
+        rv = []
+        for compressor, value in diffs.items():
+            rv.extend(lineages.generate_deltas(compressor, value))
+        return rv
+
+    try:
+        for preset in presets:
+            for thread in threads:
+                Diff.xz_preset = parse_xz_preset(preset)
+                Diff.xz_threads = thread
+                best, median, dbrecords = timed(generate_deltas, args.repeat)
+                size = sum([i.delta.uchksums.size.to_long() \
+                            for i in dbrecords])
+                delta_size = sum([i.delta.chksums.size.to_long() \
+                                  for i in dbrecords])
+                name = preset
+                if thread is not None:
+                    name += '.T%i' % thread
+                results.add('presets', name, best, median,
+                            diffs=len(dbrecords), bytes=size,
+                            delta_bytes=delta_size,
+                            ratio=float(delta_size) / size)
+    finally:
+        Diff.xz_preset = parse_xz_preset('6')
+        Diff.xz_threads = None
+
+
+def bench_chains(work_dir, args, results):
+    from distpatch.deltadb import open_deltadb
+    from distpatch.planner import ChainIndex, plan
+    records = synthetic_records(args.records, 20)
+    r = random.Random(0)
+    queries = []
+    for i in range(args.queries):
+        record = r.choice(records)
+        pkg = record.dest.fname.rsplit('-', 1)[0]
+        queries.append((record.dest.fname,
+                        ['%s-%i.tar.gz' % (pkg, r.randint(0, 3))]))
+    for backend in ('text', 'sqlite'):
+        fname = _deltadb_fname(work_dir, backend)
+        _remove(fname)
+        db = open_deltadb(fname, backend)
+        db.add_many(records)
+        db.compact()
+
+        def planner():
+            for dest, distfiles in queries:
+                plan(db, dest, distfiles)
+
+        best, median, rv = timed(planner, args.repeat)
+        results.add('chains', '%s.planner' % backend, best, median,
+                    records=len(records), queries=len(queries))
+        index = ChainIndex(db)
+        best, median, rv = timed(index.build, args.repeat)
+        results.add('chains', '%s.index_build' % backend, best, median,
+                    records=len(records))
+
+        def indexed():
+            index.open()
+            for dest, distfiles in queries:
+                index.plan(dest, distfiles)
+
+        best, median, rv = timed(indexed, args.repeat, index.close)
+        results.add('chains', '%s.index' % backend, best, median,
+                    records=len(records), queries=len(queries))
+        index.close()
+        _remove(fname)
+
+
+def main():
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(prefix='distpatch-bench-')
+    try:
+        setup_environment(work_dir)
+        from distpatch import __version__
+        results = Results()
+        lineages = Lineages(work_dir, args)
+        for scenario in args.scenarios or scenarios:
+            if scenario == 'deltadb':
+                bench_deltadb(work_dir, args, results)
+            elif scenario == 'diff':
+                bench_diff(lineages, args, results)
+            elif scenario == 'patch':
+                bench_patch(lineages, args, results)
+            elif scenario == 'chains':
+                bench_chains(work_dir, args, results)
+            elif scenario == 'presets':
+                bench_presets(lineages, args, results)
+    finally:
+        if args.keep:
+            sys.stderr.write('Temporary directory: %s\n' % work_dir)
+        else:
+            rmtree(work_dir)
+    parameters = vars(args).copy()
+    del parameters['output']
+    del parameters['keep']
+    report = OrderedDict([
+        ('distpatch', __version__),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('date', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+        ('parameters', parameters),
+        ('results', results.results),
+    ])
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=1)
+            fp.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/startup.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Benchmark for the startup time of the command line tools, with the
+    stand-in portage from benchmarks/stubs, simulating the cost of loading
+    portage and of creating the porttree.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from shutil import rmtree
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+stubs_dir = os.path.join(root_dir, 'benchmarks', 'stubs')
+sys.path.insert(0, root_dir)
+
+from distpatch.deltadb import DeltaDB, DeltaDBFile, DeltaDBRecord
+
+parser = argparse.ArgumentParser(
+    description='Benchmark the startup time of the distpatch tools')
+parser.add_argument('-r', '--repeat', dest='repeat', metavar='N', type=int,
+                    default=10, help='Number of runs of each command ' \
+                    '(default: 10)')
+parser.add_argument('--import-delay', dest='import_delay', metavar='SECONDS',
+                    type=float, default=0.2, help='Time taken by the stub ' \
+                    'to import portage (default: 0.2)')
+parser.add_argument('--trees-delay', dest='trees_delay', metavar='SECONDS',
+                    type=float, default=0.3, help='Time taken by the stub ' \
+                    'to create the porttree (default: 0.3)')
+
+
+def chksums(r):
+    return dict(md5=r.getrandbits(128), sha1=r.getrandbits(160),
+                sha256=r.getrandbits(256), rmd160=r.getrandbits(160),
+                size=r.randint(1, 10 ** 8))
+
+
+def build_deltadb(fname):
+    r = random.Random(0)
+    db = DeltaDB(fname)
+    records = []
+    for i in range(200):
+        f = lambda name: DeltaDBFile(name, chksums=chksums(r),
+                                     uchksums=chksums(r))
+        src = 'foo-%i.tar.gz' % i
+        dest = 'foo-%i.tar.gz' % (i + 1)
+        records.append(DeltaDBRecord(f(src), f(dest),
+                                     f('%s-%s.switching.xz' % (src, dest))))
+    db.add_many(records)
+    db.compact()
+
+
+def run(cmd, env, repeat, log):
+    times = []
+    for i in range(repeat):
+        if os.path.exists(log):
+            os.unlink(log)
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(cmd, env=env, stdout=devnull, stderr=devnull)
+        times.append(time.time() - start)
+    calls = []
+    if os.path.exists(log):
+        with open(log) as fp:
+            calls = fp.read().split()
+    times.sort()
+    return times[0], times[len(times) // 2], calls
+
+
+def main():
+    args = parser.parse_args()
+    tmp_dir = tempfile.mkdtemp(prefix='distpatch-bench-')
+    try:
+        distdir = os.path.join(tmp_dir, 'distdir')
+        os.makedirs(os.path.join(distdir, 'patches'))
+        open(os.path.join(distdir, 'foo-0.tar.gz'), 'w').close()
+        deltadb = os.path.join(tmp_dir, 'deltadb')
+        build_deltadb(deltadb)
+        log = os.path.join(tmp_dir, 'log')
+
+        env = dict(os.environ)
+        env.update({
+            'PYTHONPATH': os.pathsep.join([stubs_dir, root_dir]),
+            'DISTPATCH_BENCH_IMPORT_DELAY': str(args.import_delay),
+            'DISTPATCH_BENCH_TREES_DELAY': str(args.trees_delay),
+            'DISTPATCH_BENCH_DISTDIR': distdir,
+            'DISTPATCH_BENCH_LOG': log,
+            'DISTPATCH_CHKSUM_CACHE': '',
+        })
+        commands = [
+            ('distpatchq usage', ['distpatchq']),
+            ('distpatchq delta_fetch_size',
+             ['distpatchq', 'delta_fetch_size', deltadb, 'foo-10.tar.gz',
+              distdir]),
+            ('distpatcher --help', ['distpatcher', '--help']),
+            ('distdiffer --help', ['distdiffer', '--help']),
+        ]
+        print('%-30s %9s %9s %8s %12s' % ('command', 'min (ms)', 'med (ms)',
+                                          'imports', 'create_trees'))
+        for name, cmd in commands:
+            cmd = [sys.executable, os.path.join(root_dir, cmd[0])] + cmd[1:]
+            best, median, calls = run(cmd, env, args.repeat, log)
+            print('%-30s %9.1f %9.1f %8i %12i' % (
+                name, best * 1000, median * 1000, calls.count('import'),
+                calls.count('create_trees')))
+    finally:
+        rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+    portage (stand-in)
+    ~~~~~~~~~~~~~~~~~~
+
+    Minimal replacement for portage, used by the benchmarks. The tree is a
+    JSON file with an object mapping CPVs to their SRC_URI, and DISTDIR is a
+    local directory. Configured by environment variables:
+
+    - DISTPATCH_BENCH_TREE: the JSON file with the tree.
+    - DISTPATCH_BENCH_DISTDIR: DISTDIR.
+    - DISTPATCH_BENCH_MIRROR: directory where missing distfiles are fetched
+      from (optional).
+    - DISTPATCH_BENCH_IMPORT_DELAY, DISTPATCH_BENCH_TREES_DELAY: seconds
+      spent importing portage and creating the trees, to simulate the real
+      thing (default: 0).
+    - DISTPATCH_BENCH_LOG: file to log the imports and tree creations to
+      (optional).
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import json
+import os
+import time
+
+
+def _log(event):
+    fname = os.environ.get('DISTPATCH_BENCH_LOG')
+    if fname:
+        with open(fname, 'a') as fp:
+            fp.write('%s\n' % event)
+
+time.sleep(float(os.environ.get('DISTPATCH_BENCH_IMPORT_DELAY', 0)))
+_log('import')
+
+settings = {
+    'DISTDIR': os.environ.get('DISTPATCH_BENCH_DISTDIR', os.getcwd()),
+    'ROOT': '/',
+}
+
+
+def _load_tree():
+    fname = os.environ.get('DISTPATCH_BENCH_TREE')
+    if not fname or not os.path.exists(fname):
+        return {}
+    with open(fname) as fp:
+        return json.load(fp)
+
+
+class _Dbapi(object):
+
+    def __init__(self):
+        self._tree = _load_tree()
+
+    def cpv_exists(self, cpv):
+        return cpv in self._tree
+
+    def cp_all(self):
+        return sorted(set([cpv.rsplit('-', 1)[0] for cpv in self._tree]))
+
+    def cp_list(self, cp):
+        return self.match(cp)
+
+    def match(self, atom):
+        # versions are compared as tuples of integers, enough for the
+        # benchmarks
+        rv = [cpv for cpv in self._tree if cpv.rsplit('-', 1)[0] == atom]
+        return sorted(rv, key=lambda x: [int(i) for i in \
+                                         x.rsplit('-', 1)[1].split('.')])
+
+    def aux_get(self, cpv, keys):
+        metadata = {'EAPI': '0', 'SRC_URI': self._tree[cpv]}
+        return [metadata.get(key, '') for key in keys]
+
+    def findname(self, cpv):
+        return os.path.join(settings['DISTDIR'], '%s.ebuild' % cpv)
+
+
+class _Tree(object):
+
+    def __init__(self):
+        self.dbapi = _Dbapi()
+
+
+def create_trees():
+    time.sleep(float(os.environ.get('DISTPATCH_BENCH_TREES_DELAY', 0)))
+    _log('create_trees')
+    return {settings['ROOT']: {'porttree': _Tree()}}
+
+
+class config(dict):
+
+    def __init__(self, clone=None):
+        dict.__init__(self, clone or {})
+        self.features = set()
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+
+def _parse_uri_map(cpv, metadata):
+    rv = OrderedDict()
+    for uri in metadata['SRC_URI'].split():
+        rv.setdefault(uri.rsplit('/', 1)[-1], set()).add(uri)
+    return rv
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.cache
+    ~~~~~~~~~~~~~~~
+
+    Scratch cache of uncompressed distfiles.
+
+    The distfiles of a lineage are used twice by distdiffer, as destination
+    of a delta and as source of the next one. The decompressed files and
+    their checksums are kept in a cache directory, keyed by the SHA256 of the
+    compressed file, to decompress and hash each distfile just once.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from fcntl import lockf, LOCK_EX, LOCK_UN
+
+from distpatch.chksums import Chksum, ChksumHasher, chksum_cache
+from distpatch.deltadb import DeltaDBFile, parse_chksum_line
+from distpatch.helpers import link_or_copy, uncompress, \
+     uncompressed_filename_and_compressor
+
+
+def _key(chksums):
+    return '%064x' % chksums.sha256.to_long()
+
+
+class UncompressedCache(object):
+    """Cache of uncompressed distfiles, with their checksums. Each entry is a
+    directory named after the SHA256 of the compressed distfile, with the
+    uncompressed file and a `chksums` file. Least recently used entries are
+    evicted when the cache gets bigger than `max_size` bytes.
+
+    The cache is stored in $DISTPATCH_UNCOMPRESSED_CACHE (default:
+    ~/.cache/distpatch/uncompressed), with a size limit of
+    $DISTPATCH_UNCOMPRESSED_CACHE_SIZE megabytes (default: 4096). Set it
+    empty to disable the cache. Files are hardlinked out of the cache when
+    possible, keep it in the same filesystem as the output directory.
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = os.environ.get('DISTPATCH_UNCOMPRESSED_CACHE')
+        if directory is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME',
+                                        os.path.expanduser('~/.cache'))
+            directory = os.path.join(cache_home, 'distpatch', 'uncompressed')
+        self.directory = directory
+        if max_size is None:
+            max_size = int(os.environ.get('DISTPATCH_UNCOMPRESSED_CACHE_SIZE',
+                                          4096)) * 1024 * 1024
+        self.max_size = max_size
+        self._thread_lock = threading.RLock()
+
+    @contextmanager
+    def _lock(self):
+        # entries are looked up, added and evicted by threads and processes
+        # running in parallel.
+        with self._thread_lock:
+            with open(os.path.join(self.directory, '.lock'), 'a+') as fp:
+                lockf(fp, LOCK_EX)
+                try:
+                    yield
+                finally:
+                    lockf(fp, LOCK_UN)
+
+    def _lookup(self, key):
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'chksums')) as fp:
+                ufname = fp.readline().strip()
+                chksums, uchksums = parse_chksum_line(fp.readline())
+        except (IOError, OSError):
+            return None
+        ufname = os.path.join(entry, ufname)
+        if not os.path.exists(ufname):
+            return None
+        os.utime(entry, None)
+        return ufname, Chksum(**chksums), Chksum(**uchksums)
+
+    def _evict(self, keep):
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            entry = os.path.join(self.directory, key)
+            if not os.path.isdir(entry):
+                continue
+            mtime = os.stat(entry).st_mtime
+
+            # leftovers from interrupted runs
+            if key.startswith('.'):
+                if time.time() - mtime > 24 * 60 * 60:
+                    shutil.rmtree(entry, True)
+                continue
+
+            size = 0
+            for fname in os.listdir(entry):
+                size += os.stat(os.path.join(entry, fname)).st_size
+            entries.append((mtime, size, key))
+            total += size
+        entries.sort()
+        for mtime, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.directory, key), True)
+                total -= size
+
+    def uncompress(self, fname, output_dir):
+        """Decompresses the given file to `output_dir`, like
+        `distpatch.helpers.uncompress`. Returns the path of the decompressed
+        file, and the checksums of the compressed and decompressed files.
+        """
+        compressor = uncompressed_filename_and_compressor(fname)[1]
+        if compressor is not None and self.directory:
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+            except OSError:
+                # no cache, no problem
+                self.directory = None
+        if compressor is None or not self.directory:
+            hasher, uhasher = ChksumHasher(), ChksumHasher()
+            ufname = uncompress(fname, output_dir, [hasher.update],
+                                [uhasher.update])
+            return ufname, hasher.chksum(), uhasher.chksum()
+
+        # entries may be shared by distfiles with different names
+        ufname = os.path.join(output_dir, os.path.basename(
+            uncompressed_filename_and_compressor(fname)[0]))
+
+        # the checksum of the compressed file is usually known from the
+        # checksums cache. otherwise it is calculated while decompressing,
+        # unless there's no checksums cache at all.
+        chksums = chksum_cache.get_chksum(fname, 'c')
+        if chksums is None and not chksum_cache.fname:
+            chksums = Chksum(fname)
+        if chksums is not None:
+            # the entry is hardlinked while holding the lock, so it can't be
+            # evicted meanwhile, and copied out of the cache without it.
+            pin = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+            try:
+                with self._lock():
+                    cached = self._lookup(_key(chksums))
+                    pinned = None
+                    if cached is not None:
+                        pinned = os.path.join(pin,
+                                              os.path.basename(cached[0]))
+                        try:
+                            os.link(cached[0], pinned)
+                        except OSError:
+                            pinned = None
+                            link_or_copy(cached[0], ufname)
+                if cached is not None:
+                    if pinned is not None:
+                        link_or_copy(pinned, ufname)
+                    return ufname, cached[1], cached[2]
+            finally:
+                shutil.rmtree(pin, True)
+
+        identity = chksum_cache.identity(fname)
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            hasher, uhasher = ChksumHasher(), ChksumHasher()
+            cached = uncompress(fname, tmp_entry, [hasher.update],
+                                [uhasher.update])
+            chksums, uchksums = hasher.chksum(), uhasher.chksum()
+            chksum_cache.set_chksum(fname, 'c', chksums, identity)
+            chksum_cache.set_chksum(fname, 'u', uchksums, identity)
+            with open(os.path.join(tmp_entry, 'chksums'), 'w') as fp:
+                fp.write('%s\n%s\n' % (os.path.basename(cached),
+                                       DeltaDBFile(fname, cached, chksums,
+                                                   uchksums).format_chksums()))
+            link_or_copy(cached, ufname)
+            key = _key(chksums)
+            with self._lock():
+                if not os.path.exists(os.path.join(self.directory, key)) and \
+                   os.stat(cached).st_size <= self.max_size:
+                    os.rename(tmp_entry, os.path.join(self.directory, key))
+                    tmp_entry = None
+                    self._evict(key)
+        finally:
+            if tmp_entry is not None:
+                shutil.rmtree(tmp_entry, True)
+        return ufname, chksums, uchksums
+
+
+uncompressed_cache = UncompressedCache()
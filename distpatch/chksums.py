@@ -10,9 +10,15 @@
 """
 
 import os
+import sqlite3
+import struct
+import threading
+import time
 
 from snakeoil.chksum import get_chksums, get_handler
 
+from distpatch.helpers import stream_file, uncompressed_filename_and_compressor
+
 
 class ChksumException(Exception):
     pass
@@ -60,7 +66,7 @@ class Chksum(object):
 
     algorithms = frozenset(['md5', 'sha1', 'sha256', 'rmd160', 'size'])
 
-    def __init__(self, fname=None, **chksums):
+    def __init__(self, fname=None, uncompressed=False, **chksums):
 
         # if provided fname, calculate checksums from the given file.
         if fname is not None:
@@ -68,8 +74,22 @@ class Chksum(object):
             if not os.path.exists(fname):
                 raise ChksumException('File not found: %s' % fname)
 
-            values = get_chksums(fname, *self.algorithms)
-            chksums = list(zip(self.algorithms, values))
+            kind = uncompressed and 'u' or 'c'
+            identity = chksum_cache.identity(fname)
+            cached = chksum_cache.get_chksum(fname, kind)
+            if cached is not None:
+                chksums = cached.items()
+
+            # checksums of the decompressed contents of the file, without
+            # writing them to disk
+            elif uncompressed:
+                hasher = ChksumHasher()
+                stream_file(fname, (), [hasher.update],
+                            uncompressed_filename_and_compressor(fname)[1])
+                chksums = hasher.chksum().items()
+            else:
+                values = get_chksums(fname, *self.algorithms)
+                chksums = list(zip(self.algorithms, values))
 
         # if provided checksums, use them
         else:
@@ -87,6 +107,9 @@ class Chksum(object):
             raise ChksumException('Missing checksums: %s' % \
                               ', '.join(tmp_algorithms))
 
+        if fname is not None and cached is None:
+            chksum_cache.set_chksum(fname, kind, self, identity)
+
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             raise ChksumException('Invalid operand for %s: %r' % \
@@ -98,5 +121,215 @@ class Chksum(object):
                 return False
         return True
 
+    def items(self):
+        return [(i, getattr(self, i).to_long()) for i in self.algorithms]
+
     def __ne__(self, other):
         return not self.__eq__(other)
+
+
+class ChksumHasher(object):
+    """Calculates all the checksums of data fed in chunks."""
+
+    def __init__(self):
+        self._chfs = [(i, get_handler(i).new()()) for i in Chksum.algorithms]
+
+    def update(self, data):
+        for algorithm, chf in self._chfs:
+            chf.update(data)
+
+    def chksum(self):
+        return Chksum(**dict([(algorithm, int(chf.hexdigest(), 16)) \
+                              for algorithm, chf in self._chfs]))
+
+
+def compressed_chksums(fname):
+    """Returns the checksums of the given file and the checksums of its
+    decompressed contents, reading the file just once.
+    """
+    if not os.path.exists(fname):
+        raise ChksumException('File not found: %s' % fname)
+    identity = chksum_cache.identity(fname)
+    chksums = chksum_cache.get_chksum(fname, 'c')
+    uchksums = chksum_cache.get_chksum(fname, 'u')
+    if chksums is not None and uchksums is not None:
+        return chksums, uchksums
+    compressor = uncompressed_filename_and_compressor(fname)[1]
+    hasher = ChksumHasher()
+    if compressor is None:
+        stream_file(fname, [hasher.update])
+        chksums = uchksums = hasher.chksum()
+    else:
+        uhasher = ChksumHasher()
+        stream_file(fname, [hasher.update], [uhasher.update], compressor)
+        chksums, uchksums = hasher.chksum(), uhasher.chksum()
+    chksum_cache.set_chksum(fname, 'c', chksums, identity)
+    chksum_cache.set_chksum(fname, 'u', uchksums, identity)
+    return chksums, uchksums
+
+
+# typical compression ratios of source tarballs, to estimate the size of
+# the decompressed contents when it isn't known
+compression_ratios = {
+    'gzip': 4,
+    'bzip2': 5,
+    'xz': 6,
+    'lzma': 6,
+}
+
+
+def uncompressed_size(fname):
+    """Returns the size of the decompressed contents of the given file,
+    without decompressing it: from the checksums cache, from the gzip
+    trailer, or estimated from the typical compression ratios.
+    """
+    size = os.path.getsize(fname)
+    compressor = uncompressed_filename_and_compressor(fname)[1]
+    if compressor is None:
+        return size
+    uchksums = chksum_cache.get_chksum(fname, 'u')
+    if uchksums is not None:
+        return uchksums.size.to_long()
+    if compressor == 'gzip' and size >= 18:
+        # the trailer has the size modulo 2 ** 32, of the last member
+        with open(fname, 'rb') as fp:
+            fp.seek(-4, os.SEEK_END)
+            usize = struct.unpack('<I', fp.read(4))[0]
+        while usize < size:
+            usize += 2 ** 32
+        return usize
+    return size * compression_ratios.get(compressor, 4)
+
+
+class ChksumCache(object):
+    """Persistent cache of file checksums, keyed by the identity of the file
+    (device, inode, size and modification time). Least recently used entries
+    are evicted when the cache gets bigger than `max_entries`, checked every
+    `evict_interval` insertions.
+
+    The cache is stored in $DISTPATCH_CHKSUM_CACHE (default:
+    ~/.cache/distpatch/chksums.sqlite). Set it empty to disable the cache.
+    Set $DISTPATCH_REVALIDATE, or the `revalidate` attribute, to ignore the
+    cached values and calculate everything again.
+    """
+
+    evict_interval = 1000
+
+    def __init__(self, fname=None, max_entries=None):
+        if fname is None:
+            fname = os.environ.get('DISTPATCH_CHKSUM_CACHE')
+        if fname is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME',
+                                        os.path.expanduser('~/.cache'))
+            fname = os.path.join(cache_home, 'distpatch', 'chksums.sqlite')
+        self.fname = fname
+        if max_entries is None:
+            max_entries = int(os.environ.get('DISTPATCH_CHKSUM_CACHE_SIZE',
+                                             100000))
+        self.max_entries = max_entries
+        self.revalidate = os.environ.get('DISTPATCH_REVALIDATE', '') \
+                          not in ('', '0')
+        self._local = threading.local()
+        self._inserts = 0
+        self._inserts_lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None or not self.fname:
+            return conn
+        try:
+            dirname = os.path.dirname(os.path.abspath(self.fname))
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            conn = sqlite3.connect(self.fname, timeout=60)
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS chksums (' \
+                             'dev INTEGER, ino INTEGER, size INTEGER, ' \
+                             'mtime INTEGER, kind TEXT, value TEXT, ' \
+                             'atime REAL, PRIMARY KEY (dev, ino, kind))')
+                conn.execute('CREATE INDEX IF NOT EXISTS chksums_atime ' \
+                             'ON chksums (atime)')
+        except (OSError, sqlite3.Error):
+            # no cache, no problem
+            self.fname = None
+            return None
+        self._local.conn = conn
+        return conn
+
+    def identity(self, fname):
+        """Returns the identity of the file, or None if it can't be cached.
+        Callers take it before reading the file, and pass it to `set`.
+        """
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        # files modified too recently may change again without changing
+        # the modification time.
+        if time.time() - st.st_mtime < 2:
+            return None
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+    def get(self, fname, kind):
+        if self.revalidate:
+            return None
+        conn = self._conn()
+        identity = self.identity(fname)
+        if conn is None or identity is None:
+            return None
+        dev, ino, size, mtime = identity
+        try:
+            with conn:
+                row = conn.execute('SELECT value FROM chksums WHERE ' \
+                                   'dev = ? AND ino = ? AND kind = ? AND ' \
+                                   'size = ? AND mtime = ?',
+                                   (dev, ino, kind, size, mtime)).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE chksums SET atime = ? WHERE ' \
+                                 'dev = ? AND ino = ? AND kind = ?',
+                                 (time.time(), dev, ino, kind))
+        except sqlite3.Error:
+            return None
+        return row is not None and row[0] or None
+
+    def set(self, fname, kind, value, identity):
+        # the value isn't cached if the file changed while it was read
+        conn = self._conn()
+        if conn is None or identity is None or \
+           self.identity(fname) != identity:
+            return
+        dev, ino, size, mtime = identity
+        with self._inserts_lock:
+            self._inserts += 1
+            evict = self._inserts % self.evict_interval == 0
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO chksums VALUES ' \
+                             '(?, ?, ?, ?, ?, ?, ?)',
+                             (dev, ino, size, mtime, kind, value, time.time()))
+                if evict:
+                    count = conn.execute('SELECT COUNT(*) FROM chksums') \
+                            .fetchone()[0]
+                    if count > self.max_entries:
+                        conn.execute('DELETE FROM chksums WHERE rowid IN (' \
+                                     'SELECT rowid FROM chksums ORDER BY ' \
+                                     'atime LIMIT ?)',
+                                     (count - self.max_entries,))
+        except sqlite3.Error:
+            pass
+
+    def get_chksum(self, fname, kind):
+        value = self.get(fname, kind)
+        if value is None:
+            return None
+        pieces = value.split()
+        return Chksum(**dict([(key, get_handler(key).str2long(value)) \
+                              for key, value in zip(pieces[::2],
+                                                    pieces[1::2])]))
+
+    def set_chksum(self, fname, kind, chksum, identity):
+        self.set(fname, kind, ' '.join(['%s %s' % (i, getattr(chksum, i)) \
+                                        for i in Chksum.algorithms]), identity)
+
+
+chksum_cache = ChksumCache()
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.compression
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Detection of the parameters used to compress distfiles, to recompress
+    the reconstructed distfiles byte-identical to the originals.
+
+    Parameters are stored in the DeltaDB as a line with the name of the
+    compressor, followed by space-separated key=value pairs, e.g.::
+
+        gzip level=9 mtime=1300000000 name=foo-1.0.tar os=3 xfl=2
+        bzip2 level=9
+        xz check=crc64 preset=6
+        xz check=crc32 dict=4194304 filters=x86 preset=9e
+
+    Parameters are only detected if compressing the uncompressed file with
+    them, in-process, gives back the original file, byte by byte. That is
+    usually true for files compressed by zlib-based tools (e.g. git
+    archive), bzip2(1) and single-threaded xz(1), and usually false for
+    files compressed by pigz, pbzip2 or multithreaded xz(1). gzip(1) may go
+    either way.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import lzma
+import struct
+import zlib
+
+from collections import OrderedDict
+from urllib.parse import quote, unquote_to_bytes
+
+from distpatch.helpers import Compressor, parse_xz_preset, stream_file, \
+     uncompressed_filename_and_compressor
+
+
+class CompressionException(Exception):
+    pass
+
+
+class _Mismatch(Exception):
+    pass
+
+
+# gzip header flags
+_FTEXT, _FHCRC, _FEXTRA, _FNAME, _FCOMMENT = 1, 2, 4, 8, 16
+
+_xz_magic = b'\xfd7zXZ\x00'
+
+_xz_checks = OrderedDict([
+    ('none', lzma.CHECK_NONE),
+    ('crc32', lzma.CHECK_CRC32),
+    ('crc64', lzma.CHECK_CRC64),
+    ('sha256', lzma.CHECK_SHA256),
+])
+
+# filters supported before LZMA2, besides delta
+_xz_filters = OrderedDict([
+    ('x86', lzma.FILTER_X86),
+    ('powerpc', lzma.FILTER_POWERPC),
+    ('ia64', lzma.FILTER_IA64),
+    ('arm', lzma.FILTER_ARM),
+    ('armthumb', lzma.FILTER_ARMTHUMB),
+    ('sparc', lzma.FILTER_SPARC),
+])
+
+# dictionary sizes of the xz presets 0-9
+_xz_dict_sizes = [256 * 1024] + [i * 1024 * 1024 for i in (1, 2, 4, 4, 8, 8,
+                                                            16, 32, 64)]
+
+
+class _GzipCompressor(object):
+    # gzip member with a given header, same interface of Compressor
+
+    def __init__(self, level, memlevel, header):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                     memlevel)
+        self._header = header
+        self._crc = 0
+        self._size = 0
+
+    def feed(self, data, callback):
+        if self._header is not None:
+            callback(self._header)
+            self._header = None
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        out = self._obj.compress(data)
+        if len(out) > 0:
+            callback(out)
+
+    def close(self, callback):
+        if self._header is not None:
+            callback(self._header)
+            self._header = None
+        callback(self._obj.flush() + struct.pack('<II', self._crc & 0xffffffff,
+                                                 self._size & 0xffffffff))
+
+
+class Parameters(object):
+    """Parameters of a compressor. Values are kept as strings, as stored
+    in the DeltaDB.
+    """
+
+    def __init__(self, compressor, **params):
+        self.compressor = compressor
+        self.params = OrderedDict(sorted(params.items()))
+
+    @classmethod
+    def parse(cls, line):
+        pieces = line.split()
+        if len(pieces) == 0:
+            raise CompressionException('Empty compressor parameters')
+        params = {}
+        for piece in pieces[1:]:
+            key, sep, value = piece.partition('=')
+            if len(sep) == 0:
+                raise CompressionException('Invalid compressor parameter: ' \
+                                           '%s' % piece)
+            params[key] = value
+        return cls(pieces[0], **params)
+
+    def new_compressor(self):
+        """Returns a compressor object, with the same interface of
+        `distpatch.helpers.Compressor`.
+        """
+        p = self.params
+        try:
+            if self.compressor == 'gzip':
+                header = b'\x1f\x8b\x08'
+                flags = 0
+                extra = b''
+                if 'name' in p:
+                    flags |= _FNAME
+                    extra += unquote_to_bytes(p['name']) + b'\0'
+                if 'comment' in p:
+                    flags |= _FCOMMENT
+                    extra += unquote_to_bytes(p['comment']) + b'\0'
+                header += struct.pack('<BIBB', flags, int(p['mtime']),
+                                      int(p['xfl']), int(p['os'])) + extra
+                return _GzipCompressor(int(p['level']),
+                                       int(p.get('memlevel', 8)), header)
+            if self.compressor == 'bzip2':
+                return Compressor('bzip2', int(p['level']))
+            if self.compressor in ('xz', 'lzma'):
+                lzma_filter = {'preset': parse_xz_preset(p['preset'])}
+                if 'dict' in p:
+                    lzma_filter['dict_size'] = int(p['dict'])
+                if self.compressor == 'lzma':
+                    lzma_filter['id'] = lzma.FILTER_LZMA1
+                    return Compressor('lzma', filters=[lzma_filter])
+                lzma_filter['id'] = lzma.FILTER_LZMA2
+                filters = []
+                for name in p.get('filters', '').split(','):
+                    if len(name) == 0:
+                        continue
+                    if name.startswith('delta:'):
+                        filters.append({'id': lzma.FILTER_DELTA,
+                                        'dist': int(name[6:])})
+                    else:
+                        filters.append({'id': _xz_filters[name]})
+                filters.append(lzma_filter)
+                return Compressor('xz', check=_xz_checks[p['check']],
+                                  filters=filters)
+        except (KeyError, ValueError, TypeError, struct.error,
+                lzma.LZMAError) as err:
+            raise CompressionException('Invalid compressor parameters: %s ' \
+                                       '(%s)' % (self, err))
+        raise CompressionException('Invalid compressor: %s' % self.compressor)
+
+    def __str__(self):
+        return ' '.join([self.compressor] + ['%s=%s' % i \
+                                             for i in self.params.items()])
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.__str__())
+
+
+def _varint(data, pos):
+    rv = 0
+    for i in range(9):
+        if pos >= len(data):
+            raise IndexError
+        rv |= (data[pos] & 0x7f) << (7 * i)
+        pos += 1
+        if not data[pos - 1] & 0x80:
+            return rv, pos
+    raise IndexError
+
+
+def _ordered_levels(first):
+    return [first] + [i for i in [6, 9, 8, 7, 5, 4, 3, 2, 1] if i != first]
+
+
+def _gzip_candidates(data):
+    if len(data) < 10 or data[:3] != b'\x1f\x8b\x08':
+        return []
+    flags, mtime, xfl, os_ = struct.unpack('<BIBB', data[3:10])
+    if flags & ~(_FNAME | _FCOMMENT):
+        return []
+    params = {'mtime': str(mtime), 'xfl': str(xfl), 'os': str(os_)}
+    pos = 10
+    for flag, key in ((_FNAME, 'name'), (_FCOMMENT, 'comment')):
+        if flags & flag:
+            end = data.find(b'\0', pos)
+            if end == -1:
+                return []
+            params[key] = quote(data[pos:end], safe='')
+            pos = end + 1
+
+    # the header hints the level used: 2 for the best compression, 4 for
+    # the fastest one.
+    first = {2: 9, 4: 1}.get(xfl, 6)
+    rv = []
+    for memlevel in (8, 9):
+        for level in _ordered_levels(first):
+            p = dict(params, level=str(level))
+            if memlevel != 8:
+                p['memlevel'] = str(memlevel)
+            rv.append(Parameters('gzip', **p))
+    return rv
+
+
+def _bzip2_candidates(data):
+    if len(data) < 4 or data[:3] != b'BZh' or data[3:4] not in b'123456789':
+        return []
+    return [Parameters('bzip2', level=data[3:4].decode('ascii'))]
+
+
+def _lzma_presets(compressor, dict_size, **params):
+    # the presets with the dictionary size found come first, then the
+    # others with the dictionary size overriden, as xz(1) may shrink it
+    # for small files.
+    rv = []
+    for matches in (True, False):
+        for extreme in ('', 'e'):
+            for preset in _ordered_levels(6)[:1] + list(range(9, -1, -1)):
+                if (_xz_dict_sizes[preset] == dict_size) != matches:
+                    continue
+                p = dict(params, preset='%i%s' % (preset, extreme))
+                if not matches:
+                    p['dict'] = str(dict_size)
+                candidate = Parameters(compressor, **p)
+                if str(candidate) not in [str(i) for i in rv]:
+                    rv.append(candidate)
+    return rv
+
+
+def _xz_candidates(data):
+    if len(data) < 14 or data[:6] != _xz_magic or data[6] != 0:
+        return []
+    checks = dict([(value, key) for key, value in _xz_checks.items()])
+    check = checks.get(data[7] & 0x0f)
+    if check is None:
+        return []
+
+    # the block header of the first block has the filter chain. blocks
+    # with the sizes in the header are written by multithreaded xz(1)
+    block = data[12:]
+    if block[0] == 0 or block[1] & 0xfc:
+        return []
+    filters = []
+    pos = 2
+    try:
+        for i in range((block[1] & 0x03) + 1):
+            filter_id, pos = _varint(block, pos)
+            size, pos = _varint(block, pos)
+            props = block[pos:pos + size]
+            if len(props) != size:
+                return []
+            pos += size
+            filters.append((filter_id, props))
+    except IndexError:
+        return []
+    filter_id, lzma2_props = filters.pop()
+    if filter_id != lzma.FILTER_LZMA2 or len(lzma2_props) != 1 or \
+       lzma2_props[0] > 39:
+        return []
+    names = dict([(value, key) for key, value in _xz_filters.items()])
+    chain = []
+    for filter_id, props in filters:
+        if filter_id == lzma.FILTER_DELTA and len(props) == 1:
+            chain.append('delta:%i' % (props[0] + 1))
+        elif filter_id in names and len(props) == 0:
+            chain.append(names[filter_id])
+        else:
+            return []
+    params = {'check': check}
+    if len(chain) > 0:
+        params['filters'] = ','.join(chain)
+    dict_size = (2 | (lzma2_props[0] & 1)) << (lzma2_props[0] // 2 + 11)
+    return _lzma_presets('xz', dict_size, **params)
+
+
+def _lzma_candidates(data):
+    # just the default literal and position bits are supported
+    if len(data) < 13 or data[0] != 0x5d:
+        return []
+    return _lzma_presets('lzma', struct.unpack('<I', data[1:5])[0])
+
+
+_candidates = {
+    'gzip': _gzip_candidates,
+    'bzip2': _bzip2_candidates,
+    'xz': _xz_candidates,
+    'lzma': _lzma_candidates,
+}
+
+
+def _matches(params, fname, ufname, compressor):
+    obj = params.new_compressor()
+    with open(fname, 'rb') as fp:
+
+        def compare(data):
+            if fp.read(len(data)) != data:
+                raise _Mismatch
+
+        def callback(data):
+            obj.feed(data, compare)
+
+        try:
+            if ufname is not None:
+                stream_file(ufname, [callback])
+            else:
+                stream_file(fname, [], [callback], compressor)
+            obj.close(compare)
+        except _Mismatch:
+            return False
+        return len(fp.read(1)) == 0
+
+
+def detect_parameters(fname, ufname=None):
+    """Returns the Parameters that reproduce the given compressed file from
+    its uncompressed contents (read from `ufname`, if provided), or None if
+    none of the candidates does. Wrong candidates usually fail in the first
+    megabytes, the right one costs a full compression.
+    """
+    compressor = uncompressed_filename_and_compressor(fname)[1]
+    if compressor is None:
+        return None
+    with open(fname, 'rb') as fp:
+        data = fp.read(64 * 1024)
+    for params in _candidates[compressor](data):
+        if _matches(params, fname, ufname, compressor):
+            return params
+    return None
@@ -22,6 +22,19 @@
     - 3rd line is the text-formated checksums for the source file.
     - 4th line is the text-formated checksums for the destination file.
     - 5th line is the text-formated checksums for the delta file.
+    - 6th line, optional, is the parameters of the compressor of the
+      destination file, to recompress it byte-identical to the original,
+      see `distpatch.compression`.
+
+    New records are appended to a journal file (the database file name +
+    '.journal'), using the same format, with every record terminated by a line
+    with '--'. Records from the journal override records with the same delta
+    file name from the database. The journal is merged back into the database
+    by `DeltaDB.compact`.
+
+    The same records can be stored in a SQLite database instead, see
+    `distpatch.sqlitedb`. Use `open_deltadb` to load any of them, and
+    `convert_deltadb` to convert between formats.
 
     Simple example (Most of the checksums were ommited)::
 
@@ -37,17 +50,18 @@
 
 import codecs
 import os
+import threading
 
 from collections import OrderedDict
+from contextlib import contextmanager
 from fcntl import lockf, LOCK_EX, LOCK_UN
 
-from shutil import rmtree
 from snakeoil.chksum import get_handler
 from snakeoil.fileutils import AtomicWriteFile
 
-from distpatch.chksums import Chksum
-from distpatch.helpers import tempdir, uncompress, \
-     uncompressed_filename_and_compressor
+from distpatch.chksums import Chksum, compressed_chksums
+from distpatch.helpers import uncompressed_filename_and_compressor
+from distpatch.instrument import stage
 
 
 class DeltaDBException(Exception):
@@ -58,34 +72,54 @@ class UncompressedOk(Exception):
     pass
 
 
+def parse_chksum_line(line):
+    pieces = line.split()
+    chksums = OrderedDict()
+    uchksums = OrderedDict()
+    for key, value in zip(pieces[::2], pieces[1::2]):
+        key = key.lower()[:]
+        mykey = key[0] == 'u' and key[1:] or key
+        myvalue = get_handler(mykey).str2long(value.strip())
+        if key[0] == 'u':
+            uchksums[mykey] = myvalue
+        else:
+            chksums[mykey] = myvalue
+    return chksums, uchksums
+
+
 class DeltaDBFile(object):
 
-    def __init__(self, fname, ufname=None, chksums=None, uchksums=None):
+    def __init__(self, fname, ufname=None, chksums=None, uchksums=None,
+                 chksum_line=None, compression=None):
+
+        # parameters of the compressor, as stored in the DeltaDB
+        self.compression = compression
+
+        self._chksum_line = None
+        self._chksums = None
+        self._uchksums = None
+
+        # checksums line from the DeltaDB, just decoded when accessed
+        if chksum_line is not None:
+            self._chksum_line = chksum_line
 
         # just calculate checksums if they weren't provided manually
-        if chksums is None and uchksums is None:
-            self.chksums = Chksum(fname)
-
-            # calculate decompressed checksums
-            remove_uncompressed = False
-            if ufname is None:
-                tmp_dir = tempdir()
-                ufname = uncompress(fname, tmp_dir)
-                remove_uncompressed = True
-            self.uchksums = Chksum(ufname)
-            if remove_uncompressed:
-                rmtree(tmp_dir)
+        elif chksums is None and uchksums is None:
+
+            # calculate decompressed checksums while reading the compressed
+            # file, if we don't have it decompressed already
+            with stage('checksum') as measure:
+                if ufname is None:
+                    self.chksums, self.uchksums = compressed_chksums(fname)
+                else:
+                    self.chksums = Chksum(fname)
+                    self.uchksums = Chksum(ufname)
+                measure.bytes = self.uchksums.size.to_long()
 
         # manual
         elif chksums is not None and uchksums is not None:
-            if isinstance(chksums, Chksum):
-                self.chksums = chksums
-            else:
-                self.chksums = Chksum(**chksums)
-            if isinstance(uchksums, Chksum):
-                self.uchksums = uchksums
-            else:
-                self.uchksums = Chksum(**uchksums)
+            self.chksums = chksums
+            self.uchksums = uchksums
 
         else:
             raise DeltaDBException('You need to provide both dictionaries ' \
@@ -97,6 +131,57 @@ class DeltaDBFile(object):
             ufname = uncompressed_filename_and_compressor(fname)[0]
         self.ufname = os.path.basename(ufname)
 
+    def _parse_chksum_line(self):
+        chksums, uchksums = parse_chksum_line(self._chksum_line)
+        self._chksums = Chksum(**chksums)
+        self._uchksums = Chksum(**uchksums)
+        self._chksum_line = None
+
+    def _get_chksums(self):
+        if self._chksum_line is not None:
+            self._parse_chksum_line()
+        return self._chksums
+
+    def _set_chksums(self, chksums):
+        if self._chksum_line is not None:
+            self._parse_chksum_line()
+        if not isinstance(chksums, Chksum):
+            chksums = Chksum(**chksums)
+        self._chksums = chksums
+
+    chksums = property(_get_chksums, _set_chksums)
+
+    def _get_uchksums(self):
+        if self._chksum_line is not None:
+            self._parse_chksum_line()
+        return self._uchksums
+
+    def _set_uchksums(self, uchksums):
+        if self._chksum_line is not None:
+            self._parse_chksum_line()
+        if not isinstance(uchksums, Chksum):
+            uchksums = Chksum(**uchksums)
+        self._uchksums = uchksums
+
+    uchksums = property(_get_uchksums, _set_uchksums)
+
+    def format_chksums(self):
+        # records that were never decoded are written back as they were read
+        if self._chksum_line is not None:
+            return self._chksum_line
+        rv = []
+        for algorithm in Chksum.algorithms:
+            value = getattr(self.chksums, algorithm)
+            if value is None:
+                raise DeltaDBException('Invalid checksum for %s' % algorithm)
+            uvalue = getattr(self.uchksums, algorithm)
+            if uvalue is None:
+                raise DeltaDBException('Invalid uncompressed checksum for %s' \
+                                       % algorithm)
+            rv.append('%s %s U%s %s' % (algorithm.upper(), value.to_str(),
+                                        algorithm.upper(), uvalue.to_str()))
+        return ' '.join(rv)
+
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             raise DeltaDBException('Invalid operand for %s: %r' % \
@@ -128,131 +213,335 @@ class DeltaDBRecord(object):
             raise DeltaDBException('Invalid delta object: %r' % delta)
         self.delta = delta
 
-    def _format_checksum(self, obj):
-        rv = []
-        for algorithm in Chksum.algorithms:
-            value = getattr(obj.chksums, algorithm)
-            if value is None:
-                raise DeltaDBException('Invalid checksum for %s' % algorithm)
-            uvalue = getattr(obj.uchksums, algorithm)
-            if uvalue is None:
-                raise DeltaDBException('Invalid uncompressed checksum for %s' \
-                                       % algorithm)
-            rv.append('%s %s U%s %s' % (algorithm.upper(), value.to_str(),
-                                        algorithm.upper(), uvalue.to_str()))
-        return ' '.join(rv)
-
     def __str__(self):
         rv = [
             os.path.basename(self.delta.fname),
             os.path.basename(self.src.fname) + '\t' + os.path.basename(
                 self.dest.fname),
-            self._format_checksum(self.src),
-            self._format_checksum(self.dest),
-            self._format_checksum(self.delta),
+            self.src.format_chksums(),
+            self.dest.format_chksums(),
+            self.delta.format_chksums(),
         ]
+        if self.dest.compression is not None:
+            rv.append(self.dest.compression)
         return '\n'.join(rv)
 
     def __repr__(self):
         return '<%s %s>' % (self.__class__.__name__, self.delta.fname)
 
 
-class DeltaDB(list):
+def iter_raw_records(fp):
+    """Yields the lines of each record of a text DeltaDB, one record at a
+    time, without reading the whole file into memory.
+    """
+    record = []
+    for line in fp:
+        line = line.strip()
+        if line == '--':
+            if len(record) > 0:
+                yield record
+            record = []
+        elif len(line) > 0:
+            record.append(line)
+    if len(record) > 0:
+        yield record
+
+
+def record_from_raw(raw):
+    # first line is just the diff filename
+    delta_name = raw[0]
+
+    # second line is the src filename and the dest filename, separed by tab
+    src_name, dest_name = tuple(raw[1].split('\t'))
+
+    # lines 3,4 and 5 are checksums, only decoded when accessed
+    # line 6, optional, is the parameters of the compressor of dest
+    compression = len(raw) > 5 and raw[5] or None
+    return DeltaDBRecord(DeltaDBFile(src_name, chksum_line=raw[2]),
+                         DeltaDBFile(dest_name, chksum_line=raw[3],
+                                     compression=compression),
+                         DeltaDBFile(delta_name, chksum_line=raw[4]))
+
+
+# fcntl locks are per-process, we need to serialize threads by ourselves
+_thread_lock = threading.RLock()
+
+
+class DeltaDB(object):
+
+    # compact the journal automatically when it gets bigger than this
+    max_journal_records = 1000
 
     def __init__(self, fname):
         self.fname = fname
+        self.journal_fname = '%s.journal' % fname
+        self.lock_fname = '%s.lock' % fname
+        self._pending = None
+
+        # readers don't lock, see _init. just writers create the lock file.
         self._init()
 
+    @contextmanager
+    def _lock(self):
+        with _thread_lock:
+            # the lock file is never removed, otherwise two processes could
+            # lock different files with the same name.
+            with open(self.lock_fname, 'a+') as lock_fp:
+                lockf(lock_fp, LOCK_EX)
+                try:
+                    yield
+                finally:
+                    lockf(lock_fp, LOCK_UN)
+
+    def _file_id(self, fname):
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime
+
     def _init(self):
-        list.__init__(self)
+        # delta name -> DeltaDBRecord, or the raw record lines while the
+        # record wasn't accessed yet.
+        self._records = OrderedDict()
+        self._by_src = {}
+        self._by_dest = {}
+
+        # the journal is read before the database, so a compaction running
+        # in between can't hide records from us.
+        self._journal_id = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        journal = self._read_journal()
+        self._db_id = self._file_id(self.fname)
         self._parse_db()
-
-    def _parse_checksum_line(self, line):
-        pieces = line.split()
-        chksums = OrderedDict()
-        uchksums = OrderedDict()
-        for key, value in zip(pieces[::2], pieces[1::2]):
-            key = key.lower()[:]
-            mykey = key[0] == 'u' and key[1:] or key
-            myvalue = get_handler(mykey).str2long(value.strip())
-            if key[0] == 'u':
-                uchksums[mykey] = myvalue
+        self._apply_journal(journal)
+
+    def _read_journal(self):
+        journal_id = self._file_id(self.journal_fname)
+        if journal_id is None:
+            return []
+        if self._journal_id is not None and \
+           self._journal_id[:2] != journal_id[:2]:
+            raise DeltaDBException('Journal replaced: %s' % self.journal_fname)
+        try:
+            with open(self.journal_fname, 'rb') as fp:
+                fp.seek(self._journal_offset)
+                data = fp.read()
+        except (IOError, OSError):
+            # merged meanwhile by a compaction, its records are in the
+            # database file, read after it.
+            if os.path.exists(self.journal_fname):
+                raise
+            return []
+
+        # records are only valid after their '--' line, anything after the
+        # last one is a partial write.
+        end = data.rfind(b'\n--\n')
+        if end == -1:
+            data = b''
+        else:
+            data = data[:end + 4]
+        self._journal_id = journal_id
+        self._journal_offset += len(data)
+        return list(iter_raw_records(data.decode('utf-8').splitlines()))
+
+    def _apply_journal(self, journal):
+        for raw in journal:
+            src_name, dest_name = raw[1].split('\t')
+            self._index(raw[0], src_name, dest_name, raw)
+            self._journal_records += 1
+
+    def _refresh(self):
+        # called with the exclusive lock held. if nobody compacted the
+        # database since we loaded it, just read the journal tail.
+        if self._db_id == self._file_id(self.fname):
+            try:
+                journal = self._read_journal()
+            except DeltaDBException:
+                pass
             else:
-                chksums[mykey] = myvalue
-        return chksums, uchksums
+                self._apply_journal(journal)
+                return
+        self._init()
+
+    def _index(self, delta_name, src_name, dest_name, record):
+        if delta_name in self._records:
+            self._unindex(delta_name)
+        self._records[delta_name] = record
+        self._by_src.setdefault(src_name, []).append(delta_name)
+        self._by_dest.setdefault(dest_name, []).append(delta_name)
+
+    def _unindex(self, delta_name):
+        record = self._records.pop(delta_name)
+        if isinstance(record, DeltaDBRecord):
+            src_name, dest_name = record.src.fname, record.dest.fname
+        else:
+            src_name, dest_name = record[1].split('\t')
+        for index, key in ((self._by_src, src_name),
+                           (self._by_dest, dest_name)):
+            index[key].remove(delta_name)
+            if len(index[key]) == 0:
+                del index[key]
+
+    def _get_record(self, delta_name):
+        record = self._records[delta_name]
+        if not isinstance(record, DeltaDBRecord):
+            record = record_from_raw(record)
+            self._records[delta_name] = record
+        return record
+
+    def append(self, record):
+        self._index(record.delta.fname, record.src.fname, record.dest.fname,
+                    record)
 
     def _parse_db(self):
 
         if not os.path.exists(self.fname):
             return
 
-        # doing this without memory usage in mind, should fix
-        records = []
-        with codecs.open(self.fname, encoding='utf-8') as fp:
-            records = [i.strip() for i in fp.read().split('\n--\n')]
-
-        for record in records:
-            record = record.split('\n')
-
-            # first line is just the diff filename
-            delta_name = record[0]
+        with stage('deltadb.parse', os.path.getsize(self.fname)):
+            with codecs.open(self.fname, encoding='utf-8') as fp:
+                for raw in iter_raw_records(fp):
+                    src_name, dest_name = raw[1].split('\t')
+                    self._index(raw[0], src_name, dest_name, raw)
 
-            # second line is the src filename and the dest filename, separed by tab
-            src_name, dest_name = tuple(record[1].split('\t'))
+    def _format_record(self, delta_name):
+        record = self._records[delta_name]
+        if isinstance(record, DeltaDBRecord):
+            return str(record)
+        return '\n'.join(record)
 
-            # lines 3,4 and 5 are checksums
-            chksum_src, uchksum_src = self._parse_checksum_line(record[2])
-            chksum_dest, uchksum_dest = self._parse_checksum_line(record[3])
-            chksum_delta, uchksum_delta = self._parse_checksum_line(record[4])
+    def __iter__(self):
+        for delta_name in list(self._records.keys()):
+            yield self._get_record(delta_name)
 
-            self.append(DeltaDBRecord(DeltaDBFile(src_name,
-                                                  chksums=chksum_src,
-                                                  uchksums=uchksum_src),
-                                      DeltaDBFile(dest_name,
-                                                  chksums=chksum_dest,
-                                                  uchksums=uchksum_dest),
-                                      DeltaDBFile(delta_name,
-                                                  chksums=chksum_delta,
-                                                  uchksums=uchksum_delta)))
+    def __len__(self):
+        return len(self._records)
 
     def __contains__(self, key):
-        for dbrecord in self:
-            if key == dbrecord.delta.fname:
-                return True
-        return False
+        return key in self._records
 
     def get(self, delta):
-        for dbrecord in self:
-            if dbrecord.delta.fname == delta:
-                return dbrecord
+        if delta in self._records:
+            return self._get_record(delta)
+
+    def get_by_src(self, src):
+        return [self._get_record(i) for i in self._by_src.get(src, [])]
 
     def get_by_dest(self, dest):
-        rv = []
-        for dbrecord in self:
-            if dbrecord.dest.fname == dest:
-                rv.append(dbrecord)
-        return rv
+        return [self._get_record(i) for i in self._by_dest.get(dest, [])]
 
     def add(self, record):
+        if self._pending is not None:
+            self._pending.append(record)
+            self.append(record)
+            return
+        self.add_many([record])
+
+    def add_many(self, records):
+        records = list(records)
+        if len(records) == 0:
+            return
+
         # locking, because this should be as atomic as possible
-        lock_file = '%s.lock' % self.fname
-        with open(lock_file, 'w') as lock_fp:
-            lockf(lock_fp, LOCK_EX)
-            try:  # this makes sure that the lock is released if something bad happens
-                self._init()  # refresh the object to make sure that we have latest data
-                taken = []
-                for i in range(len(self)):
-                    if os.path.basename(record.delta.fname) == self[i].delta.fname:
-                        taken.append(i)
-                for i in taken:
-                    del self[i]
+        with stage('deltadb.add') as measure, self._lock():
+            self._refresh()  # make sure that we have latest data
+
+            # drop any partial write left behind by a crashed writer
+            if self._journal_id is not None and \
+               self._journal_id[2] > self._journal_offset:
+                with open(self.journal_fname, 'r+b') as fp:
+                    fp.truncate(self._journal_offset)
+
+            data = ''.join(['%s\n--\n' % record for record in records])
+            data = data.encode('utf-8')
+            measure.bytes = len(data)
+            with open(self.journal_fname, 'ab') as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            self._journal_id = self._file_id(self.journal_fname)
+            self._journal_offset += len(data)
+            for record in records:
                 self.append(record)
-                fp = AtomicWriteFile(self.fname)
-                fp.write('\n--\n'.join(map(str, self)))
-                fp.close()
-            finally:
-                lockf(lock_fp, LOCK_UN)
-                try:
-                    os.remove(lock_file)
-                except:
-                    pass
+                self._journal_records += 1
+
+            if self._journal_records > self.max_journal_records:
+                self._compact()
+
+    @contextmanager
+    def transaction(self):
+        """Buffers the records added inside the block, and commits all of
+        them with a single journal write when the block exits. Records are
+        independent from each other, so the ones added before an exception
+        are committed too.
+        """
+        if self._pending is not None:
+            raise DeltaDBException('Transaction already in progress')
+        self._pending = []
+        try:
+            yield self
+        finally:
+            pending = self._pending
+            self._pending = None
+            self.add_many(pending)
+
+    def compact(self):
+        """Merges the journal back into the database file."""
+        with self._lock():
+            self._refresh()
+            self._compact()
+
+    def _compact(self):
+        with stage('deltadb.compact') as measure:
+            data = '\n--\n'.join(map(self._format_record, self._records))
+            measure.bytes = len(data)
+            fp = AtomicWriteFile(self.fname)
+            fp.write(data)
+            fp.close()
+        if os.path.exists(self.journal_fname):
+            os.remove(self.journal_fname)
+        self._db_id = self._file_id(self.fname)
+        self._journal_id = None
+        self._journal_offset = 0
+        self._journal_records = 0
+
+
+def _backend(fname):
+    if os.path.exists(fname):
+        from distpatch.sqlitedb import sqlite_magic
+        with open(fname, 'rb') as fp:
+            if fp.read(len(sqlite_magic)) == sqlite_magic:
+                return 'sqlite'
+        return 'text'
+    if os.path.splitext(fname)[1] in ('.sqlite', '.sqlite3'):
+        return 'sqlite'
+    return 'text'
+
+
+def open_deltadb(fname, backend=None):
+    """Opens a DeltaDB with the given backend ('text' or 'sqlite'). If the
+    backend isn't provided, it is detected from the file contents, or from
+    the file extension for new databases.
+    """
+    if backend is None:
+        backend = _backend(fname)
+    if backend == 'text':
+        return DeltaDB(fname)
+    if backend == 'sqlite':
+        from distpatch.sqlitedb import SQLiteDeltaDB
+        return SQLiteDeltaDB(fname)
+    raise DeltaDBException('Invalid DeltaDB backend: %s' % backend)
+
+
+def convert_deltadb(db, fname, backend=None):
+    """Writes all the records of the given DeltaDB object to a new database,
+    returning it.
+    """
+    if os.path.exists(fname):
+        raise DeltaDBException('File already exists: %s' % fname)
+    new_db = open_deltadb(fname, backend)
+    new_db.add_many(db)
+    new_db.compact()
+    return new_db
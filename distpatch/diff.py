@@ -10,17 +10,20 @@
 """
 
 import os
-import portage
 import shutil
 
-from shutil import copy2, rmtree
+from shutil import rmtree
 from snakeoil.chksum import get_chksums
-from subprocess import call
 
-from distpatch.chksums import Chksum
+from distpatch.cache import uncompressed_cache
+from distpatch.chksums import Chksum, ChksumHasher, chksum_cache, \
+     uncompressed_size
+from distpatch.compression import CompressionException, detect_parameters
 from distpatch.deltadb import DeltaDBFile, DeltaDBRecord
 from distpatch.ebuild import Distfile
-from distpatch.helpers import uncompress, tempdir
+from distpatch.helpers import compress as compress_file, tempdir, \
+     uncompressed_filename_and_compressor
+from distpatch.instrument import call, stage
 from distpatch.patch import Patch, PatchException
 
 
@@ -48,9 +51,27 @@ _supported_formats = [
 class Diff(object):
 
     patch_format = 'switching'
-    _cleanup = []
+
+    # distfiles bigger than this (compressed) aren't diffed, None for no
+    # limit.
+    max_size = 300 * 1024 * 1024
+
+    # memory used by differ, per byte of the uncompressed distfiles
+    memory_factor = 2
+
+    # xz preset of the deltas, and number of threads of xz(1), to compress
+    # them with the multithreaded xz(1) instead of in-process (0 for one per
+    # processor, None for in-process).
+    xz_preset = 6
+    xz_threads = None
+
+    # detect the parameters of the compressor of the destination distfile,
+    # to be replayed when recompressing it. costs a compression of the
+    # distfile.
+    detect_compression = True
 
     def __init__(self, src, dest):
+        self._cleanup = []
         if not isinstance(src, Distfile):
             raise DiffException('Invalid src object: %r' % src)
         self.src = src
@@ -70,16 +91,51 @@ class Diff(object):
             if not found:
                 raise DiffUnsupported('Invalid distfile type: %s' % distfile)
 
-            # validate size (XXX: Improve this. Make the max size a config opt)
+            # validate size
+            if self.max_size is None:
+                return
+            import portage
             distfile_path = os.path.join(portage.settings['DISTDIR'],
                                          distfile)
             size = get_chksums(distfile_path, 'size')[0]
-            if size > (300 * 1024 * 1024):  # 300MB
+            if size > self.max_size:
                 raise DiffUnsupported('Invalid distfile size: %s' % distfile)
 
         validate(self.src.fname)
         validate(self.dest.fname)
 
+    def _diff_file(self, output_dir):
+        return os.path.join(output_dir, '%s-%s.%s' % (self.src.fname,
+                                                      self.dest.fname,
+                                                      self.patch_format))
+
+    def exists(self, output_dir, compress=True):
+        """Returns True if the delta was already generated in `output_dir`,
+        without looking at the distfiles.
+        """
+        diff_file = self._diff_file(output_dir)
+        if compress:
+            diff_file += '.xz'
+        if os.path.exists(diff_file):
+            self.diff_file = diff_file
+            return True
+        return False
+
+    def needs(self):
+        """Returns the estimated resources needed to generate the delta, for
+        `distpatch.scheduler.Scheduler`: the memory used by differ, and the
+        scratch disk space for the uncompressed distfiles and the validation
+        of the delta. The distfiles must be fetched already.
+        """
+        import portage
+        distdir = portage.settings['DISTDIR']
+        usrc = uncompressed_size(os.path.join(distdir, self.src.fname))
+        udest = uncompressed_size(os.path.join(distdir, self.dest.fname))
+        return {
+            'memory': self.memory_factor * (usrc + udest),
+            'scratch': usrc + 2 * udest,
+        }
+
     def fetch_distfiles(self):
         # please fetch from distpatch.package to avoid dupes
         self.src.fetch()
@@ -94,64 +150,82 @@ class Diff(object):
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        # building delta filename
-        self.diff_file = os.path.join(output_dir,
-                                      '%s-%s.%s' % (self.src.fname,
-                                                    self.dest.fname,
-                                                    self.patch_format))
-
         # check if delta already exists
-        diff_indisk = self.diff_file[:]
-        if compress:
-            diff_indisk += '.xz'
-        if os.path.exists(diff_indisk) and not force:
-            self.diff_file = diff_indisk
+        if not force and self.exists(output_dir, compress):
             raise DiffExists
+        self.diff_file = self._diff_file(output_dir)
 
+        import portage
         distdir = portage.settings['DISTDIR']
 
-        # copy files to output dir and uncompress
-        src = os.path.join(output_dir, self.src.fname)
-        dest = os.path.join(output_dir, self.dest.fname)
-        copy2(os.path.join(distdir, self.src.fname), src)
-        clean_sources and self.cleanup_register(src)
-        copy2(os.path.join(distdir, self.dest.fname), dest)
-        clean_sources and self.cleanup_register(dest)
-        usrc = uncompress(src, output_dir)
-        clean_sources and self.cleanup_register(usrc)
-        udest = uncompress(dest, output_dir)
-        clean_sources and self.cleanup_register(udest)
+        # decompress the distfiles straight from DISTDIR, hashing them. the
+        # sources go to a private directory, because diffs running in
+        # parallel may share distfiles.
+        stage_dir = output_dir
+        if clean_sources:
+            stage_dir = tempdir(prefix='.distdiffer-', dir=output_dir)
+            self.cleanup_register(stage_dir)
+        src = os.path.join(distdir, self.src.fname)
+        dest = os.path.join(distdir, self.dest.fname)
+        usrc, src_chksums, usrc_chksums = self._stage(src, stage_dir,
+                                                      clean_sources)
+        udest, dest_chksums, udest_chksums = self._stage(dest, stage_dir,
+                                                         clean_sources)
 
         cmd = [differ, usrc, udest, '--patch-format', self.patch_format,
                self.diff_file]
 
-        if call(cmd) != os.EX_OK:
+        if call(cmd, 'differ', usrc_chksums.size.to_long() + \
+                udest_chksums.size.to_long()) != os.EX_OK:
             raise DiffException('Failed to generate diff: %s' % self.diff_file)
 
-        # validation of delta
-        tmp_dir = tempdir()
-        clean_sources and self.cleanup_register(tmp_dir)
-        copy2(usrc, tmp_dir)
-        copy2(self.diff_file, tmp_dir)
-        uchksums = Chksum(self.diff_file)
-
-        # xz it
+        # xz it, hashing the delta and the compressed delta on the way
         if compress:
-            if call(['xz', '-f', self.diff_file]) != os.EX_OK:
-                raise DiffException('Failed to xz diff: %s' % self.diff_file)
-            self.diff_file += '.xz'
-
-        self.dbrecord = DeltaDBRecord(DeltaDBFile(src, usrc),
-                                      DeltaDBFile(dest, udest),
+            hasher, uhasher = ChksumHasher(), ChksumHasher()
+            with stage('compress') as measure:
+                try:
+                    self.diff_file = compress_file(
+                        self.diff_file, 'xz', self.xz_preset,
+                        self.xz_threads, [hasher.update], [uhasher.update])
+                except (IOError, OSError, RuntimeError) as err:
+                    raise DiffException('Failed to xz diff: %s' % str(err))
+                chksums, uchksums = hasher.chksum(), uhasher.chksum()
+                measure.bytes = uchksums.size.to_long()
+            # written here, so it was hashed as it is now
+            chksum_cache.set_chksum(self.diff_file, 'c', chksums,
+                                    chksum_cache.identity(self.diff_file))
+        else:
+            with stage('checksum') as measure:
+                chksums = uchksums = Chksum(self.diff_file)
+                measure.bytes = uchksums.size.to_long()
+
+        compression = None
+        if self.detect_compression:
+            with stage('detect', udest_chksums.size.to_long()):
+                try:
+                    params = detect_parameters(dest, udest)
+                except CompressionException:
+                    params = None
+            if params is not None:
+                compression = str(params)
+
+        self.dbrecord = DeltaDBRecord(DeltaDBFile(src, usrc, src_chksums,
+                                                  usrc_chksums),
+                                      DeltaDBFile(dest, udest, dest_chksums,
+                                                  udest_chksums,
+                                                  compression=compression),
                                       DeltaDBFile(self.diff_file,
-                                                  chksums=Chksum(
-                                                      self.diff_file),
+                                                  chksums=chksums,
                                                   uchksums=uchksums))
 
-        # reconstruct dest file from src and delta
+        # validation of delta: reconstruct dest file from the src file in
+        # DISTDIR and the delta in the output dir
+        tmp_dir = tempdir()
+        clean_sources and self.cleanup_register(tmp_dir)
         try:
             patch = Patch(self.dbrecord)
-            patch.reconstruct(output_dir, tmp_dir, False)
+            with stage('validate'):
+                patch.reconstruct(output_dir, tmp_dir, False)
         except PatchException as err:
             if clean_sources:
                 os.unlink(self.diff_file)
@@ -160,10 +234,22 @@ class Diff(object):
         # remove sources
         rmtree(tmp_dir)
         if clean_sources:
-            os.unlink(src)
-            os.unlink(dest)
-            os.unlink(usrc)
-            os.unlink(udest)
+            rmtree(stage_dir)
+
+    def _stage(self, distfile, output_dir, clean_sources):
+        # uncompressed distfiles are read in place, unless we want to
+        # preserve them in the output dir.
+        if clean_sources and \
+           uncompressed_filename_and_compressor(distfile)[1] is None:
+            with stage('checksum') as measure:
+                chksums = Chksum(distfile)
+                measure.bytes = chksums.size.to_long()
+            return distfile, chksums, chksums
+        # distfiles shared by consecutive diffs are decompressed just once
+        with stage('uncompress') as measure:
+            rv = uncompressed_cache.uncompress(distfile, output_dir)
+            measure.bytes = rv[2].size.to_long()
+        return rv
 
     def cleanup_register(self, dir_or_file):
         self._cleanup.append(dir_or_file)
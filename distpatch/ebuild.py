@@ -10,14 +10,27 @@
 """
 
 import os
-import portage
+import threading
 
 from collections import OrderedDict
 
-from portage.dbapi.porttree import _parse_uri_map
-from portage.package.ebuild.fetch import fetch
+from distpatch.instrument import stage
 
-dbapi = portage.create_trees()[portage.settings['ROOT']]['porttree'].dbapi
+# portage is imported just when needed, it is slow to load. the porttree
+# dbapi is created once, on first use, see `get_dbapi`.
+_dbapi = None
+_dbapi_lock = threading.Lock()
+
+
+def get_dbapi():
+    """Returns the porttree dbapi shared by all the distpatch modules."""
+    global _dbapi
+    with _dbapi_lock:
+        if _dbapi is None:
+            import portage
+            _dbapi = portage.create_trees()[portage.settings['ROOT']] \
+                     ['porttree'].dbapi
+    return _dbapi
 
 
 class EbuildException(Exception):
@@ -28,34 +41,75 @@ class DistfileException(Exception):
     pass
 
 
+def fetch_config():
+    """Returns a portage config to fetch distfiles. Clone it once and share
+    it between the ebuilds of a package.
+    """
+    import portage
+    mysettings = portage.config(clone=portage.settings)
+    if 'distpatch' in mysettings.features:
+        mysettings.features.remove('distpatch')
+    return mysettings
+
+
+def load_ebuilds(cpvs, mysettings=None):
+    """Returns an OrderedDict with Ebuild objects for the given CPVs, with
+    their metadata already loaded, sharing the same portage config.
+    """
+    dbapi = get_dbapi()
+    rv = OrderedDict()
+    for cpv in cpvs:
+        eapi, src_uri = dbapi.aux_get(cpv, ['EAPI', 'SRC_URI'])
+        rv[cpv] = Ebuild(cpv, mysettings, {'EAPI': eapi,
+                                            'SRC_URI': src_uri})
+    return rv
+
+
 class Ebuild(object):
 
-    def __init__(self, cpv):
-        if not dbapi.cpv_exists(cpv):
+    def __init__(self, cpv, mysettings=None, metadata=None):
+        if metadata is None and not get_dbapi().cpv_exists(cpv):
             raise EbuildException('Invalid CPV: %s' % cpv)
         self.cpv = cpv
+        self.mysettings = mysettings
+        self._metadata = metadata
+        self._src_uri_map = None
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            eapi, src_uri = get_dbapi().aux_get(self.cpv,
+                                                ['EAPI', 'SRC_URI'])
+            self._metadata = {'EAPI': eapi, 'SRC_URI': src_uri}
+        return self._metadata
 
     @property
     def eapi(self):
         try:
-            return int(dbapi.aux_get(self.cpv, ['EAPI'])[0])
+            return int(self.metadata['EAPI'])
         except:
             return 0
 
     @property
     def src_uri(self):
-        return ' '.join(dbapi.aux_get(self.cpv, ['SRC_URI']))
+        return self.metadata['SRC_URI']
 
     @property
     def src_uri_map(self):
-        return _parse_uri_map(self.cpv, {
-            'EAPI': self.eapi,
-            'SRC_URI': self.src_uri,
-        })
+        if self._src_uri_map is None:
+            from portage.dbapi.porttree import _parse_uri_map
+            self._src_uri_map = _parse_uri_map(self.cpv, {
+                'EAPI': self.eapi,
+                'SRC_URI': self.src_uri,
+            })
+        return self._src_uri_map
 
     def fetch(self, myfile=None):
-        mysettings = portage.config(clone=portage.settings)
-        mysettings['O'] = os.path.dirname(dbapi.findname(self.cpv))
+        from portage.package.ebuild.fetch import fetch
+        if self.mysettings is None:
+            self.mysettings = fetch_config()
+        mysettings = self.mysettings
+        mysettings['O'] = os.path.dirname(get_dbapi().findname(self.cpv))
         available_files = self.src_uri_map
         if myfile is None:
             files = available_files
@@ -64,9 +118,9 @@ class Ebuild(object):
                 raise EbuildException('Invalid distfile: %s' % myfile)
             files = OrderedDict()
             files[myfile] = available_files[myfile]
-        if 'distpatch' in mysettings.features:
-            mysettings.features.remove('distpatch')
-        if not fetch(files, mysettings, allow_missing_digests=False):
+        with stage('fetch'):
+            fetched = fetch(files, mysettings, allow_missing_digests=False)
+        if not fetched:
             raise EbuildException('Failed to fetch distfiles for %s' % self.cpv)
 
     def __repr__(self):
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.fetcher
+    ~~~~~~~~~~~~~~~~~
+
+    Concurrent downloader for deltas.
+
+    HTTP(S) mirrors are handled in-process, with a bounded number of parallel
+    transfers and persistent connections, reused for every delta downloaded
+    from the same host. Other URLs are handed to portage.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import os
+import posixpath
+import threading
+
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from queue import Queue, Empty
+from urllib.parse import quote, urljoin, urlsplit
+
+from distpatch import __version__
+from distpatch.chksums import Chksum
+from distpatch.helpers import bufsize
+from distpatch.instrument import stage
+
+user_agent = 'distpatch/%s' % __version__
+
+
+class FetcherException(Exception):
+    pass
+
+
+class DeltaFetcher(object):
+
+    max_redirects = 5
+
+    def __init__(self, root_url, output_dir=None, jobs=4, timeout=60):
+        if output_dir is None:
+            import portage
+            output_dir = os.path.join(portage.settings['DISTDIR'], 'patches')
+        self.root_url = root_url
+        self.output_dir = output_dir
+        self.jobs = jobs
+        self.timeout = timeout
+
+    def url(self, fname):
+        return posixpath.join(self.root_url, fname)
+
+    def _verified(self, path, dbrecord):
+        return os.path.exists(path) and \
+               Chksum(path) == dbrecord.delta.chksums
+
+    def fetch(self, dbrecords):
+        """Downloads the deltas of the given DeltaDBRecord objects that are
+        missing or invalid in the output directory. Returns a dictionary
+        with the error messages of the failed downloads, by delta name.
+        """
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        queue = Queue()
+        seen = set()
+        for dbrecord in dbrecords:
+            fname = dbrecord.delta.fname
+            if fname in seen:
+                continue
+            seen.add(fname)
+            if not self._verified(os.path.join(self.output_dir, fname),
+                                  dbrecord):
+                queue.put(dbrecord)
+        if queue.empty():
+            return {}
+        with stage('fetch', sum([i.delta.chksums.size.to_long() \
+                                 for i in queue.queue])):
+            if urlsplit(self.root_url)[0] not in ('http', 'https'):
+                return self._portage_fetch(list(queue.queue))
+            return self._fetch(queue)
+
+    def _fetch(self, queue):
+        errors = {}
+        threads = [threading.Thread(target=self._worker,
+                                    args=(queue, errors)) \
+                   for i in range(min(self.jobs, queue.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def _worker(self, queue, errors):
+        connections = {}
+        try:
+            while True:
+                try:
+                    dbrecord = queue.get_nowait()
+                except Empty:
+                    break
+                try:
+                    self._download(connections, dbrecord)
+                except (FetcherException, HTTPException, IOError,
+                        OSError) as err:
+                    errors[dbrecord.delta.fname] = str(err)
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+    def _connection(self, connections, scheme, netloc):
+        key = (scheme, netloc)
+        if key not in connections:
+            cls = scheme == 'https' and HTTPSConnection or HTTPConnection
+            connections[key] = cls(netloc, timeout=self.timeout)
+        return connections[key]
+
+    def _request(self, connections, url):
+        for redirect in range(self.max_redirects + 1):
+            scheme, netloc, path, query = urlsplit(url)[:4]
+            if scheme not in ('http', 'https'):
+                raise FetcherException('Unsupported URL: %s' % url)
+            path = quote(path or '/', safe='/%')
+            if query:
+                path += '?' + query
+
+            # a kept-alive connection may have been closed by the server
+            # meanwhile, retry once with a new one.
+            for retry in (True, False):
+                conn = self._connection(connections, scheme, netloc)
+                try:
+                    conn.request('GET', path, headers={
+                        'User-Agent': user_agent})
+                    response = conn.getresponse()
+                except (HTTPException, IOError, OSError):
+                    conn.close()
+                    del connections[(scheme, netloc)]
+                    if not retry:
+                        raise
+                else:
+                    break
+
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                response.read()
+                if location is None:
+                    raise FetcherException('Invalid redirect: %s' % url)
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                response.read()
+                raise FetcherException('Failed to fetch %s: %i %s' % \
+                                       (url, response.status,
+                                        response.reason))
+            return response
+        raise FetcherException('Too many redirects: %s' % url)
+
+    def _download(self, connections, dbrecord):
+        fname = dbrecord.delta.fname
+        path = os.path.join(self.output_dir, fname)
+        tmp_path = '%s.%s.part' % (path, threading.current_thread().ident)
+        response = self._request(connections, self.url(fname))
+        try:
+            with open(tmp_path, 'wb') as fp:
+                while True:
+                    data = response.read(bufsize)
+                    if not data:
+                        break
+                    fp.write(data)
+            if Chksum(tmp_path) != dbrecord.delta.chksums:
+                raise FetcherException('Bad checksum for delta: %s' % fname)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _portage_fetch(self, dbrecords):
+        import portage
+        from portage.package.ebuild.fetch import fetch
+        mysettings = portage.config(clone=portage.settings)
+        mysettings['DISTDIR'] = self.output_dir
+        if 'distpatch' in mysettings.features:
+            mysettings.features.remove('distpatch')
+        urls = [self.url(i.delta.fname) for i in dbrecords]
+        if fetch(urls, mysettings):
+            return {}
+        errors = {}
+        for dbrecord in dbrecords:
+            if not self._verified(os.path.join(self.output_dir,
+                                               dbrecord.delta.fname),
+                                  dbrecord):
+                errors[dbrecord.delta.fname] = 'Failed to fetch delta: %s' % \
+                                               self.url(dbrecord.delta.fname)
+        return errors
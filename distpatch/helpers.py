@@ -10,11 +10,23 @@
 """
 
 import atexit
+import bz2
+import fcntl
+import lzma
 import os
 import shutil
+import subprocess
 import tempfile
+import threading
+import zlib
 
-from subprocess import call
+from distpatch.instrument import stage
+
+# size of the chunks read from files and produced by decompressors
+bufsize = 1024 * 1024
+
+# ioctl to share the data blocks of two files (btrfs, xfs, ...)
+FICLONE = 0x40049409
 
 
 def tempdir(*args, **kwargs):
@@ -46,33 +58,320 @@ def uncompressed_filename_and_compressor(tarball):
     return dest + compressor[1], compressor[0]
 
 
-def uncompress(fname, output_dir=None):
-    # extract to a temporary directory and move back, to keep both files:
-    # compressed and uncompressed.
+class Decompressor(object):
+    """In-process decompressor, for data fed in chunks. Concatenated streams
+    are supported, like gzip(1) and friends do.
+    """
+
+    def __init__(self, compressor):
+        if compressor not in ('gzip', 'bzip2', 'xz', 'lzma'):
+            raise RuntimeError('Invalid compressor: %s' % compressor)
+        self.compressor = compressor
+        self._new()
+
+    def _new(self):
+        if self.compressor == 'gzip':
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.compressor == 'bzip2':
+            self._obj = bz2.BZ2Decompressor()
+        else:
+            self._obj = lzma.LZMADecompressor(lzma.FORMAT_AUTO)
+        self._fresh = True
+
+    def feed(self, data, callback):
+        """Decompresses `data`, calling `callback` for every chunk of
+        decompressed data.
+        """
+        data = bytes(data)
+        while len(data) > 0:
+            # null padding after a stream is ignored, as gzip(1) does
+            if self._fresh and len(data.strip(b'\0')) == 0:
+                return
+            self._fresh = False
+            try:
+                while True:
+                    out = self._obj.decompress(data, bufsize)
+                    if self.compressor == 'gzip':
+                        data = self._obj.unconsumed_tail
+                    else:
+                        data = b''
+                    if len(out) > 0:
+                        callback(out)
+                    if self._obj.eof:
+                        break
+                    if self.compressor == 'gzip':
+                        if len(data) == 0:
+                            return
+                    elif self._obj.needs_input:
+                        return
+            except (EOFError, IOError, OSError, lzma.LZMAError,
+                    zlib.error) as err:
+                raise RuntimeError('Failed to decompress data: %s' % err)
+            data = self._obj.unused_data
+            self._new()
+
+    def close(self, callback):
+        if self._fresh:
+            return
+        if self.compressor == 'gzip':
+            out = self._obj.flush()
+            if len(out) > 0:
+                callback(out)
+            if self._obj.eof:
+                return
+        raise RuntimeError('Truncated compressed data')
+
+
+def stream_file(fname, callbacks=(), ucallbacks=(), compressor=None):
+    """Reads the given file just once, calling every function from
+    `callbacks` with each chunk of its contents, and every function from
+    `ucallbacks` with each chunk of its decompressed contents.
+    """
+    decompressor = None
+    if len(ucallbacks) > 0 and compressor is not None:
+        decompressor = Decompressor(compressor)
+
+    def ucallback(data):
+        for callback in ucallbacks:
+            callback(data)
+
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(fname, 'rb', buffering=0) as fp:
+        while True:
+            size = fp.readinto(buf)
+            if not size:
+                break
+            data = view[:size]
+            for callback in callbacks:
+                callback(data)
+            if decompressor is not None:
+                decompressor.feed(data, ucallback)
+            else:
+                ucallback(data)
+    if decompressor is not None:
+        decompressor.close(ucallback)
+
+
+def uncompress(fname, output_dir=None, callbacks=(), ucallbacks=()):
+    """Decompresses the given file in-process, writing the decompressed file
+    straight to `output_dir` (default: the directory of the file), and
+    keeping the compressed file. The functions from `callbacks` and
+    `ucallbacks` are called with the chunks of compressed and decompressed
+    data, e.g. to hash them while decompressing.
+    """
     base_src = os.path.basename(fname)
     base_dest, compressor = uncompressed_filename_and_compressor(base_src)
-    tmp_dir = tempdir()
-    tmp_src = os.path.join(tmp_dir, base_src)
-    tmp_dest = os.path.join(tmp_dir, base_dest)
     local_dir = os.path.dirname(os.path.abspath(fname))
     local_src = os.path.join(local_dir, base_src)
     if output_dir is None:
         local_dest = os.path.join(local_dir, base_dest)
     else:
         local_dest = os.path.join(output_dir, base_dest)
-    shutil.copy2(local_src, tmp_src)
-    if compressor is not None:
-        rv = call([compressor, '-fd', tmp_src])
-        if rv is not os.EX_OK:
-            raise RuntimeError('Failed to decompress file: %d' % rv)
-        if not os.path.exists(tmp_dest):
-            raise RuntimeError('Decompressed file not found: %s' % tmp_dest)
-    shutil.move(tmp_dest, local_dest)
-    # we do automatic cleanup, but we should remove it here to save disk space
-    shutil.rmtree(tmp_dir)
+
+    # nothing to decompress
+    if compressor is None:
+        if os.path.abspath(local_dest) != local_src:
+            link_or_copy(local_src, local_dest)
+        if len(callbacks) > 0 or len(ucallbacks) > 0:
+            stream_file(local_src, list(callbacks) + list(ucallbacks))
+        return local_dest
+
+    # write to a temporary file, to not leave partial files behind
+    fd, tmp_dest = tempfile.mkstemp(prefix='.%s.' % base_dest,
+                                    dir=os.path.dirname(local_dest))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            stream_file(local_src, callbacks, [fp.write] + list(ucallbacks),
+                        compressor)
+        shutil.copystat(local_src, tmp_dest)
+        os.rename(tmp_dest, local_dest)
+    except:
+        os.unlink(tmp_dest)
+        raise
     return local_dest
 
 
+compressor_extensions = {
+    'gzip': '.gz',
+    'bzip2': '.bz2',
+    'xz': '.xz',
+    'lzma': '.lzma',
+}
+
+
+class Compressor(object):
+    """In-process compressor, for data fed in chunks. The default presets
+    are the same as the defaults of the command line tools, but the output
+    is not guaranteed to match theirs: xz(1) 5.6 and newer is multithreaded
+    by default, and gzip(1) isn't zlib. Files are only recompressed
+    byte-identical with the parameters recorded by
+    `distpatch.compression`, or when the original file was compressed by
+    bzip2(1) or single-threaded xz(1) with the default preset.
+
+    xz and lzma also accept the integrity check and the filter chain, as
+    supported by the lzma module. The preset is ignored if the filter chain
+    is provided.
+    """
+
+    def __init__(self, compressor, preset=None, check=-1, filters=None):
+        if compressor == 'gzip':
+            self._obj = zlib.compressobj(preset is None and 6 or preset,
+                                         zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compressor == 'bzip2':
+            self._obj = bz2.BZ2Compressor(preset is None and 9 or preset)
+        elif compressor in ('xz', 'lzma'):
+            if filters is not None:
+                preset = None
+            elif preset is None:
+                preset = 6
+            self._obj = lzma.LZMACompressor(
+                compressor == 'xz' and lzma.FORMAT_XZ or lzma.FORMAT_ALONE,
+                check, preset, filters)
+        else:
+            raise RuntimeError('Invalid compressor: %s' % compressor)
+
+    def feed(self, data, callback):
+        out = self._obj.compress(data)
+        if len(out) > 0:
+            callback(out)
+
+    def close(self, callback):
+        out = self._obj.flush()
+        if len(out) > 0:
+            callback(out)
+
+
+def xz_preset_arg(preset):
+    """Returns the command line argument of xz(1) for a preset of the lzma
+    module, e.g. '-9e'.
+    """
+    return '-%i%s' % (preset & ~lzma.PRESET_EXTREME,
+                      preset & lzma.PRESET_EXTREME and 'e' or '')
+
+
+def parse_xz_preset(value):
+    """Returns the preset of the lzma module for a preset given like in the
+    command line of xz(1), e.g. '9e'.
+    """
+    extreme = value.endswith('e')
+    preset = int(extreme and value[:-1] or value)
+    if preset < 0 or preset > 9:
+        raise ValueError('Invalid xz preset: %s' % value)
+    return preset | (extreme and lzma.PRESET_EXTREME or 0)
+
+
+def _xz_threaded(fname, fp, preset, threads, callbacks, ucallbacks):
+    # the file is read by a thread that feeds xz(1), its output is written
+    # and hashed by us.
+    cmd = ['xz', '-c', '-T%i' % threads, xz_preset_arg(preset)]
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    errors = []
+
+    def feed():
+        try:
+            stream_file(fname, list(ucallbacks) + [p.stdin.write])
+        except Exception as err:
+            errors.append(err)
+        finally:
+            try:
+                p.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    thread = threading.Thread(target=feed)
+    thread.start()
+    try:
+        while True:
+            data = p.stdout.read(bufsize)
+            if not data:
+                break
+            fp.write(data)
+            for callback in callbacks:
+                callback(data)
+    except:
+        # nobody will read the output of xz(1) anymore, it would block
+        # writing it, and the thread would block feeding it.
+        p.stdout.close()
+        p.kill()
+        raise
+    finally:
+        p.stdout.close()
+        thread.join()
+        with stage('xz') as measure:
+            pid, status, measure.rusage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+    if p.returncode != os.EX_OK or len(errors) > 0:
+        raise RuntimeError('Failed to compress file with xz: %s' % fname)
+
+
+def compress(fname, compressor='xz', preset=None, threads=None,
+             callbacks=(), ucallbacks=(), obj=None):
+    """Compresses the given file in-process, replacing it with the
+    compressed file, like the command line tools do. Returns the name of the
+    compressed file. The functions from `callbacks` and `ucallbacks` are
+    called with the chunks of compressed and uncompressed data, e.g. to hash
+    them while compressing. A compressor object, with the same interface of
+    `Compressor`, may be provided to be used instead of the default one.
+
+    If `threads` is provided, xz(1) compresses the file instead, with the
+    given number of threads (0 for one per processor). Its output is not the
+    same as the output of the single-threaded compressor.
+    """
+    if compressor not in compressor_extensions:
+        raise RuntimeError('Invalid compressor: %s' % compressor)
+    dest = fname + compressor_extensions[compressor]
+    fd, tmp_dest = tempfile.mkstemp(prefix='.%s.' % os.path.basename(dest),
+                                    dir=os.path.dirname(os.path.abspath(dest)))
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            if obj is None and threads is not None and compressor == 'xz':
+                _xz_threaded(fname, fp, preset is None and 6 or preset,
+                             threads, callbacks, ucallbacks)
+            else:
+                if obj is None:
+                    obj = Compressor(compressor, preset)
+
+                def callback(data):
+                    fp.write(data)
+                    for i in callbacks:
+                        i(data)
+
+                stream_file(fname, list(ucallbacks) + \
+                            [lambda data: obj.feed(data, callback)])
+                obj.close(callback)
+        shutil.copystat(fname, tmp_dest)
+        os.rename(tmp_dest, dest)
+    except:
+        os.unlink(tmp_dest)
+        raise
+    os.unlink(fname)
+    return dest
+
+
+def link_or_copy(src, dest):
+    """Makes `dest` a copy of `src`, trying to avoid copying the data: with a
+    hardlink, then with a reflink, then falling back to a real copy.
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        pass
+    try:
+        with open(src, 'rb') as fp_src:
+            with open(dest, 'wb') as fp_dest:
+                fcntl.ioctl(fp_dest.fileno(), FICLONE, fp_src.fileno())
+        shutil.copystat(src, dest)
+        return
+    except (IOError, OSError):
+        if os.path.exists(dest):
+            os.unlink(dest)
+    shutil.copy2(src, dest)
+
+
 def format_size(size):
 
     KB = 1024
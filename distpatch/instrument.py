@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.instrument
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Timing and resource usage of the stages of diffs and patches.
+
+    Nothing is recorded until `start_recording` is called. Then each stage
+    (decompression, checksums, external commands, DeltaDB writes, ...)
+    records its wall time and the number of bytes it processed, to the
+    record of the diff or patch running in the current thread, see
+    `recording`, or to the run-level record. External commands run with
+    `call` also record the CPU time and the peak memory (RSS) of the child
+    process.
+
+    Nested stages are named after their parents, e.g. 'validate/patcher',
+    and their time is included in the time of the parent.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_local = threading.local()
+
+# the Recorder of the running command, if any
+recorder = None
+
+
+class Stage(object):
+    """Accumulated measures of a stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.bytes = 0
+        self.cpu_user = 0.0
+        self.cpu_sys = 0.0
+        self.maxrss = 0
+
+    def add(self, wall, nbytes=0, rusage=None):
+        self.count += 1
+        self.wall += wall
+        self.bytes += nbytes
+        if rusage is not None:
+            self.cpu_user += rusage.ru_utime
+            self.cpu_sys += rusage.ru_stime
+            # kilobytes, on Linux
+            self.maxrss = max(self.maxrss, rusage.ru_maxrss * 1024)
+
+    def merge(self, other):
+        self.count += other.count
+        self.wall += other.wall
+        self.bytes += other.bytes
+        self.cpu_user += other.cpu_user
+        self.cpu_sys += other.cpu_sys
+        self.maxrss = max(self.maxrss, other.maxrss)
+
+    def to_dict(self):
+        return OrderedDict([('count', self.count), ('wall', self.wall),
+                            ('bytes', self.bytes),
+                            ('cpu_user', self.cpu_user),
+                            ('cpu_sys', self.cpu_sys),
+                            ('maxrss', self.maxrss)])
+
+
+class Record(object):
+    """Measures of the stages of a diff, a patch, or of the whole run."""
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.status = None
+        self.error = None
+        self.wall = 0.0
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, stage, wall, nbytes=0, rusage=None):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = Stage()
+            self.stages[stage].add(wall, nbytes, rusage)
+
+    def to_dict(self):
+        rv = OrderedDict([('kind', self.kind), ('name', self.name)])
+        if self.status is not None:
+            rv['status'] = self.status
+            if self.error is not None:
+                rv['error'] = self.error
+            rv['wall'] = self.wall
+        rv['stages'] = OrderedDict([(key, value.to_dict()) \
+                                    for key, value in self.stages.items()])
+        return rv
+
+
+def _rusage_dict(rusage):
+    return OrderedDict([('cpu_user', rusage.ru_utime),
+                        ('cpu_sys', rusage.ru_stime),
+                        ('maxrss', rusage.ru_maxrss * 1024)])
+
+
+class Recorder(object):
+    """Records of a run of a command, written as a JSON report."""
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.time()
+        self.run = Record('run', command)
+        self.records = []
+        self._lock = threading.Lock()
+
+    def append(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def totals(self):
+        rv = OrderedDict()
+        with self._lock:
+            records = [self.run] + self.records
+        for record in records:
+            for key, value in record.stages.items():
+                if key not in rv:
+                    rv[key] = Stage()
+                rv[key].merge(value)
+        return rv
+
+    def report(self):
+        statuses = OrderedDict()
+        for record in self.records:
+            statuses[record.status] = statuses.get(record.status, 0) + 1
+        return OrderedDict([
+            ('command', self.command),
+            ('argv', sys.argv[1:]),
+            ('started', time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                      time.gmtime(self.started))),
+            ('wall', time.time() - self.started),
+            ('rusage', OrderedDict([
+                ('self', _rusage_dict(
+                    resource.getrusage(resource.RUSAGE_SELF))),
+                ('children', _rusage_dict(
+                    resource.getrusage(resource.RUSAGE_CHILDREN))),
+            ])),
+            ('statuses', statuses),
+            ('totals', OrderedDict([(key, value.to_dict()) \
+                                    for key, value in self.totals().items()])),
+            ('run', self.run.to_dict()['stages']),
+            ('records', [i.to_dict() for i in self.records]),
+        ])
+
+    def write(self, fname):
+        with open(fname, 'w') as fp:
+            json.dump(self.report(), fp, indent=1)
+            fp.write('\n')
+
+
+def start_recording(command):
+    """Starts recording the stages of the running command, returning the
+    Recorder.
+    """
+    global recorder
+    recorder = Recorder(command)
+    return recorder
+
+
+@contextmanager
+def recording(kind, name):
+    """Records the stages run by the current thread inside the block, for
+    the diff or patch named `name`. The status of the record is 'ok', or
+    the name of the exception raised by the block.
+    """
+    if recorder is None:
+        yield None
+        return
+    record = Record(kind, name)
+    previous = getattr(_local, 'record', None)
+    _local.record = record
+    start = time.time()
+    try:
+        yield record
+    except BaseException as err:
+        record.status = err.__class__.__name__
+        record.error = str(err) or None
+        raise
+    else:
+        record.status = 'ok'
+    finally:
+        record.wall = time.time() - start
+        _local.record = previous
+        recorder.append(record)
+
+
+class _Measure(object):
+
+    def __init__(self, nbytes):
+        self.bytes = nbytes
+        self.rusage = None
+
+
+@contextmanager
+def stage(name, nbytes=0):
+    """Records the time spent inside the block as the stage `name`. The
+    number of bytes processed may be given in advance, or set in the
+    `bytes` attribute of the object returned.
+    """
+    measure = _Measure(nbytes)
+    if recorder is None:
+        yield measure
+        return
+    record = getattr(_local, 'record', None) or recorder.run
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(name)
+    key = '/'.join(stack)
+    start = time.time()
+    try:
+        yield measure
+    finally:
+        stack.pop()
+        record.add(key, time.time() - start, measure.bytes, measure.rusage)
+
+
+def call(cmd, name=None, nbytes=0, **kwargs):
+    """Same as `subprocess.call`, recording the command as a stage, named
+    after the executable by default, with the resource usage of the child.
+    """
+    if name is None:
+        name = os.path.basename(cmd[0])
+    with stage(name, nbytes) as measure:
+        p = subprocess.Popen(cmd, **kwargs)
+        try:
+            pid, status, measure.rusage = os.wait4(p.pid, 0)
+        except:
+            p.kill()
+            p.wait()
+            raise
+        p.returncode = os.waitstatus_to_exitcode(status)
+    return p.returncode
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.lineage
+    ~~~~~~~~~~~~~~~~~
+
+    Identification of the distfiles that are new versions of the distfiles
+    of the previous version of a package.
+
+    Distfile names are split in tokens: alphanumeric words, separators and
+    the archive extension. Names with the same tokens, apart from the
+    numbers (e.g. foo-1.9.tar.gz and foo-1.10.tar.gz), have the same template
+    and are always preferred. Then the names with longer common leading and
+    trailing tokens win, and then the names with closer version numbers.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import os
+import re
+
+from collections import OrderedDict
+
+re_extension = re.compile(r'(\.tar)?\.(%s)$|\.tar$' % \
+                          'gz|tgz|bz2|tbz2|xz|txz|lzma|zip|7z|Z')
+re_token = re.compile(r'[^\W_]+|[\W_]')
+
+
+class DistfileTokens(object):
+
+    def __init__(self, fname):
+        self.fname = fname
+        rv = re_extension.search(fname)
+        if rv is None:
+            stem, extension = fname, ''
+        else:
+            stem, extension = fname[:rv.start()], rv.group(0)
+        self.tokens = re_token.findall(stem) + [extension]
+        self.rtokens = self.tokens[::-1]
+        # numbers are None in the template, any string would collide with
+        # some distfile name
+        self.template = tuple([not i.isdigit() and i or None \
+                               for i in self.tokens])
+
+    def score(self, other):
+        if self.fname == other.fname:
+            return True, float(len(self.fname)), 0
+        prefix = os.path.commonprefix([self.tokens, other.tokens])
+        suffix = os.path.commonprefix([self.rtokens, other.rtokens])
+        chars = sum(map(len, prefix)) + sum(map(len, suffix))
+        if self.template != other.template:
+            return False, float(chars) / 2, 0
+        distance = 0
+        for a, b in zip(self.tokens, other.tokens):
+            if a != b:
+                distance += abs(int(a) - int(b))
+        return True, float(chars) / 2, -distance
+
+
+class Lineage(object):
+    """Finds the pairs of distfiles of consecutive versions of a package.
+    The distfiles of each version are tokenized just once.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+
+    def tokens(self, fname):
+        if fname not in self._tokens:
+            self._tokens[fname] = DistfileTokens(fname)
+        return self._tokens[fname]
+
+    def match(self, src_distfiles, dest_distfiles):
+        """Returns a list of (score, src, dest) tuples, with the best match
+        from `dest_distfiles` for each distfile from `src_distfiles`, if it
+        is unique.
+        """
+        dests = [self.tokens(i) for i in dest_distfiles]
+        by_template = {}
+        for dest in dests:
+            by_template.setdefault(dest.template, []).append(dest)
+        rv = []
+        for fname in src_distfiles:
+            src = self.tokens(fname)
+
+            # distfiles with the same template always win, look for the
+            # others just if there's none.
+            candidates = by_template.get(src.template, dests)
+            best = None
+            best_score = None
+            tie = False
+            for dest in candidates:
+                score = src.score(dest)
+                if score[1] <= 0:
+                    continue
+                if best_score is None or score > best_score:
+                    best, best_score, tie = dest, score, False
+                elif score == best_score:
+                    tie = True
+            if best is not None and not tie and best.fname != fname:
+                rv.append((best_score, fname, best.fname))
+        return rv
+
+    def identify(self, distfiles):
+        """Receives a list with the lists of distfiles of each version of a
+        package, in order. Returns a list of (version index, src, dest)
+        tuples, where `src` is from the given version and `dest` from the
+        next one. Each dest appears once, with the best of its sources.
+        """
+        taken = OrderedDict()
+        for i in range(len(distfiles) - 1):
+            for score, src, dest in self.match(distfiles[i],
+                                               distfiles[i + 1]):
+                if dest in taken:
+                    if taken[dest][0] > score:
+                        continue
+                    del taken[dest]
+                taken[dest] = (score, i, src, dest)
+        return [i[1:] for i in taken.values()]
@@ -10,15 +10,16 @@
 """
 
 import os
-import portage
 
 from collections import OrderedDict
 
 from distpatch.diff import Diff, DiffUnsupported
-from distpatch.ebuild import Distfile, Ebuild
+from distpatch.ebuild import Distfile, Ebuild, EbuildException, \
+     fetch_config, get_dbapi, load_ebuilds
+from distpatch.lineage import Lineage
 from distpatch.patch import Patch
-
-dbapi = portage.create_trees()[portage.settings['ROOT']]['porttree'].dbapi
+from distpatch.planner import ChainIndex, plan
+from distpatch.similarity import sketch
 
 
 class PackageException(Exception):
@@ -29,66 +30,31 @@ class Package(object):
 
     def __init__(self, deltadb):
         self.deltadb = deltadb
+        self.chain_index = ChainIndex(deltadb)
+        self.mysettings = None
+        self.ebuilds = OrderedDict()
+        self.diffs = []
+        self.existing = []
+
+    def _share_fetch_config(self):
+        # a single portage config is cloned to fetch the distfiles of all
+        # the ebuilds
+        if self.mysettings is None:
+            self.mysettings = fetch_config()
+        for ebuild in self.ebuilds.values():
+            ebuild.mysettings = self.mysettings
 
     def _lineage_identification(self):
+        ebuilds = list(self.ebuilds.values())
+        distfiles = [list(ebuild.src_uri_map.keys()) for ebuild in ebuilds]
         self.diffs = []
-        diffs = []
-        taken = {}
-        for ebuild_id in range(len(self.ebuilds) - 1):
-            cpvs = list(self.ebuilds.keys())
-            src_cpv = cpvs[ebuild_id]
-            dest_cpv = cpvs[ebuild_id + 1]
-            src_ebuild = self.ebuilds[src_cpv]
-            dest_ebuild = self.ebuilds[dest_cpv]
-            for src_distfile in list(src_ebuild.src_uri_map.keys()):
-                avg_distfile = None
-                avg_ebuild = None
-                max_avg = 0.0
-                avgs = {}
-                for dest_distfile in list(dest_ebuild.src_uri_map.keys()):
-                    prefix = ''
-                    suffix = ''
-                    for i in range(min(len(src_distfile), len(dest_distfile))):
-                        if src_distfile[i] == dest_distfile[i]:
-                            prefix += src_distfile[i]
-                        else:
-                            break
-                    for i in range(min(len(src_distfile), len(dest_distfile))):
-                        if src_distfile[-i - 1] == dest_distfile[-i - 1]:
-                            suffix = src_distfile[-i - 1] + suffix
-                        else:
-                            break
-                    avg = float(len(prefix) + len(suffix)) / 2
-                    if avg in avgs:
-                        if avg_distfile == avgs[avg]:
-                            avg_distfile = None
-                            avg_ebuild = None
-                        continue
-                    avgs[avg] = dest_distfile
-                    if avg > max_avg:
-                        avg_distfile = dest_distfile
-                        avg_ebuild = dest_ebuild
-                        max_avg = avg
-                if avg_distfile is not None and src_distfile != avg_distfile:
-                    diffs.append((max_avg, Diff(Distfile(src_distfile,
-                                                         src_ebuild),
-                                                Distfile(avg_distfile,
-                                                         avg_ebuild))))
-        for avg, diff in diffs:
-            if diff.dest.fname in taken:
-                if taken[diff.dest.fname][0] > avg:
-                    continue
-                else:
-                    tmp_diffs = []
-                    for tmp_diff in self.diffs:
-                        if tmp_diff.dest.fname != diff.dest.fname:
-                            tmp_diffs.append(tmp_diff)
-                    self.diffs = tmp_diffs
-            self.diffs.append(diff)
-            taken[diff.dest.fname] = (avg, diff)
+        for i, src, dest in Lineage().identify(distfiles):
+            self.diffs.append(Diff(Distfile(src, ebuilds[i]),
+                                   Distfile(dest, ebuilds[i + 1])))
 
     def _distfiles_list(self, output_dir):
         if output_dir is None:
+            import portage
             output_dir = portage.settings['DISTDIR']
         distfiles_list = []
         if os.path.isdir(output_dir):
@@ -98,14 +64,71 @@ class Package(object):
             distfiles_list += os.listdir(delta_dir)
         return distfiles_list
 
-    def diff(self, atom):
-        self.ebuilds = OrderedDict()
-        for cpv in dbapi.match(atom):
-            self.ebuilds[cpv] = Ebuild(cpv)
+    def _similarity_selection(self):
+        # the distfiles of all the versions are needed, to compare them.
+        self._share_fetch_config()
+        ebuilds = list(self.ebuilds.values())
+        for ebuild in ebuilds:
+            try:
+                ebuild.fetch()
+            except EbuildException:
+                pass
+        import portage
+        distdir = portage.settings['DISTDIR']
+        sketches = {}
+
+        def get_sketch(fname):
+            if fname not in sketches:
+                try:
+                    sketches[fname] = sketch(os.path.join(distdir, fname))
+                except Exception:
+                    sketches[fname] = None
+            return sketches[fname]
+
+        # any distfile that is new in a version can be reconstructed from any
+        # distfile of the previous versions, the one with the smallest
+        # predicted delta wins. the lineage is used if nothing is similar.
+        lineage = dict([(diff.dest.fname, diff) for diff in self.diffs])
+        owners = OrderedDict()
+        self.diffs = []
+        for ebuild in ebuilds:
+            new = [i for i in ebuild.src_uri_map.keys() if i not in owners]
+            for dest in new:
+                dest_sketch = get_sketch(dest)
+                best = None
+                if dest_sketch is not None:
+                    for src in owners:
+                        src_sketch = get_sketch(src)
+                        if src_sketch is None:
+                            continue
+                        size = dest_sketch.predicted_delta_size(src_sketch)
+                        if size < dest_sketch.usize and \
+                           (best is None or size < best[0]):
+                            best = size, src
+                if best is not None:
+                    self.diffs.append(Diff(Distfile(best[1], owners[best[1]]),
+                                           Distfile(dest, ebuild)))
+                elif dest in lineage:
+                    self.diffs.append(lineage[dest])
+            for dest in new:
+                owners[dest] = ebuild
+
+    def diff(self, atom, similarity=False, output_dir=None, compress=True):
+        """Finds the deltas to be generated for the package. If `output_dir`
+        is provided, the deltas that exist there already are moved to
+        `self.existing`, without validating their distfiles.
+        """
+        self.ebuilds = load_ebuilds(get_dbapi().match(atom))
         self._lineage_identification()
+        if similarity:
+            self._similarity_selection()
         _diffs = self.diffs[:]
         self.diffs = []
+        self.existing = []
         for diff in _diffs:
+            if output_dir is not None and diff.exists(output_dir, compress):
+                self.existing.append(diff)
+                continue
             try:
                 diff.validate_distfiles()
             except DiffUnsupported:
@@ -113,43 +136,51 @@ class Package(object):
             else:
                 self.diffs.append(diff)
 
-    def patch(self, cpv, output_dir=None):
+    def _deltas_list(self, input_dir):
+        if input_dir is None:
+            import portage
+            input_dir = os.path.join(portage.settings['DISTDIR'], 'patches')
+        if os.path.isdir(input_dir):
+            return os.listdir(input_dir)
+        return []
+
+    def _plan(self, distfile, distfiles, deltas):
+        # use the precomputed chains, if they are up to date. they don't
+        # know about downloaded deltas, that may make a chain cheaper than
+        # the full download.
+        if self.chain_index.open():
+            _plan = self.chain_index.plan(distfile, distfiles, deltas)
+            if _plan is not None and _plan.full_download and len(deltas) > 0:
+                _plan = plan(self.deltadb, distfile, distfiles, deltas)
+        else:
+            _plan = plan(self.deltadb, distfile, distfiles, deltas)
+        if _plan is None:
+            return
+        self.plans.append(_plan)
+        if not _plan.full_download:
+            self.patches.append(Patch(*_plan.dbrecords))
+
+    def patch(self, cpv, output_dir=None, extra_distfiles=(), input_dir=None,
+              extra_deltas=()):
         self.patches = []
+        self.plans = []
         ebuild = Ebuild(cpv)
-        distfiles = self._distfiles_list(output_dir)
-        hops_list = []
+        distfiles = self._distfiles_list(output_dir) + list(extra_distfiles)
+        deltas = self._deltas_list(input_dir) + list(extra_deltas)
         for distfile in ebuild.src_uri_map:
-            hops = []
-            dbline = self.deltadb.get_by_dest(distfile)
-            while len(dbline) > 0:
-                if dbline[0].dest.fname in distfiles:
-                    break
-                hops.append(dbline[0])
-                dbline = self.deltadb.get_by_dest(dbline[0].src.fname)
-            hops.reverse()
-            if len(hops) > 0 and hops[0].src.fname in distfiles:
-                hops_list.append(hops)
-        for hops in hops_list:
-            if len(hops) > 0:
-                self.patches.append(Patch(*hops))
+            self._plan(distfile, distfiles, deltas)
         return self.patches
 
-    def patch_distfile(self, distfile, output_dir=None):
+    def patch_distfile(self, distfile, output_dir=None, extra_distfiles=(),
+                       input_dir=None, extra_deltas=()):
         self.patches = []
-        distfiles = self._distfiles_list(output_dir)
-        hops = []
-        dbline = self.deltadb.get_by_dest(distfile)
-        while len(dbline) > 0:
-            if dbline[0].dest.fname in distfiles:
-                break
-            hops.append(dbline[0])
-            dbline = self.deltadb.get_by_dest(dbline[0].src.fname)
-        hops.reverse()
-        if len(hops) == 0 or hops[0].src.fname not in distfiles:
-            return
-        self.patches.append(Patch(*hops))
+        self.plans = []
+        distfiles = self._distfiles_list(output_dir) + list(extra_distfiles)
+        deltas = self._deltas_list(input_dir) + list(extra_deltas)
+        self._plan(distfile, distfiles, deltas)
 
     def fetch_distfiles(self):
+        self._share_fetch_config()
         fetched = []
         for diff in self.diffs:
             if diff.src.fname not in fetched:
@@ -161,4 +192,5 @@ class Package(object):
 
 
 # used by distdiffer --all
-cp_all = dbapi.cp_all
+def cp_all():
+    return get_dbapi().cp_all()
@@ -9,22 +9,30 @@
     :license: GPL-2, see LICENSE for more details.
 """
 
+import errno
 import os
-import portage
-import posixpath
 import re
+import subprocess
+import tempfile
+import threading
 
 
-from portage.package.ebuild.fetch import fetch
-from shutil import move
-from subprocess import call
+from shutil import move, rmtree
 
-from distpatch.chksums import Chksum
+from distpatch.chksums import Chksum, ChksumHasher
+from distpatch.compression import CompressionException, Parameters
 from distpatch.deltadb import DeltaDBFile, DeltaDBRecord
-from distpatch.helpers import uncompressed_filename_and_compressor
+from distpatch.helpers import Compressor, bufsize, \
+     compress as compress_file, uncompressed_filename_and_compressor
+from distpatch.instrument import call, stage
 
 re_diff_filename = re.compile(r'(?P<dest>.+)\.(?P<format>[^(\.xz)]+)(\.xz)?$')
 
+# the umask can only be read by setting it, do it once, before any thread
+# creates files
+_umask = os.umask(0o022)
+os.umask(_umask)
+
 
 class PatchException(Exception):
     pass
@@ -32,6 +40,11 @@ class PatchException(Exception):
 
 class Patch(object):
 
+    # stream the output of patcher, through a FIFO, to the hashers and the
+    # compressor, writing the destination file just once. patcher must
+    # write its output sequentially.
+    streaming = True
+
     def __init__(self, *dbrecords):
 
         # validate dbrecords
@@ -50,18 +63,13 @@ class Patch(object):
         if not self._verify_deltas():
             raise PatchException('Invalid delta series: %s' % self.dbrecords)
 
-    def fetch_deltas(self, root_url, output_dir=None):
-        if output_dir is None:
-            output_dir = os.path.join(portage.settings['DISTDIR'], 'patches')
-        mysettings = portage.config(clone=portage.settings)
-        mysettings['DISTDIR'] = output_dir
-        urls = []
-        for record in self.dbrecords:
-            urls.append(posixpath.join(root_url, record.delta.fname))
-        if 'distpatch' in mysettings.features:
-            mysettings.features.remove('distpatch')
-        if not fetch(urls, mysettings):
-            raise PatchException('Failed to fetch deltas: %s' % urls)
+    def fetch_deltas(self, root_url, output_dir=None, jobs=1):
+        from distpatch.fetcher import DeltaFetcher
+        fetcher = DeltaFetcher(root_url, output_dir, jobs)
+        errors = fetcher.fetch(self.dbrecords)
+        if len(errors) > 0:
+            raise PatchException('Failed to fetch deltas: %s' % \
+                                 ', '.join(sorted(errors.values())))
 
     def _verify_deltas(self):
         self.patch_format = None
@@ -80,6 +88,7 @@ class Patch(object):
     def reconstruct(self, input_dir=None, output_dir=None, compress=True):
         diffball_bindir = os.environ.get('DIFFBALL_BINDIR', '/usr/bin')
         patcher = os.path.join(diffball_bindir, 'patcher')
+        import portage
         distdir = portage.settings['DISTDIR']
         if input_dir is None:
             input_dir = os.path.join(distdir, 'patches')
@@ -93,40 +102,197 @@ class Patch(object):
                   for i in self.dbrecords]
 
         # validate source and deltas before recompose
-        if self.src != DeltaDBFile(src):
-            raise PatchException('Bad checksum for source: %s' % \
-                                 self.src.fname)
-        for delta, delta_record in zip(deltas, self.dbrecords):
-            if delta_record.delta != DeltaDBFile(delta):
-                raise PatchException('Bad checksum for delta: %s' % \
-                                     delta_record.delta.fname)
+        with stage('verify'):
+            if self.src != DeltaDBFile(src):
+                raise PatchException('Bad checksum for source: %s' % \
+                                     self.src.fname)
+            for delta, delta_record in zip(deltas, self.dbrecords):
+                if delta_record.delta != DeltaDBFile(delta):
+                    raise PatchException('Bad checksum for delta: %s' % \
+                                         delta_record.delta.fname)
 
         # recompose :)
         cmd = [patcher, src, '--patch-format', self.patch_format]
         cmd.extend(deltas)
+        nbytes = self.src.uchksums.size.to_long() + \
+                 sum([i.delta.uchksums.size.to_long() \
+                      for i in self.dbrecords])
+        if not compress:
+            compressor = None
+        obj = None
+        if compressor is not None:
+            obj = self._compressor(compressor)
+            if obj is None and compressor != 'gzip':
+                obj = Compressor(compressor)
+        if self.streaming and (compressor is None or obj is not None):
+            self._reconstruct_streaming(cmd, nbytes, dest, output_dir, obj)
+            return
         cmd.append(dest)
-        if call(cmd) != os.EX_OK:
+        if call(cmd, 'patcher', nbytes) != os.EX_OK:
             raise PatchException('Failed to reconstruct file: %s' % dest)
 
         # validate checksums for uncompressed destination
-        if self.dest.uchksums != Chksum(dest):
+        with stage('checksum', self.dest.uchksums.size.to_long()):
+            valid = self.dest.uchksums == Chksum(dest)
+        if not valid:
             raise PatchException(
                 'Bad checksum for uncompressed destination: %s' % \
                 self.dest.fname)
 
-        # compress the destination file, if needed.
-        if compress and compressor is not None:
-            if call([compressor, dest]) != os.EX_OK:
-                raise PatchException(
-                    'Failed to compress reconstructed file: %s' % dest)
-            dest += os.path.splitext(self.dest.fname)[1]
-            if self.dest.chksums != Chksum(dest):
-                invalid_dir = os.path.join(output_dir, 'delta-reconstructed')
-                if not os.path.exists(invalid_dir):
-                    os.makedirs(invalid_dir)
-                move(dest, invalid_dir)
+        # compress the destination file, if needed, in-process and hashing
+        # the output on the way. the parameters of the compressor detected
+        # by distdiffer are replayed, if any. otherwise the defaults are
+        # used, and gzip(1) is still called, because zlib doesn't produce
+        # the same output.
+        if compressor is not None:
+            if obj is None:
+                if call([compressor, dest], compressor,
+                        self.dest.uchksums.size.to_long()) != os.EX_OK:
+                    raise PatchException(
+                        'Failed to compress reconstructed file: %s' % dest)
+                compressed = dest + '.gz'
+                with stage('checksum', self.dest.chksums.size.to_long()):
+                    chksums = Chksum(compressed)
+            else:
+                hasher = ChksumHasher()
+                with stage('compress', self.dest.uchksums.size.to_long()):
+                    try:
+                        compressed = compress_file(dest, compressor,
+                                                   callbacks=[hasher.update],
+                                                   obj=obj)
+                    except (IOError, OSError, RuntimeError) as err:
+                        raise PatchException(
+                            'Failed to compress reconstructed file: %s' % \
+                            str(err))
+                chksums = hasher.chksum()
+            dest = os.path.join(output_dir, self.dest.fname)
+            if compressed != dest:
+                os.rename(compressed, dest)
+            if self.dest.chksums != chksums:
+                self._move_invalid(dest, output_dir)
+        self.dest_distfile = dest
+
+    def _reconstruct_streaming(self, cmd, nbytes, dest, output_dir, obj):
+        # patcher -> uncompressed hashers -> compressor -> hashers -> file.
+        # nothing is left behind on failures.
+        if obj is not None:
+            dest = os.path.join(output_dir, self.dest.fname)
+        hasher, uhasher = ChksumHasher(), ChksumHasher()
+        tmp_dest = None
+        try:
+            fd, tmp_dest = tempfile.mkstemp(prefix='.%s.' % \
+                                            os.path.basename(dest),
+                                            dir=output_dir)
+
+            # mkstemp creates the file readable just by its owner
+            os.fchmod(fd, 0o666 & ~_umask)
+            fp = os.fdopen(fd, 'wb')
+            with fp:
+
+                def write(data):
+                    fp.write(data)
+                    hasher.update(data)
+
+                def callback(data):
+                    uhasher.update(data)
+                    if obj is None:
+                        fp.write(data)
+                    else:
+                        obj.feed(data, write)
+
+                with stage('stream', nbytes) as measure:
+                    try:
+                        rv = self._stream(cmd, callback, measure)
+                    except (IOError, OSError, RuntimeError) as err:
+                        raise PatchException('Failed to reconstruct file: ' \
+                                             '%s: %s' % (dest, str(err)))
+                    if rv != os.EX_OK:
+                        raise PatchException('Failed to reconstruct file: ' \
+                                             '%s' % dest)
+                    if self.dest.uchksums != uhasher.chksum():
+                        raise PatchException(
+                            'Bad checksum for uncompressed destination: ' \
+                            '%s' % self.dest.fname)
+                    if obj is not None:
+                        obj.close(write)
+            os.rename(tmp_dest, dest)
+        except:
+            if tmp_dest is not None and os.path.exists(tmp_dest):
+                os.unlink(tmp_dest)
+            raise
+        if obj is not None and self.dest.chksums != hasher.chksum():
+            self._move_invalid(dest, output_dir)
         self.dest_distfile = dest
 
+    def _stream(self, cmd, callback, measure):
+        # runs patcher writing to a FIFO, calling `callback` with each chunk
+        # of its output. returns the exit code of patcher.
+        tmp_dir = tempfile.mkdtemp(prefix='distpatcher-')
+        fifo = os.path.join(tmp_dir, 'dest')
+        os.mkfifo(fifo)
+        rv = []
+        errors = []
+        done = threading.Event()
+
+        def watch():
+            try:
+                rv.extend(os.wait4(p.pid, 0)[1:])
+
+                # if patcher died without opening the FIFO, we would block
+                # opening it forever. a writer that goes away unblocks us.
+                while not done.is_set():
+                    try:
+                        os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                        break
+                    except OSError as err:
+                        if err.errno != errno.ENXIO:
+                            raise
+                        done.wait(0.01)
+            except Exception as err:
+                errors.append(err)
+
+        try:
+            p = subprocess.Popen(cmd + [fifo])
+            thread = threading.Thread(target=watch)
+            thread.start()
+            try:
+                with open(fifo, 'rb', buffering=0) as fp:
+                    while True:
+                        data = fp.read(bufsize)
+                        if not data:
+                            break
+                        callback(data)
+            except:
+                p.kill()
+                raise
+            finally:
+                done.set()
+                thread.join()
+        finally:
+            rmtree(tmp_dir)
+        if len(errors) > 0:
+            raise PatchException('Failed to wait for patcher: %s' % \
+                                 str(errors[0]))
+        status, measure.rusage = rv
+        return os.waitstatus_to_exitcode(status)
+
+    def _move_invalid(self, dest, output_dir):
+        invalid_dir = os.path.join(output_dir, 'delta-reconstructed')
+        if not os.path.exists(invalid_dir):
+            os.makedirs(invalid_dir)
+        move(dest, invalid_dir)
+
+    def _compressor(self, compressor):
+        if self.dest.compression is None:
+            return None
+        try:
+            params = Parameters.parse(self.dest.compression)
+            if params.compressor != compressor:
+                return None
+            return params.new_compressor()
+        except CompressionException:
+            return None
+
     def __str__(self):
         return ' -> '.join([i.delta.fname for i in self.dbrecords])
 
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.planner
+    ~~~~~~~~~~~~~~~~~
+
+    Planner for the cheapest series of deltas to reconstruct a distfile.
+
+    The DeltaDB is handled as a graph, with distfiles as nodes and deltas as
+    edges, weighted by the size of the delta. Deltas already downloaded cost
+    nothing. The cheapest path from any distfile available locally to the
+    wanted distfile is found with Dijkstra's algorithm, searching backwards
+    from the wanted distfile. All the deltas of a path must use the same
+    patch format.
+
+    The mirrors may ship a chain index with the DeltaDB (the database file
+    name + '.chains'), with the cheapest chain from every source to every
+    destination precomputed, see `ChainIndex`.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import heapq
+import mmap
+import os
+
+from snakeoil.fileutils import AtomicWriteFile
+
+from distpatch.patch import re_diff_filename
+
+chains_magic = '# distpatch chains'
+
+
+class PlannerException(Exception):
+    pass
+
+
+class Plan(object):
+    """Cheapest way to get a distfile: a series of DeltaDBRecord objects
+    to be applied, in order, with the number of bytes to be downloaded, or
+    the full download of the distfile, if it is cheaper.
+    """
+
+    def __init__(self, dest, dbrecords, cost, full_size=None):
+        self.dest = dest
+        self.dbrecords = dbrecords
+        self.cost = cost
+        self.full_size = full_size
+
+    @property
+    def full_download(self):
+        return len(self.dbrecords) == 0
+
+    def __str__(self):
+        if self.full_download:
+            return self.dest
+        return ' -> '.join([i.delta.fname for i in self.dbrecords])
+
+    def __repr__(self):
+        return '<%s %s (%i bytes)>' % (self.__class__.__name__,
+                                       self.__str__(), self.cost)
+
+
+def _delta_size(dbrecord):
+    return int(dbrecord.delta.chksums.size.to_long())
+
+
+def _search(deltadb, dest, records, limit, deltas=()):
+    # yields the (distfile, cost, dbrecords) tuples for the distfiles that
+    # can be used to reconstruct `dest` for less than `limit` bytes, cheapest
+    # first.
+    #
+    # nodes are (distfile, patch format) pairs, the patch format of a path is
+    # chosen by its last delta. for each node we store the cost to reach
+    # `dest` and the delta to take towards it.
+    start = (dest, None)
+    costs = {start: 0}
+    nexts = {start: None}
+    done = set()
+    queue = [(0, 0, start)]
+    counter = 1
+    while len(queue) > 0:
+        cost, i, node = heapq.heappop(queue)
+        if node in done:
+            continue
+        done.add(node)
+        if cost >= limit:
+            break
+        fname, patch_format = node
+        if node is not start:
+            dbrecords = []
+            tmp_node = node
+            while nexts[tmp_node] is not None:
+                tmp_node, dbrecord = nexts[tmp_node]
+                dbrecords.append(dbrecord)
+            yield fname, cost, dbrecords
+            records = deltadb.get_by_dest(fname)
+        for dbrecord in records:
+            rv = re_diff_filename.match(dbrecord.delta.fname)
+            if rv is None:
+                continue
+            delta_format = rv.groupdict().get('format')
+            if patch_format is not None and patch_format != delta_format:
+                continue
+            src = (dbrecord.src.fname, delta_format)
+            if src in done:
+                continue
+            src_cost = cost
+            if dbrecord.delta.fname not in deltas:
+                src_cost += _delta_size(dbrecord)
+            if src not in costs or src_cost < costs[src]:
+                costs[src] = src_cost
+                nexts[src] = (node, dbrecord)
+                heapq.heappush(queue, (src_cost, counter, src))
+                counter += 1
+
+
+def plan(deltadb, dest, distfiles, deltas=()):
+    """Returns the cheapest Plan to get the `dest` distfile, using deltas
+    from `deltadb` and any of the `distfiles` available as source. Deltas
+    from `deltas` are already downloaded. Returns None if the distfile is
+    already available, or if it can't be reconstructed nor its size is
+    known.
+    """
+    distfiles = set(distfiles)
+    deltas = set(deltas)
+    if dest in distfiles:
+        return None
+
+    # the size of the full download is known from any delta that produces
+    # the distfile.
+    records = deltadb.get_by_dest(dest)
+    if len(records) == 0:
+        return None
+    full_size = int(records[0].dest.chksums.size.to_long())
+
+    for src, cost, dbrecords in _search(deltadb, dest, records, full_size,
+                                        deltas):
+        if src in distfiles:
+            return Plan(dest, dbrecords, cost, full_size)
+    return Plan(dest, [], full_size, full_size)
+
+
+class ChainIndex(object):
+    """Index with the cheapest chain of deltas to reconstruct each
+    destination distfile of a DeltaDB, from each of the distfiles that can
+    be used as source, when nothing was downloaded yet. Plans are answered
+    with a binary search on the index file, without walking the graph.
+
+    The first line of the index identifies the database file it was built
+    from. The index is ignored if the database changed since then, or if the
+    database has records in its journal. Each following line has the
+    destination, its size, the source, the cost of the chain and the deltas
+    of the chain, separated by TABs and sorted by destination and cost::
+
+        foo-2.tgz  1000  foo-1.tgz  120  foo-1.tgz-foo-2.tgz.switching.xz
+    """
+
+    def __init__(self, deltadb, fname=None):
+        self.deltadb = deltadb
+        if fname is None:
+            fname = '%s.chains' % deltadb.fname
+        self.fname = fname
+        self._mmap = None
+        self._start = 0
+
+    def _db_id(self):
+        journal_fname = getattr(self.deltadb, 'journal_fname', None)
+        if journal_fname is not None and os.path.exists(journal_fname) and \
+           os.path.getsize(journal_fname) > 0:
+            return None
+        try:
+            st = os.stat(self.deltadb.fname)
+        except OSError:
+            return None
+        return '%s %i %i' % (chains_magic, st.st_size, st.st_mtime_ns)
+
+    def build(self):
+        """Builds the index from the DeltaDB, merging its journal first."""
+        self.deltadb.compact()
+        db_id = self._db_id()
+        if db_id is None:
+            raise PlannerException('DeltaDB changed while building the ' \
+                                   'chains index, or is not a file: %s' % \
+                                   self.deltadb.fname)
+        dests = set()
+        for dbrecord in self.deltadb:
+            dests.add(dbrecord.dest.fname)
+        fp = AtomicWriteFile(self.fname)
+        fp.write('%s\n' % db_id)
+        for dest in sorted(dests, key=lambda x: x.encode('utf-8')):
+            records = self.deltadb.get_by_dest(dest)
+            full_size = int(records[0].dest.chksums.size.to_long())
+            seen = set()
+            for src, cost, dbrecords in _search(self.deltadb, dest, records,
+                                                full_size):
+                if src in seen or src == dest:
+                    continue
+                seen.add(src)
+                fp.write('%s\t%i\t%s\t%i\t%s\n' % (
+                    dest, full_size, src, cost,
+                    ' '.join([i.delta.fname for i in dbrecords])))
+        fp.close()
+        self.close()
+
+    def open(self):
+        """Opens the index, returning False if it is missing or stale."""
+        if self._mmap is not None:
+            return True
+        db_id = self._db_id()
+        if db_id is None:
+            return False
+        try:
+            with open(self.fname, 'rb') as fp:
+                if fp.readline().decode('utf-8').rstrip('\n') != db_id:
+                    return False
+                self._start = fp.tell()
+                if os.fstat(fp.fileno()).st_size == self._start:
+                    return False
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return False
+        return True
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def lookup(self, dest):
+        """Returns the size of the destination distfile and a list of
+        (source, cost, delta names) tuples, cheapest first.
+        """
+        mm = self._mmap
+        key = dest.encode('utf-8')
+
+        # binary search for the first line of the destination
+        lo, hi = self._start, len(mm)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b'\n', lo, mid) + 1 or lo
+            end = mm.find(b'\n', start) + 1 or len(mm)
+            if mm[start:end].split(b'\t', 1)[0] < key:
+                lo = end
+            else:
+                hi = start
+
+        full_size = None
+        rv = []
+        while lo < len(mm):
+            end = mm.find(b'\n', lo) + 1 or len(mm)
+            pieces = mm[lo:end].decode('utf-8').rstrip('\n').split('\t')
+            if pieces[0] != dest:
+                break
+            full_size = int(pieces[1])
+            rv.append((pieces[2], int(pieces[3]), pieces[4].split()))
+            lo = end
+        return full_size, rv
+
+    def plan(self, dest, distfiles, deltas=()):
+        """Same as `plan`, using the index. Deltas already downloaded are
+        discounted from the precomputed chains, but don't change them.
+        """
+        distfiles = set(distfiles)
+        deltas = set(deltas)
+        if dest in distfiles:
+            return None
+        full_size, chains = self.lookup(dest)
+        if full_size is None:
+            return None
+        best = None
+        for src, cost, delta_names in chains:
+            if src not in distfiles:
+                continue
+            for delta_name in delta_names:
+                if delta_name in deltas:
+                    cost -= _delta_size(self.deltadb.get(delta_name))
+            if best is None or cost < best[0]:
+                best = cost, delta_names
+            if len(deltas) == 0:
+                break
+        if best is None:
+            return Plan(dest, [], full_size, full_size)
+        return Plan(dest, [self.deltadb.get(i) for i in best[1]], best[0],
+                    full_size)
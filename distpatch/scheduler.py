@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.scheduler
+    ~~~~~~~~~~~~~~~~~~~
+
+    Job scheduler for running diffs and patches in parallel.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import bisect
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+
+class SchedulerException(Exception):
+    pass
+
+
+class _Job(object):
+
+    def __init__(self, key, function, args, needs, future):
+        self.key = key
+        self.function = function
+        self.args = args
+        self.needs = needs
+        self.future = future
+        self.bypassed = 0
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class Scheduler(object):
+    """Runs jobs in a pool of threads. A job only starts after all the jobs
+    it depends on finished successfully, and fails if any of them failed.
+
+    Jobs may declare the resources they need, e.g. {'memory': 1024}. The
+    scheduler has a budget for each resource (None for unlimited), and
+    starts a job only while the needs of the running jobs fit the budgets.
+    The ready jobs with the biggest needs, relative to the budgets, start
+    first, the smaller ones fill the gaps. A job that needs more than a
+    whole budget runs alone.
+    """
+
+    # number of times a job can be passed over by smaller jobs, before
+    # waiting for the resources it needs to be freed.
+    max_bypass = 8
+
+    def __init__(self, jobs=1, budgets=None):
+        if jobs < 1:
+            raise SchedulerException('Invalid number of jobs: %i' % jobs)
+        self.jobs = jobs
+        self.budgets = dict([(key, value) for key, value in \
+                             (budgets or {}).items() if value is not None])
+        for key, value in self.budgets.items():
+            if value <= 0:
+                raise SchedulerException('Invalid budget for %s: %r' % \
+                                         (key, value))
+        self._executor = ThreadPoolExecutor(jobs)
+        self._lock = threading.Lock()
+        self._used = dict.fromkeys(self.budgets, 0)
+        self._ready = []
+        self._running = 0
+        self._counter = 0
+        self._futures = set()
+
+    def _weight(self, needs):
+        rv = 0.0
+        for key, value in needs.items():
+            rv = max(rv, float(value) / self.budgets[key])
+        return rv
+
+    def submit(self, function, args=(), depends=(), needs=None):
+        future = Future()
+        depends = list(depends)
+        waiting = [len(depends)]
+        needs = dict([(key, value) for key, value in (needs or {}).items() \
+                      if key in self.budgets])
+        with self._lock:
+            key = (-self._weight(needs), self._counter)
+            self._counter += 1
+            self._futures.add(future)
+        future.add_done_callback(self._forget)
+
+        def run():
+            for dependency in depends:
+                if dependency.exception() is not None:
+                    future.set_exception(SchedulerException(
+                        'Dependency failed: %s' % dependency.exception()))
+                    return
+            with self._lock:
+                bisect.insort(self._ready,
+                              _Job(key, function, args, needs, future))
+            self._dispatch()
+
+        def dependency_done(dependency):
+            with self._lock:
+                waiting[0] -= 1
+                ready = waiting[0] == 0
+            if ready:
+                run()
+
+        if len(depends) == 0:
+            run()
+        for dependency in depends:
+            dependency.add_done_callback(dependency_done)
+        return future
+
+    def _forget(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _fits(self, job):
+        if self._running == 0:
+            return True
+        for key, value in job.needs.items():
+            if self._used[key] + value > self.budgets[key]:
+                return False
+        return True
+
+    def _dispatch(self):
+        started = []
+        with self._lock:
+            while self._running < self.jobs and len(self._ready) > 0:
+                for i, job in enumerate(self._ready):
+                    if self._fits(job):
+                        break
+                    if i == 0 and job.bypassed >= self.max_bypass:
+                        job = None
+                        break
+                else:
+                    job = None
+                if job is None:
+                    break
+                del self._ready[i]
+                if i > 0:
+                    self._ready[0].bypassed += 1
+                for key, value in job.needs.items():
+                    self._used[key] += value
+                self._running += 1
+                started.append(job)
+        for job in started:
+            inner = self._executor.submit(job.function, *job.args)
+            inner.add_done_callback(lambda inner, job=job: self._done(job,
+                                                                      inner))
+
+    def _done(self, job, inner):
+        with self._lock:
+            for key, value in job.needs.items():
+                self._used[key] -= value
+            self._running -= 1
+        self._dispatch()
+        if inner.exception() is not None:
+            job.future.set_exception(inner.exception())
+        else:
+            job.future.set_result(inner.result())
+
+    def shutdown(self):
+        # jobs waiting for resources or dependencies aren't known by the
+        # executor yet.
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+            if len(futures) == 0:
+                break
+            wait(futures)
+        self._executor.shutdown()
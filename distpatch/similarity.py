@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.similarity
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Content fingerprints of distfiles, to predict the size of deltas.
+
+    The uncompressed contents of a distfile are split in blocks, aligned to
+    the start of each member of the tarball, and hashed. The fingerprint is
+    a bottom-k MinHash sketch of the block hashes: the `sketch_size`
+    smallest ones, with the number of distinct blocks and the uncompressed
+    size. Comparing the sketches of two distfiles estimates how much of a
+    distfile is contained in the other one, and so how big a delta between
+    them would be.
+
+    Sketches are stored in the checksums cache, see
+    `distpatch.chksums.ChksumCache`.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import hashlib
+import os
+
+from distpatch.chksums import chksum_cache
+from distpatch.helpers import stream_file, uncompressed_filename_and_compressor
+
+sketch_size = 256
+block_size = 64 * 1024
+
+
+class SimilarityException(Exception):
+    pass
+
+
+class Sketch(object):
+
+    def __init__(self, count, usize, hashes):
+        self.count = count
+        self.usize = usize
+        self.hashes = frozenset(hashes)
+
+    @classmethod
+    def from_str(cls, value):
+        pieces = value.split()
+        return cls(int(pieces[0]), int(pieces[1]),
+                   [int(i, 16) for i in pieces[2:]])
+
+    def to_str(self):
+        return '%i %i %s' % (self.count, self.usize,
+                             ' '.join(['%x' % i for i in sorted(self.hashes)]))
+
+    def resemblance(self, other):
+        """Estimates the Jaccard index of the blocks of both distfiles."""
+        union = sorted(self.hashes | other.hashes)[:sketch_size]
+        if len(union) == 0:
+            return 0.0
+        common = len([i for i in union if i in self.hashes and \
+                      i in other.hashes])
+        return float(common) / len(union)
+
+    def containment(self, other):
+        """Estimates the fraction of the blocks of this distfile that are
+        found in the other one.
+        """
+        if self.count == 0:
+            return 0.0
+        j = self.resemblance(other)
+        common = j * (self.count + other.count) / (1 + j)
+        return min(common / self.count, 1.0)
+
+    def predicted_delta_size(self, src):
+        """Predicts the size of the uncompressed delta to reconstruct this
+        distfile from `src`.
+        """
+        return int(self.usize * (1 - self.containment(src)))
+
+
+class SketchBuilder(object):
+    """Builds a Sketch from the uncompressed contents of a distfile, fed in
+    chunks. Tarballs are parsed on the fly, any other file is handled as a
+    single member.
+    """
+
+    def __init__(self):
+        self._hashes = set()
+        self._buf = bytearray()
+        self._block = hashlib.blake2b(digest_size=8)
+        self._block_len = 0
+        self._remaining = 0
+        self._padding = 0
+        self._state = 'header'
+        self.usize = 0
+
+    def _end_block(self):
+        if self._block_len > 0:
+            self._hashes.add(int(self._block.hexdigest(), 16))
+            self._block = hashlib.blake2b(digest_size=8)
+            self._block_len = 0
+
+    def _hash(self, data):
+        while len(data) > 0:
+            size = min(len(data), block_size - self._block_len)
+            self._block.update(data[:size])
+            self._block_len += size
+            data = data[size:]
+            if self._block_len == block_size:
+                self._end_block()
+
+    def _parse_header(self, header):
+        if header == bytes(512):
+            return None
+        try:
+            chksum = int(header[148:156].strip(b' \x00') or b'0', 8)
+        except ValueError:
+            return False
+        if sum(header[:148]) + 8 * 32 + sum(header[156:]) != chksum:
+            return False
+        if header[124] & 0x80:
+            # base-256 encoded size, for huge members
+            size = 0
+            for byte in header[125:136]:
+                size = (size << 8) + byte
+            return size
+        try:
+            return int(header[124:136].strip(b' \x00') or b'0', 8)
+        except ValueError:
+            return False
+
+    def update(self, data):
+        self.usize += len(data)
+        if self._state == 'raw':
+            self._hash(memoryview(data))
+            return
+        if self._state == 'end':
+            return
+        self._buf += data
+        pos = 0
+        while True:
+            if self._state == 'header':
+                if len(self._buf) - pos < 512:
+                    break
+                header = bytes(self._buf[pos:pos + 512])
+                size = self._parse_header(header)
+                if size is False:
+                    if self.usize - len(self._buf) + pos == 0:
+                        # not a tarball
+                        self._state = 'raw'
+                        self._hash(memoryview(bytes(self._buf[pos:])))
+                        self._buf = bytearray()
+                        return
+                    raise SimilarityException('Invalid tarball')
+                if size is None:
+                    self._state = 'end'
+                    self._buf = bytearray()
+                    return
+                pos += 512
+                self._remaining = size
+                self._padding = (512 - size % 512) % 512
+                self._state = 'data'
+            elif self._state == 'data':
+                size = min(self._remaining, len(self._buf) - pos)
+                self._hash(memoryview(self._buf)[pos:pos + size])
+                pos += size
+                self._remaining -= size
+                if self._remaining > 0:
+                    break
+                self._end_block()
+                self._state = 'padding'
+            elif self._state == 'padding':
+                size = min(self._padding, len(self._buf) - pos)
+                pos += size
+                self._padding -= size
+                if self._padding > 0:
+                    break
+                self._state = 'header'
+        del self._buf[:pos]
+
+    def sketch(self):
+        self._end_block()
+        return Sketch(len(self._hashes), self.usize,
+                      sorted(self._hashes)[:sketch_size])
+
+
+def sketch(fname):
+    """Returns the Sketch of the given distfile, from the checksums cache if
+    possible.
+    """
+    if not os.path.exists(fname):
+        raise SimilarityException('File not found: %s' % fname)
+    identity = chksum_cache.identity(fname)
+    value = chksum_cache.get(fname, 's')
+    if value is not None:
+        return Sketch.from_str(value)
+    builder = SketchBuilder()
+    stream_file(fname, (), [builder.update],
+                uncompressed_filename_and_compressor(fname)[1])
+    rv = builder.sketch()
+    chksum_cache.set(fname, 's', rv.to_str(), identity)
+    return rv
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.sqlitedb
+    ~~~~~~~~~~~~~~~~~~
+
+    DeltaDB storage backend based on SQLite.
+
+    Stores the same records of the text DeltaDB, in a table indexed by the
+    delta, source and destination file names, with the checksums stored as
+    raw bytes. Opening the database costs the same, whatever its size, and
+    queries just read the records they need. The parameters of the
+    compressor of the destination file are stored in the `dest_compression`
+    column, added to databases created without it.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import binascii
+import sqlite3
+
+from contextlib import contextmanager
+
+from distpatch.chksums import Chksum
+from distpatch.deltadb import DeltaDBException, DeltaDBFile, DeltaDBRecord
+from distpatch.instrument import stage
+
+sqlite_magic = b'SQLite format 3\x00'
+
+_roles = ['src', 'dest', 'delta']
+_algorithms = sorted(Chksum.algorithms)
+_columns = ['%s_%s%s' % (role, prefix, algorithm) for role in _roles \
+            for prefix in ('', 'u') for algorithm in _algorithms]
+
+
+def _to_db(algorithm, value):
+    if algorithm == 'size':
+        return value.to_long()
+    return sqlite3.Binary(binascii.unhexlify(value.to_str()))
+
+
+def _from_db(algorithm, value):
+    if algorithm == 'size':
+        return int(value)
+    return int(binascii.hexlify(value), 16)
+
+
+class SQLiteDeltaDB(object):
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._pending = None
+        self._compression_column = 'dest_compression'
+        self._conn = sqlite3.connect(fname, timeout=600)
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS records (' \
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, ' \
+                'delta TEXT NOT NULL UNIQUE, src TEXT NOT NULL, ' \
+                'dest TEXT NOT NULL, %s)' % ', '.join(
+                    ['%s %s' % (column, column.endswith('size') and \
+                                'INTEGER' or 'BLOB') for column in _columns]))
+            columns = [row[1] for row in \
+                       self._conn.execute('PRAGMA table_info(records)')]
+            if 'dest_compression' not in columns:
+                try:
+                    self._conn.execute('ALTER TABLE records ADD COLUMN ' \
+                                       'dest_compression TEXT')
+                except sqlite3.OperationalError:
+                    # read-only database, created without the column
+                    self._compression_column = 'NULL'
+            self._conn.execute('CREATE INDEX IF NOT EXISTS records_src ' \
+                               'ON records (src)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS records_dest ' \
+                               'ON records (dest)')
+
+    def _query(self, where='', args=()):
+        cur = self._conn.execute(
+            'SELECT delta, src, dest, %s, %s FROM records %s ORDER BY id' % \
+            (self._compression_column, ', '.join(_columns), where), args)
+        for row in cur:
+            yield self._record_from_row(row)
+
+    def _record_from_row(self, row):
+        names = dict(zip(['delta', 'src', 'dest'], row[:3]))
+        compression = row[3]
+        values = iter(row[4:])
+        files = {}
+        for role in _roles:
+            chksums = {}
+            uchksums = {}
+            for d in (chksums, uchksums):
+                for algorithm in _algorithms:
+                    d[algorithm] = _from_db(algorithm, next(values))
+            files[role] = DeltaDBFile(names[role], chksums=chksums,
+                                      uchksums=uchksums)
+        files['dest'].compression = compression
+        return DeltaDBRecord(files['src'], files['dest'], files['delta'])
+
+    def _row_from_record(self, record):
+        row = [record.delta.fname, record.src.fname, record.dest.fname,
+               record.dest.compression]
+        for role in _roles:
+            obj = getattr(record, role)
+            for chksums in (obj.chksums, obj.uchksums):
+                for algorithm in _algorithms:
+                    value = getattr(chksums, algorithm)
+                    if value is None:
+                        raise DeltaDBException('Invalid checksum for %s' % \
+                                               algorithm)
+                    row.append(_to_db(algorithm, value))
+        return row
+
+    def __iter__(self):
+        return self._query()
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def __contains__(self, key):
+        return self._conn.execute('SELECT 1 FROM records WHERE delta = ?',
+                                  (key,)).fetchone() is not None
+
+    def get(self, delta):
+        for record in self._query('WHERE delta = ?', (delta,)):
+            return record
+
+    def get_by_src(self, src):
+        return list(self._query('WHERE src = ?', (src,)))
+
+    def get_by_dest(self, dest):
+        return list(self._query('WHERE dest = ?', (dest,)))
+
+    def add(self, record):
+        if self._pending is not None:
+            self._pending.append(record)
+            return
+        self.add_many([record])
+
+    def add_many(self, records):
+        rows = [self._row_from_record(record) for record in records]
+        if len(rows) == 0:
+            return
+        with stage('deltadb.add'), self._conn:
+            for row in rows:
+                # replaced records go to the end, like in the text DeltaDB
+                self._conn.execute('DELETE FROM records WHERE delta = ?',
+                                   (row[0],))
+                self._conn.execute(
+                    'INSERT INTO records (delta, src, dest, ' \
+                    'dest_compression, %s) VALUES ' \
+                    '(%s)' % (', '.join(_columns),
+                              ', '.join(['?'] * len(row))), row)
+
+    @contextmanager
+    def transaction(self):
+        if self._pending is not None:
+            raise DeltaDBException('Transaction already in progress')
+        self._pending = []
+        try:
+            yield self
+        finally:
+            pending = self._pending
+            self._pending = None
+            self.add_many(pending)
+
+    def compact(self):
+        # records are written in place, there's no journal to merge.
+        pass
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    distpatch.state
+    ~~~~~~~~~~~~~~~
+
+    Persistent state of distdiffer runs, to skip the packages that didn't
+    change since they were last processed, and to resume interrupted runs.
+
+    The state file has a JSON object per line, with the package, its key
+    (a digest of its CPVs, of its Manifest files and of the options that
+    choose its deltas) and the deltas produced for it. Lines are appended as
+    packages are done, the last line of a package wins. The file is
+    rewritten when it gets too many stale lines.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from snakeoil.fileutils import AtomicWriteFile
+
+from distpatch.ebuild import get_dbapi
+
+
+def package_key(cp, options=None):
+    """Returns a digest of the CPVs of the package `cp` and of the Manifest
+    files of their directories, or None if the package has no CPVs. Just
+    the tree is read, not the metadata of the ebuilds. `options` is a
+    dictionary with the options that change the deltas chosen for the
+    package (e.g. the maximum size of the distfiles), packages done with
+    other options get other keys.
+    """
+    dbapi = get_dbapi()
+    try:
+        cpvs = sorted(dbapi.cp_list(cp))
+    except Exception:
+        return None
+    if len(cpvs) == 0:
+        return None
+    key = hashlib.sha256()
+    directories = set()
+    for cpv in cpvs:
+        key.update(('%s\n' % cpv).encode('utf-8'))
+        ebuild = dbapi.findname(cpv)
+        if ebuild is not None:
+            directories.add(os.path.dirname(ebuild))
+    for directory in sorted(directories):
+        manifest = os.path.join(directory, 'Manifest')
+        digest = ''
+        if os.path.exists(manifest):
+            with open(manifest, 'rb') as fp:
+                digest = hashlib.sha256(fp.read()).hexdigest()
+        key.update(('%s %s\n' % (directory, digest)).encode('utf-8'))
+    if options is not None:
+        key.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return key.hexdigest()
+
+
+class RunState(object):
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.packages = {}
+        self._lines = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.fname):
+            return
+        with open(self.fname, 'rb') as fp:
+            data = fp.read()
+        lines = data.split(b'\n')
+
+        # drop the partial line written by an interrupted run, before
+        # appending to it
+        if len(lines[-1]) > 0:
+            with open(self.fname, 'r+b') as fp:
+                fp.truncate(len(data) - len(lines[-1]))
+        for line in lines[:-1]:
+            try:
+                entry = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            self.packages[entry['package']] = entry
+            self._lines += 1
+        if self._lines > 2 * len(self.packages) + 1000:
+            self._rewrite()
+
+    def _rewrite(self):
+        fp = AtomicWriteFile(self.fname)
+        for package in sorted(self.packages):
+            fp.write('%s\n' % json.dumps(self.packages[package],
+                                         sort_keys=True))
+        fp.close()
+        self._lines = len(self.packages)
+
+    def done(self, package, key):
+        """Returns True if the package was done with the given key."""
+        entry = self.packages.get(package)
+        return key is not None and entry is not None and \
+               entry['key'] == key
+
+    def deltas(self, package):
+        entry = self.packages.get(package)
+        if entry is None:
+            return []
+        return entry['deltas']
+
+    def set_done(self, package, key, deltas):
+        """Records that the package was done with the given key, producing
+        the given deltas. Written to disk right away.
+        """
+        if key is None:
+            return
+        entry = {'package': package, 'key': key, 'deltas': sorted(deltas)}
+        with self._lock:
+            self.packages[package] = entry
+            with open(self.fname, 'ab') as fp:
+                fp.write(('%s\n' % json.dumps(entry, sort_keys=True)) \
+                         .encode('utf-8'))
+            self._lines += 1
@@ -11,14 +11,14 @@
 
 from matplotlib import pyplot
 
-from distpatch.deltadb import DeltaDB
+from distpatch.deltadb import open_deltadb
 from distpatch.helpers import format_size
 
 
 class Stats(object):
 
     def __init__(self, deltadb_file):
-        self.deltadb = sorted(DeltaDB(deltadb_file), self._cmp)
+        self.deltadb = sorted(open_deltadb(deltadb_file), self._cmp)
 
     def _cmp(self, x, y):
             x_ = int(x.dest.chksums['size'])
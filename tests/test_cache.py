@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_cache.py
+    ~~~~~~~~~~~~~~~~~~~
+
+    Tests for the cache of uncompressed distfiles.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import gzip
+import os
+import unittest
+
+from testutils import TempDirTestCase
+
+from distpatch.cache import UncompressedCache
+from distpatch.chksums import Chksum
+
+
+class UncompressedCacheTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.data = b''.join([b'line %i\n' % i for i in range(10000)])
+        self.fname = self.path('foo-1.0.tar.gz')
+        with gzip.open(self.fname, 'wb') as fp:
+            fp.write(self.data)
+        self.cache = UncompressedCache(self.path('cache'))
+        os.makedirs(self.path('out1'))
+        os.makedirs(self.path('out2'))
+
+    def entries(self):
+        return sorted(os.listdir(self.cache.directory))
+
+    def test_uncompress(self):
+        ufname, chksums, uchksums = self.cache.uncompress(self.fname,
+                                                          self.path('out1'))
+        self.assertEqual(ufname, self.path('out1', 'foo-1.0.tar'))
+        with open(ufname, 'rb') as fp:
+            self.assertEqual(fp.read(), self.data)
+        self.assertTrue(chksums == Chksum(self.fname))
+        self.assertTrue(uchksums == Chksum(ufname))
+        self.assertEqual(self.entries(),
+                         ['.lock', '%064x' % chksums.sha256.to_long()])
+
+        # hits leave no temporary directories behind
+        os.unlink(ufname)
+        rv = self.cache.uncompress(self.fname, self.path('out2'))
+        self.assertEqual(rv[0], self.path('out2', 'foo-1.0.tar'))
+        with open(rv[0], 'rb') as fp:
+            self.assertEqual(fp.read(), self.data)
+        self.assertTrue(rv[1] == chksums and rv[2] == uchksums)
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_eviction(self):
+        self.cache.max_size = len(self.data) - 1
+        self.cache.uncompress(self.fname, self.path('out1'))
+        self.assertEqual(self.entries(), ['.lock'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_chksums.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the persistent checksums cache.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import os
+import time
+import unittest
+
+from testutils import TempDirTestCase
+
+from distpatch.chksums import ChksumCache
+
+
+class ChksumCacheTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.cache = ChksumCache(self.path('chksums.sqlite'), max_entries=2)
+        self.fnames = []
+        for i in range(4):
+            fname = self.path('file%i' % i)
+            self.write(fname, 'contents %i' % i)
+            self.fnames.append(fname)
+
+    def write(self, fname, data):
+        with open(fname, 'w') as fp:
+            fp.write(data)
+        # files modified too recently aren't cached
+        old = time.time() - 60
+        os.utime(fname, (old, old))
+
+    def test_set_get(self):
+        identity = self.cache.identity(self.fnames[0])
+        self.cache.set(self.fnames[0], 'c', 'value', identity)
+        self.assertEqual(self.cache.get(self.fnames[0], 'c'), 'value')
+        self.assertTrue(self.cache.get(self.fnames[0], 'u') is None)
+        self.assertTrue(self.cache.get(self.fnames[1], 'c') is None)
+
+    def test_recent_file(self):
+        with open(self.fnames[0], 'a') as fp:
+            fp.write('more')
+        self.assertTrue(self.cache.identity(self.fnames[0]) is None)
+        self.cache.set(self.fnames[0], 'c', 'value', None)
+        self.assertTrue(self.cache.get(self.fnames[0], 'c') is None)
+
+    def test_changed_while_hashing(self):
+        identity = self.cache.identity(self.fnames[0])
+        self.write(self.fnames[0], 'other contents')
+        self.cache.set(self.fnames[0], 'c', 'value', identity)
+        self.assertTrue(self.cache.get(self.fnames[0], 'c') is None)
+
+    def test_eviction(self):
+        self.cache.evict_interval = 2
+        for fname in self.fnames[:3]:
+            self.cache.set(fname, 'c', fname, self.cache.identity(fname))
+
+        # the limit is only enforced every `evict_interval` insertions
+        self.assertEqual(len([i for i in self.fnames[:3] \
+                              if self.cache.get(i, 'c') is not None]), 3)
+        self.cache.set(self.fnames[3], 'c', self.fnames[3],
+                       self.cache.identity(self.fnames[3]))
+        self.assertEqual([i for i in self.fnames \
+                          if self.cache.get(i, 'c') is not None],
+                         self.fnames[2:])
+
+
+if __name__ == '__main__':
+    unittest.main()
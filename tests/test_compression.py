@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_compression.py
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the detection of the parameters of compressors.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import bz2
+import gzip
+import lzma
+import unittest
+
+from testutils import TempDirTestCase
+
+from distpatch.compression import CompressionException, Parameters, \
+     detect_parameters
+
+
+class ParametersTestCase(unittest.TestCase):
+
+    def test_parse(self):
+        params = Parameters.parse('xz preset=9e check=crc32 dict=4194304')
+        self.assertEqual(params.compressor, 'xz')
+        self.assertEqual(list(params.params.items()),
+                         [('check', 'crc32'), ('dict', '4194304'),
+                          ('preset', '9e')])
+        self.assertEqual(str(params), 'xz check=crc32 dict=4194304 preset=9e')
+        self.assertEqual(str(Parameters.parse(str(params))), str(params))
+        self.assertEqual(str(Parameters.parse('bzip2')), 'bzip2')
+        self.assertEqual(str(Parameters('gzip', os='3', level='9')),
+                         'gzip level=9 os=3')
+
+    def test_parse_invalid(self):
+        self.assertRaises(CompressionException, Parameters.parse, '')
+        self.assertRaises(CompressionException, Parameters.parse,
+                          'xz preset')
+
+    def test_new_compressor_invalid(self):
+        self.assertRaises(CompressionException,
+                          Parameters('foo').new_compressor)
+        self.assertRaises(CompressionException,
+                          Parameters('bzip2').new_compressor)
+        self.assertRaises(CompressionException,
+                          Parameters('bzip2', level='x').new_compressor)
+        self.assertRaises(CompressionException,
+                          Parameters('xz', preset='6',
+                                     check='foo').new_compressor)
+
+
+class DetectParametersTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.data = b''.join([b'%i: some not so random line\n' % (i * i) \
+                              for i in range(5000)])
+        self.ufname = self.path('foo-1.0.tar')
+        with open(self.ufname, 'wb') as fp:
+            fp.write(self.data)
+
+    def write(self, fname, data):
+        fname = self.path(fname)
+        with open(fname, 'wb') as fp:
+            fp.write(data)
+        return fname
+
+    def recompress(self, params):
+        rv = []
+        obj = params.new_compressor()
+        obj.feed(self.data, rv.append)
+        obj.close(rv.append)
+        return b''.join(rv)
+
+    def assertDetected(self, fname, expected):
+        for ufname in (None, self.ufname):
+            params = detect_parameters(fname, ufname)
+            self.assertEqual(str(params), expected)
+            with open(fname, 'rb') as fp:
+                self.assertEqual(self.recompress(Parameters.parse(expected)),
+                                 fp.read())
+
+    def test_gzip(self):
+        fname = self.path('foo-1.0.tar.gz')
+        with open(fname, 'wb') as fp:
+            with gzip.GzipFile('foo-1.0.tar', 'wb', 9, fp, 1300000000) as gz:
+                gz.write(self.data)
+        self.assertDetected(fname, 'gzip level=9 mtime=1300000000 ' \
+                            'name=foo-1.0.tar os=255 xfl=2')
+
+    def test_bzip2(self):
+        fname = self.write('foo-1.0.tar.bz2', bz2.compress(self.data, 3))
+        self.assertDetected(fname, 'bzip2 level=3')
+
+    def test_xz(self):
+        fname = self.write('foo-1.0.tar.xz', lzma.compress(self.data))
+        self.assertDetected(fname, 'xz check=crc64 preset=6')
+        fname = self.write('foo-1.0.tar.xz', lzma.compress(
+            self.data, check=lzma.CHECK_CRC32,
+            preset=6 | lzma.PRESET_EXTREME))
+        self.assertDetected(fname, 'xz check=crc32 preset=6e')
+        fname = self.write('foo-1.0.tar.xz', lzma.compress(
+            self.data, check=lzma.CHECK_CRC32,
+            filters=[{'id': lzma.FILTER_X86},
+                     {'id': lzma.FILTER_LZMA2, 'preset': 6}]))
+        self.assertDetected(fname, 'xz check=crc32 filters=x86 preset=6')
+
+    def test_lzma(self):
+        fname = self.write('foo-1.0.tar.lzma',
+                           lzma.compress(self.data, lzma.FORMAT_ALONE,
+                                         preset=2))
+        self.assertDetected(fname, 'lzma preset=2')
+
+    def test_not_detected(self):
+        # all the candidates are tried, keep it small
+        fname = self.write('foo-1.0.tar.xz', lzma.compress(
+            self.data[:10000], filters=[{'id': lzma.FILTER_LZMA2,
+                                         'preset': 6, 'lc': 4}]))
+        self.assertTrue(detect_parameters(fname) is None)
+        self.assertTrue(detect_parameters(self.ufname) is None)
+        fname = self.write('foo-1.0.tar.gz', b'not gzip')
+        self.assertTrue(detect_parameters(fname, self.ufname) is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_deltadb.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the text DeltaDB.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import os
+import unittest
+
+from testutils import TempDirTestCase, record
+
+from distpatch.deltadb import DeltaDB, DeltaDBRecord, iter_raw_records, \
+     record_from_raw
+
+
+class DeltaDBParseTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.records = [record('foo-1.0.tar.gz', 'foo-1.1.tar.gz'),
+                        record('foo-1.1.tar.gz', 'foo-1.2.tar.gz'),
+                        record('bar-1.0.tar.bz2', 'bar-2.0.tar.bz2')]
+        self.fname = self.path('deltadb')
+        with open(self.fname, 'w') as fp:
+            fp.write('\n--\n'.join([str(i) for i in self.records]))
+
+    def test_iter_raw_records(self):
+        with open(self.fname) as fp:
+            raw = list(iter_raw_records(fp))
+        self.assertEqual(len(raw), 3)
+        self.assertEqual(['\n'.join(i) for i in raw],
+                         [str(i) for i in self.records])
+
+    def test_iter_raw_records_blank_lines(self):
+        lines = ['', 'a', 'b', '', '--', '--', 'c', '--', '']
+        self.assertEqual(list(iter_raw_records(lines)), [['a', 'b'], ['c']])
+
+    def test_record_from_raw_round_trip(self):
+        for rec in self.records:
+            raw = str(rec).split('\n')
+            parsed = record_from_raw(raw)
+            self.assertEqual(str(parsed), str(rec))
+            self.assertEqual(parsed.delta.fname, rec.delta.fname)
+            self.assertTrue(parsed.dest.chksums == rec.dest.chksums)
+            self.assertTrue(parsed.src.uchksums == rec.src.uchksums)
+
+    def test_compression_line(self):
+        rec = record('baz-1.0.tar.gz', 'baz-1.1.tar.gz',
+                     compression='gzip level=9 mtime=0 os=3 xfl=2')
+        raw = str(rec).split('\n')
+        self.assertEqual(len(raw), 6)
+        self.assertEqual(raw[5], 'gzip level=9 mtime=0 os=3 xfl=2')
+        parsed = record_from_raw(raw)
+        self.assertEqual(parsed.dest.compression, rec.dest.compression)
+        self.assertTrue(parsed.src.compression is None)
+
+        # the line is optional
+        self.assertEqual(len(str(self.records[0]).split('\n')), 5)
+        self.assertTrue(record_from_raw(str(self.records[0]).split('\n')) \
+                        .dest.compression is None)
+
+        # and mixed with records without it
+        db = DeltaDB(self.path('deltadb2'))
+        db.add_many([self.records[0], rec, self.records[1]])
+        db.compact()
+        db = DeltaDB(self.path('deltadb2'))
+        self.assertEqual([i.dest.compression for i in db],
+                         [None, rec.dest.compression, None])
+
+    def test_lazy_decoding(self):
+        db = DeltaDB(self.fname)
+        self.assertEqual(len(db), 3)
+        name = self.records[0].delta.fname
+
+        # records are kept as raw lines until accessed, and their
+        # checksums are decoded when used
+        self.assertFalse(isinstance(db._records[name], DeltaDBRecord))
+        rec = db.get(name)
+        self.assertTrue(isinstance(db._records[name], DeltaDBRecord))
+        self.assertTrue(rec.dest._chksum_line is not None)
+        self.assertTrue(rec.dest.chksums == self.records[0].dest.chksums)
+        self.assertTrue(rec.dest._chksum_line is None)
+
+    def test_indexes(self):
+        db = DeltaDB(self.fname)
+        self.assertEqual([i.delta.fname \
+                          for i in db.get_by_src('foo-1.1.tar.gz')],
+                         [self.records[1].delta.fname])
+        self.assertEqual([i.delta.fname \
+                          for i in db.get_by_dest('bar-2.0.tar.bz2')],
+                         [self.records[2].delta.fname])
+        self.assertEqual(db.get_by_dest('missing.tar.gz'), [])
+        self.assertTrue(db.get('missing') is None)
+        self.assertEqual([i.delta.fname for i in db],
+                         [i.delta.fname for i in self.records])
+
+
+class DeltaDBJournalTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.fname = self.path('deltadb')
+        self.journal = self.fname + '.journal'
+
+    def names(self, db):
+        return [i.delta.fname for i in db]
+
+    def test_journal_replay(self):
+        db = DeltaDB(self.fname)
+        records = [record('foo-1.0.tar.gz', 'foo-1.1.tar.gz'),
+                   record('foo-1.1.tar.gz', 'foo-1.2.tar.gz')]
+        db.add_many(records)
+        self.assertFalse(os.path.exists(self.fname))
+        self.assertTrue(os.path.exists(self.journal))
+        self.assertEqual(self.names(DeltaDB(self.fname)),
+                         [i.delta.fname for i in records])
+
+    def test_partial_journal_write(self):
+        db = DeltaDB(self.fname)
+        db.add(record('foo-1.0.tar.gz', 'foo-1.1.tar.gz'))
+        with open(self.journal, 'rb') as fp:
+            size = len(fp.read())
+
+        # a writer crashed in the middle of a record
+        with open(self.journal, 'a') as fp:
+            fp.write(str(record('foo-1.1.tar.gz', 'foo-1.2.tar.gz'))[:150])
+        db = DeltaDB(self.fname)
+        self.assertEqual(self.names(db),
+                         ['foo-1.0.tar.gz-foo-1.1.tar.gz.switching.xz'])
+
+        # the partial record is dropped by the next writer
+        new = record('foo-1.2.tar.gz', 'foo-1.3.tar.gz')
+        db.add(new)
+        with open(self.journal) as fp:
+            data = fp.read()
+        self.assertEqual(data[size:], '%s\n--\n' % new)
+        self.assertEqual(self.names(DeltaDB(self.fname)),
+                         ['foo-1.0.tar.gz-foo-1.1.tar.gz.switching.xz',
+                          'foo-1.2.tar.gz-foo-1.3.tar.gz.switching.xz'])
+
+    def test_journal_overrides_db(self):
+        db = DeltaDB(self.fname)
+        db.add(record('foo-1.0.tar.gz', 'foo-1.1.tar.gz', delta_size=1000))
+        db.compact()
+        db.add(record('foo-1.0.tar.gz', 'foo-1.1.tar.gz', delta_size=500))
+        rec = DeltaDB(self.fname).get(
+            'foo-1.0.tar.gz-foo-1.1.tar.gz.switching.xz')
+        self.assertEqual(rec.delta.chksums.size.to_long(), 500)
+
+    def test_compaction(self):
+        db = DeltaDB(self.fname)
+        db.add(record('foo-1.0.tar.gz', 'foo-1.1.tar.gz'))
+        db.add(record('foo-1.1.tar.gz', 'foo-1.2.tar.gz'))
+        db.add(record('foo-1.0.tar.gz', 'foo-1.1.tar.gz', delta_size=500))
+        expected = self.names(db)
+        db.compact()
+        self.assertFalse(os.path.exists(self.journal))
+        db = DeltaDB(self.fname)
+        self.assertEqual(self.names(db), expected)
+        self.assertEqual(len(db.get_by_dest('foo-1.1.tar.gz')), 1)
+        self.assertEqual(db.get_by_dest('foo-1.1.tar.gz')[0].delta.chksums \
+                         .size.to_long(), 500)
+
+        # records added after the compaction are replayed on top of it
+        db.add(record('foo-1.2.tar.gz', 'foo-1.3.tar.gz'))
+        self.assertEqual(self.names(DeltaDB(self.fname)),
+                         expected + ['foo-1.2.tar.gz-foo-1.3.tar.gz.' \
+                                     'switching.xz'])
+
+    def test_compaction_by_other_instance(self):
+        db1 = DeltaDB(self.fname)
+        db2 = DeltaDB(self.fname)
+        db2.add(record('foo-1.0.tar.gz', 'foo-1.1.tar.gz'))
+        db2.compact()
+        db1.add(record('foo-1.1.tar.gz', 'foo-1.2.tar.gz'))
+        self.assertEqual(self.names(db1),
+                         ['foo-1.0.tar.gz-foo-1.1.tar.gz.switching.xz',
+                          'foo-1.1.tar.gz-foo-1.2.tar.gz.switching.xz'])
+
+    def test_automatic_compaction(self):
+        db = DeltaDB(self.fname)
+        db.max_journal_records = 2
+        db.add_many([record('foo-1.%i.tar.gz' % i,
+                            'foo-1.%i.tar.gz' % (i + 1)) for i in range(3)])
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual(len(DeltaDB(self.fname)), 3)
+
+    def test_readers_dont_lock(self):
+        DeltaDB(self.fname).add(record('foo-1.0.tar.gz', 'foo-1.1.tar.gz'))
+        os.unlink(self.fname + '.lock')
+        db = DeltaDB(self.fname)
+        self.assertEqual(len(db), 1)
+        db.get_by_dest('foo-1.1.tar.gz')
+        self.assertFalse(os.path.exists(self.fname + '.lock'))
+
+    def test_transaction(self):
+        db = DeltaDB(self.fname)
+        with db.transaction():
+            db.add(record('foo-1.0.tar.gz', 'foo-1.1.tar.gz'))
+            db.add(record('foo-1.1.tar.gz', 'foo-1.2.tar.gz'))
+            self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual(len(DeltaDB(self.fname)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_fetcher.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the delta fetcher, against a local HTTP server.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import os
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from testutils import TempDirTestCase, record
+
+from distpatch.chksums import Chksum
+from distpatch.fetcher import DeltaFetcher
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        if self.path.startswith('/old/'):
+            self.send_response(301)
+            self.send_header('Location', '/deltas/' + self.path[5:])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path.startswith('/deltas/') and \
+             self.path[8:] in self.server.files:
+            data = self.server.files[self.path[8:]]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_error(404)
+
+        # drop the connection without telling the client, as servers do
+        # with idle kept-alive connections
+        if not self.server.keep_alive:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class DeltaFetcherTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.files = {}
+        self.server.keep_alive = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.output_dir = self.path('patches')
+        self.records = [self.delta('foo-1.%i.tar.gz' % i,
+                                   'foo-1.%i.tar.gz' % (i + 1)) \
+                        for i in range(3)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        TempDirTestCase.tearDown(self)
+
+    def delta(self, src, dest):
+        rec = record(src, dest)
+        data = ('delta from %s to %s\n' % (src, dest)).encode('ascii') * 100
+        fname = self.path(rec.delta.fname)
+        with open(fname, 'wb') as fp:
+            fp.write(data)
+        rec.delta.chksums = Chksum(fname)
+        os.unlink(fname)
+        self.server.files[rec.delta.fname] = data
+        return rec
+
+    def fetcher(self, path='deltas', jobs=1):
+        return DeltaFetcher('http://127.0.0.1:%i/%s' % \
+                            (self.server.server_address[1], path),
+                            self.output_dir, jobs=jobs, timeout=10)
+
+    def assertFetched(self, records):
+        for rec in records:
+            with open(os.path.join(self.output_dir, rec.delta.fname),
+                      'rb') as fp:
+                self.assertEqual(fp.read(),
+                                 self.server.files[rec.delta.fname])
+
+    def test_connection_reuse(self):
+        self.assertEqual(self.fetcher().fetch(self.records), {})
+        self.assertFetched(self.records)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_skip_valid(self):
+        self.assertEqual(self.fetcher().fetch(self.records[:1]), {})
+        with open(os.path.join(self.output_dir,
+                               self.records[1].delta.fname), 'wb') as fp:
+            fp.write(b'corrupted')
+        self.server.requests = []
+        self.assertEqual(self.fetcher().fetch(self.records), {})
+        self.assertFetched(self.records)
+        self.assertEqual(sorted(self.server.requests),
+                         sorted(['/deltas/' + i.delta.fname \
+                                 for i in self.records[1:]]))
+
+        # nothing left to download
+        self.server.requests = []
+        self.assertEqual(self.fetcher().fetch(self.records), {})
+        self.assertEqual(self.server.requests, [])
+
+    def test_bad_chksum(self):
+        fname = self.records[1].delta.fname
+        self.server.files[fname] = b'corrupted'
+        errors = self.fetcher().fetch(self.records)
+        self.assertEqual(list(errors.keys()), [fname])
+        self.assertTrue('Bad checksum' in errors[fname])
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         sorted([self.records[0].delta.fname,
+                                 self.records[2].delta.fname]))
+
+    def test_not_found(self):
+        del self.server.files[self.records[0].delta.fname]
+        errors = self.fetcher().fetch(self.records)
+        self.assertEqual(list(errors.keys()), [self.records[0].delta.fname])
+        self.assertTrue('404' in errors[self.records[0].delta.fname])
+        self.assertFetched(self.records[1:])
+
+    def test_redirect(self):
+        self.assertEqual(self.fetcher('old').fetch(self.records), {})
+        self.assertFetched(self.records)
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_stale_connection(self):
+        self.server.keep_alive = False
+        self.assertEqual(self.fetcher().fetch(self.records), {})
+        self.assertFetched(self.records)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_parallel(self):
+        self.assertEqual(self.fetcher(jobs=2).fetch(self.records), {})
+        self.assertFetched(self.records)
+        self.assertTrue(self.server.connections <= 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_helpers.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the helper functions.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import lzma
+import os
+import shutil
+import threading
+import unittest
+
+from testutils import TempDirTestCase
+
+from distpatch.helpers import compress
+
+
+@unittest.skipIf(shutil.which('xz') is None, 'xz(1) not installed')
+class CompressThreadedTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        # incompressible, so xz(1) fills the pipes if its output isn't read
+        self.data = os.urandom(4 * 1024 * 1024)
+        self.fname = self.path('foo-1.0.tar')
+        with open(self.fname, 'wb') as fp:
+            fp.write(self.data)
+
+    def compress(self, *args, **kwargs):
+        # a hung compressor fails the test, instead of blocking it forever
+        rv = []
+
+        def target():
+            try:
+                rv.append(compress(*args, **kwargs))
+            except Exception as err:
+                rv.append(err)
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), 'compress() hung')
+        if isinstance(rv[0], Exception):
+            raise rv[0]
+        return rv[0]
+
+    def test_compress(self):
+        chunks = []
+        dest = self.compress(self.fname, 'xz', threads=1,
+                             callbacks=[chunks.append])
+        self.assertEqual(dest, self.fname + '.xz')
+        self.assertFalse(os.path.exists(self.fname))
+        with open(dest, 'rb') as fp:
+            data = fp.read()
+        self.assertEqual(b''.join(chunks), data)
+        self.assertEqual(lzma.decompress(data), self.data)
+
+    def test_callback_error(self):
+        def callback(data):
+            raise ValueError('callback failed')
+
+        self.assertRaises(ValueError, self.compress, self.fname, 'xz',
+                          threads=1, callbacks=[callback])
+        self.assertEqual(os.listdir(self.tmp_dir), ['foo-1.0.tar'])
+
+    def test_ucallback_error(self):
+        def ucallback(data):
+            raise ValueError('ucallback failed')
+
+        self.assertRaises(RuntimeError, self.compress, self.fname, 'xz',
+                          threads=1, ucallbacks=[ucallback])
+        self.assertEqual(os.listdir(self.tmp_dir), ['foo-1.0.tar'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_lineage.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the identification of distfile lineages.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import unittest
+
+import testutils  # makes distpatch importable
+
+from distpatch.lineage import DistfileTokens, Lineage
+
+
+class DistfileTokensTestCase(unittest.TestCase):
+
+    def test_tokens(self):
+        tokens = DistfileTokens('foo-1.10.tar.gz')
+        self.assertEqual(tokens.tokens, ['foo', '-', '1', '.', '10',
+                                         '.tar.gz'])
+        self.assertEqual(tokens.template, ('foo', '-', None, '.', None,
+                                           '.tar.gz'))
+        self.assertEqual(DistfileTokens('foo_bar-2a.tgz').tokens,
+                         ['foo', '_', 'bar', '-', '2a', '.tgz'])
+        self.assertEqual(DistfileTokens('foo-1.0.tar').tokens,
+                         ['foo', '-', '1', '.', '0', '.tar'])
+        self.assertEqual(DistfileTokens('foo-1.0.patch').tokens,
+                         ['foo', '-', '1', '.', '0', '.', 'patch', ''])
+
+    def test_template(self):
+        self.assertEqual(DistfileTokens('foo-1.9.tar.gz').template,
+                         DistfileTokens('foo-1.10.tar.gz').template)
+        self.assertNotEqual(DistfileTokens('foo-1.9.tar.gz').template,
+                            DistfileTokens('foo-1.9.1.tar.gz').template)
+        self.assertNotEqual(DistfileTokens('foo-1.9.tar.gz').template,
+                            DistfileTokens('foo-1.9.tar.xz').template)
+
+    def test_score(self):
+        src = DistfileTokens('foo-1.9.tar.gz')
+        same = src.score(DistfileTokens('foo-1.10.tar.gz'))
+        other = src.score(DistfileTokens('foo-1.9.tar.xz'))
+        self.assertEqual(same, (True, 6.5, -1))
+        self.assertEqual(other, (False, 3.5, 0))
+        self.assertTrue(same > other)
+        self.assertTrue(src.score(DistfileTokens('foo-1.8.tar.gz')) >
+                        src.score(DistfileTokens('foo-1.5.tar.gz')))
+        self.assertEqual(src.score(DistfileTokens('bar'))[1], 0)
+
+        # '#' is just another separator
+        src = DistfileTokens('foo#1.tar.gz')
+        self.assertEqual(src.score(DistfileTokens('foo#2.tar.gz')),
+                         (True, 5.5, -1))
+        self.assertEqual(src.score(DistfileTokens('foo-2.tar.gz'))[0], False)
+        self.assertEqual(src.score(DistfileTokens('foo-#.tar.gz'))[0], False)
+
+
+class LineageTestCase(unittest.TestCase):
+
+    def match(self, src_distfiles, dest_distfiles):
+        return [i[1:] for i in Lineage().match(src_distfiles,
+                                               dest_distfiles)]
+
+    def test_same_template_wins(self):
+        self.assertEqual(self.match(['foo-1.0.tar.gz'],
+                                    ['foo-1.0.1.tar.gz', 'foo-2.0.tar.gz']),
+                         [('foo-1.0.tar.gz', 'foo-2.0.tar.gz')])
+
+    def test_common_tokens(self):
+        # no distfile with the same template
+        self.assertEqual(self.match(['foo-1.0.tar.gz'],
+                                    ['bar-1.1.tar.bz2',
+                                     'foo-docs-1.1.tar.gz']),
+                         [('foo-1.0.tar.gz', 'foo-docs-1.1.tar.gz')])
+        self.assertEqual(self.match(['foo-1.0'], ['bar']), [])
+
+    def test_closest_version(self):
+        self.assertEqual(self.match(['foo-1.0.tar.gz', 'foo-data-7.tar.gz'],
+                                    ['foo-1.3.tar.gz', 'foo-1.1.tar.gz',
+                                     'foo-data-9.tar.gz']),
+                         [('foo-1.0.tar.gz', 'foo-1.1.tar.gz'),
+                          ('foo-data-7.tar.gz', 'foo-data-9.tar.gz')])
+
+    def test_ties(self):
+        # equally good matches are dropped, instead of guessed
+        self.assertEqual(self.match(['foo-1.5.tar.gz'],
+                                    ['foo-1.4.tar.gz', 'foo-1.6.tar.gz']), [])
+        self.assertEqual(self.match(['foo-1.0.tar.gz'],
+                                    ['foo-1.0a.tar.gz', 'foo-1.0b.tar.gz']),
+                         [])
+
+        # unless something else breaks the tie
+        self.assertEqual(self.match(['foo-1.5.tar.gz'],
+                                    ['foo-1.4.tar.gz', 'foo-1.6.tar.bz2']),
+                         [('foo-1.5.tar.gz', 'foo-1.4.tar.gz')])
+
+    def test_unchanged(self):
+        self.assertEqual(self.match(['foo-1.0.tar.gz', 'data.tar.gz'],
+                                    ['foo-1.1.tar.gz', 'data.tar.gz']),
+                         [('foo-1.0.tar.gz', 'foo-1.1.tar.gz')])
+
+    def test_identify(self):
+        rv = Lineage().identify([['foo-1.0.tar.gz', 'foo-extra-1.0.zip'],
+                                 ['foo-1.1.tar.gz'],
+                                 ['foo-1.2.tar.gz', 'bar-1.2.tar.gz']])
+        self.assertEqual(rv, [(0, 'foo-1.0.tar.gz', 'foo-1.1.tar.gz'),
+                              (1, 'foo-1.1.tar.gz', 'foo-1.2.tar.gz')])
+
+
+if __name__ == '__main__':
+    unittest.main()
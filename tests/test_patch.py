@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_patch.py
+    ~~~~~~~~~~~~~~~~~~~
+
+    Tests for the streaming reconstruction of distfiles, with sh(1) standing
+    in for patcher.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import os
+import unittest
+
+from unittest import mock
+
+from testutils import TempDirTestCase, record
+
+from distpatch.instrument import stage
+from distpatch.patch import Patch, PatchException
+
+
+class PatchStreamTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.patch = Patch(record('foo-1.0.tar', 'foo-1.1.tar'))
+        self.chunks = []
+
+    def stream(self, script):
+        # the FIFO is the last argument, $0 of the script
+        with stage('stream') as measure:
+            return self.patch._stream(['sh', '-c', script],
+                                      self.chunks.append, measure)
+
+    def test_stream(self):
+        self.assertEqual(self.stream('seq 10000 > "$0"'), 0)
+        self.assertEqual(b''.join(self.chunks),
+                         ''.join(['%i\n' % i \
+                                  for i in range(1, 10001)]).encode('ascii'))
+
+    def test_exit_code(self):
+        self.assertEqual(self.stream('echo foo > "$0"; exit 3'), 3)
+        self.assertEqual(b''.join(self.chunks), b'foo\n')
+
+        # patcher died without opening the FIFO
+        self.assertEqual(self.stream('exit 4'), 4)
+
+    def test_watch_error(self):
+        with mock.patch('distpatch.patch.os.wait4',
+                        side_effect=OSError('wait4 failed')):
+            try:
+                self.stream('echo foo > "$0"')
+            except PatchException as err:
+                self.assertTrue('wait4 failed' in str(err))
+            else:
+                self.fail('PatchException not raised')
+
+    def test_temporary_file(self):
+        # leftovers of a previous run don't matter, and failures leave
+        # nothing behind
+        dest = self.path('foo-1.1.tar')
+        with open(self.path('.foo-1.1.tar.%i' % os.getpid()), 'w'):
+            pass
+        before = sorted(os.listdir(self.tmp_dir))
+        self.assertRaises(PatchException, self.patch._reconstruct_streaming,
+                          ['sh', '-c', 'echo foo > "$0"'], None, dest,
+                          self.tmp_dir, None)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
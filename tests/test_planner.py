@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_planner.py
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the planner of delta chains.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import os
+import unittest
+
+from testutils import TempDirTestCase, record
+
+from distpatch.deltadb import DeltaDB
+from distpatch.planner import ChainIndex, PlannerException, plan
+
+
+class PlanTestCase(TempDirTestCase):
+
+    def deltadb(self, *records):
+        db = DeltaDB(self.path('deltadb'))
+        db.add_many(records)
+        return db
+
+    def names(self, plan):
+        return [i.delta.fname for i in plan.dbrecords]
+
+    def test_cheapest_chain(self):
+        db = self.deltadb(record('a', 'b', 'switching', delta_size=100),
+                          record('b', 'c', 'switching', delta_size=100),
+                          record('a', 'c', 'switching', delta_size=500))
+        rv = plan(db, 'c', ['a'])
+        self.assertEqual(self.names(rv), ['a-b.switching.xz',
+                                          'b-c.switching.xz'])
+        self.assertEqual(rv.cost, 200)
+        self.assertEqual(rv.full_size, 10000)
+        self.assertFalse(rv.full_download)
+
+        # the nearest source wins
+        rv = plan(db, 'c', ['a', 'b'])
+        self.assertEqual(self.names(rv), ['b-c.switching.xz'])
+        self.assertEqual(rv.cost, 100)
+
+    def test_downloaded_deltas(self):
+        db = self.deltadb(record('a', 'b', 'switching', delta_size=100),
+                          record('b', 'c', 'switching', delta_size=100),
+                          record('a', 'c', 'switching', delta_size=500))
+        rv = plan(db, 'c', ['a'], ['a-c.switching.xz'])
+        self.assertEqual(self.names(rv), ['a-c.switching.xz'])
+        self.assertEqual(rv.cost, 0)
+        rv = plan(db, 'c', ['a'], ['b-c.switching.xz'])
+        self.assertEqual(self.names(rv), ['a-b.switching.xz',
+                                          'b-c.switching.xz'])
+        self.assertEqual(rv.cost, 100)
+
+    def test_format_constraint(self):
+        # the cheapest path would mix formats
+        db = self.deltadb(record('a', 'b', 'bsdiff', delta_size=50),
+                          record('a', 'b', 'switching', delta_size=1000),
+                          record('b', 'c', 'switching', delta_size=100),
+                          record('a', 'c', 'bsdiff', delta_size=500))
+        rv = plan(db, 'c', ['a'])
+        self.assertEqual(self.names(rv), ['a-c.bsdiff.xz'])
+        self.assertEqual(rv.cost, 500)
+
+        # unless the single-format path is cheaper
+        db.add(record('a', 'b', 'switching', delta_size=300))
+        rv = plan(db, 'c', ['a'])
+        self.assertEqual(self.names(rv), ['a-b.switching.xz',
+                                          'b-c.switching.xz'])
+        self.assertEqual(rv.cost, 400)
+
+    def test_full_download(self):
+        db = self.deltadb(record('a', 'b', 'switching', delta_size=100),
+                          record('b', 'c', 'switching', delta_size=100,
+                                 dest_size=150))
+        rv = plan(db, 'c', ['a'])
+        self.assertTrue(rv.full_download)
+        self.assertEqual(rv.dbrecords, [])
+        self.assertEqual(rv.cost, 150)
+        self.assertEqual(str(rv), 'c')
+
+        # no source available
+        rv = plan(db, 'b', ['x'])
+        self.assertTrue(rv.full_download)
+        self.assertEqual(rv.cost, 10000)
+
+    def test_nothing_to_do(self):
+        db = self.deltadb(record('a', 'b', 'switching'))
+        self.assertTrue(plan(db, 'b', ['a', 'b']) is None)
+        self.assertTrue(plan(db, 'x', ['a']) is None)
+
+
+class ChainIndexTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.db = DeltaDB(self.path('deltadb'))
+
+        # a few lineages, with a chain of deltas and a direct delta
+        records = []
+        for name in ('bar', 'foo', 'baz', 'a', 'z\u00e9'):
+            for i in range(5):
+                records.append(record('%s-%i' % (name, i),
+                                      '%s-%i' % (name, i + 1),
+                                      delta_size=100))
+            records.append(record('%s-0' % name, '%s-5' % name, 'bsdiff',
+                                  dest_size=10000, delta_size=450))
+        self.db.add_many(records)
+        self.index = ChainIndex(self.db)
+
+    def tearDown(self):
+        self.index.close()
+        TempDirTestCase.tearDown(self)
+
+    def test_lookup(self):
+        self.index.build()
+        self.assertTrue(self.index.open())
+        full_size, chains = self.index.lookup('foo-3')
+        self.assertEqual(full_size, 10000)
+        names = ['foo-%i-foo-%i.switching.xz' % (i, i + 1) for i in range(3)]
+        self.assertEqual(chains, [('foo-2', 100, names[2:]),
+                                  ('foo-1', 200, names[1:]),
+                                  ('foo-0', 300, names)])
+        for dest in ('a-1', 'bar-5', 'baz-2', 'z\u00e9-5', 'z\u00e9-1'):
+            full_size, chains = self.index.lookup(dest)
+            self.assertEqual(full_size, 10000)
+            self.assertTrue(len(chains) > 0)
+            self.assertTrue(all([i[0].split('-')[0] == dest.split('-')[0] \
+                                 for i in chains]))
+        for dest in ('0', 'a-0', 'bar-6', 'c', 'zz'):
+            self.assertEqual(self.index.lookup(dest), (None, []))
+
+    def test_plan(self):
+        self.index.build()
+        self.assertTrue(self.index.open())
+        for dest, distfiles, deltas in [
+                ('foo-5', ['foo-0'], []),
+                ('foo-5', ['foo-0', 'foo-3'], []),
+                ('bar-4', ['bar-0'], ['bar-0-bar-1.switching.xz']),
+                ('baz-5', ['baz-0'], ['baz-0-baz-5.bsdiff.xz']),
+                ('a-3', ['x'], [])]:
+            expected = plan(self.db, dest, distfiles, deltas)
+            rv = self.index.plan(dest, distfiles, deltas)
+            self.assertEqual(str(rv), str(expected))
+            self.assertEqual(rv.cost, expected.cost)
+        self.assertTrue(self.index.plan('foo-5', ['foo-5']) is None)
+        self.assertTrue(self.index.plan('missing', ['foo-0']) is None)
+
+    def test_stale(self):
+        self.assertFalse(self.index.open())
+        self.index.build()
+        self.assertTrue(ChainIndex(self.db).open())
+
+        # records in the journal
+        self.db.add(record('foo-5', 'foo-6'))
+        self.assertFalse(ChainIndex(self.db).open())
+
+        # the database file changed since the index was built
+        self.db.compact()
+        self.assertFalse(ChainIndex(self.db).open())
+
+        self.index.build()
+        index = ChainIndex(self.db)
+        self.assertTrue(index.open())
+        self.assertEqual(index.lookup('foo-6')[1][0],
+                         ('foo-5', 1000, ['foo-5-foo-6.switching.xz']))
+        index.close()
+
+    def test_build_without_identity(self):
+        # a record written by someone else after the journal was merged
+        self.db.compact = lambda: None
+        self.assertRaises(PlannerException, self.index.build)
+        self.assertFalse(os.path.exists(self.index.fname))
+
+
+if __name__ == '__main__':
+    unittest.main()
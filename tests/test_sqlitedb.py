@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_sqlitedb.py
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Tests for the SQLite DeltaDB and the conversion between backends.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import unittest
+
+from testutils import TempDirTestCase, record
+
+from distpatch.deltadb import DeltaDB, DeltaDBException, convert_deltadb, \
+     open_deltadb
+from distpatch.sqlitedb import SQLiteDeltaDB
+
+
+class SQLiteDeltaDBTestCase(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.records = [record('foo-1.0.tar.gz', 'foo-1.1.tar.gz'),
+                        record('foo-1.1.tar.gz', 'foo-1.2.tar.gz'),
+                        record('foo-1.0.tar.gz', 'foo-1.2.tar.gz',
+                               'bsdiff'),
+                        record('bar-1.0.tar.bz2', 'bar-2.0.tar.bz2')]
+
+    def assertSameRecords(self, a, b):
+        self.assertEqual([str(i) for i in a], [str(i) for i in b])
+
+    def test_backend_detection(self):
+        text = DeltaDB(self.path('deltadb'))
+        text.add_many(self.records)
+        text.compact()
+        sqlite = SQLiteDeltaDB(self.path('deltadb.sqlite'))
+        sqlite.add_many(self.records)
+        self.assertTrue(isinstance(open_deltadb(self.path('deltadb')),
+                                   DeltaDB))
+        self.assertTrue(isinstance(open_deltadb(self.path('deltadb.sqlite')),
+                                   SQLiteDeltaDB))
+        self.assertTrue(isinstance(open_deltadb(self.path('new.sqlite')),
+                                   SQLiteDeltaDB))
+        self.assertTrue(isinstance(open_deltadb(self.path('new')), DeltaDB))
+        self.assertRaises(DeltaDBException, open_deltadb, self.path('x'),
+                          'invalid')
+
+    def test_queries(self):
+        db = SQLiteDeltaDB(self.path('deltadb.sqlite'))
+        db.add_many(self.records)
+        self.assertEqual(len(db), 4)
+        self.assertTrue(self.records[0].delta.fname in db)
+        self.assertSameRecords([db.get(self.records[1].delta.fname)],
+                               [self.records[1]])
+        self.assertSameRecords(db.get_by_dest('foo-1.2.tar.gz'),
+                               self.records[1:3])
+        self.assertSameRecords(db.get_by_src('foo-1.0.tar.gz'),
+                               [self.records[0], self.records[2]])
+        self.assertTrue(db.get('missing') is None)
+
+    def test_compression(self):
+        compression = 'xz check=crc64 preset=6'
+        self.records.append(record('baz-1.0.tar.xz', 'baz-1.1.tar.xz',
+                                   compression=compression))
+        db = SQLiteDeltaDB(self.path('deltadb.sqlite'))
+        db.add_many(self.records)
+        db = SQLiteDeltaDB(self.path('deltadb.sqlite'))
+        self.assertEqual(db.get(self.records[-1].delta.fname) \
+                         .dest.compression, compression)
+        self.assertTrue(db.get(self.records[0].delta.fname) \
+                        .dest.compression is None)
+
+        # and back to text
+        back = convert_deltadb(db, self.path('deltadb'), 'text')
+        self.assertSameRecords(back, self.records)
+        self.assertEqual(DeltaDB(self.path('deltadb')).get(
+            self.records[-1].delta.fname).dest.compression, compression)
+
+    def test_replace(self):
+        db = SQLiteDeltaDB(self.path('deltadb.sqlite'))
+        db.add_many(self.records)
+        new = record('foo-1.0.tar.gz', 'foo-1.1.tar.gz', delta_size=500)
+        db.add(new)
+        self.assertEqual(len(db), 4)
+        self.assertSameRecords(list(db)[-1:], [new])
+
+    def test_text_to_sqlite_to_text(self):
+        text = DeltaDB(self.path('deltadb'))
+        text.add_many(self.records)
+        sqlite = convert_deltadb(text, self.path('deltadb.sqlite'))
+        self.assertTrue(isinstance(sqlite, SQLiteDeltaDB))
+        self.assertSameRecords(SQLiteDeltaDB(self.path('deltadb.sqlite')),
+                               self.records)
+        back = convert_deltadb(sqlite, self.path('deltadb2'), 'text')
+        self.assertTrue(isinstance(back, DeltaDB))
+        self.assertSameRecords(DeltaDB(self.path('deltadb2')), self.records)
+        text.compact()
+        with open(self.path('deltadb')) as fp:
+            with open(self.path('deltadb2')) as fp2:
+                self.assertEqual(fp.read(), fp2.read())
+
+    def test_convert_existing(self):
+        text = DeltaDB(self.path('deltadb'))
+        text.add_many(self.records)
+        SQLiteDeltaDB(self.path('deltadb.sqlite'))
+        self.assertRaises(DeltaDBException, convert_deltadb, text,
+                          self.path('deltadb.sqlite'))
+
+
+if __name__ == '__main__':
+    unittest.main()
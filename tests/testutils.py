@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/testutils.py
+    ~~~~~~~~~~~~~~~~~~
+
+    Helpers shared by the tests: synthetic DeltaDB records and temporary
+    directories. Importing it disables the persistent checksums cache, and
+    makes the stand-in portage from benchmarks/stubs importable.
+
+    :copyright: (c) 2011 by Rafael Goncalves Martins
+    :license: GPL-2, see LICENSE for more details.
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(tests_dir)
+sys.path.insert(0, root_dir)
+sys.path.insert(1, os.path.join(root_dir, 'benchmarks', 'stubs'))
+
+# must be set before distpatch.chksums is imported
+os.environ['DISTPATCH_CHKSUM_CACHE'] = ''
+
+from distpatch.chksums import Chksum
+from distpatch.deltadb import DeltaDBFile, DeltaDBRecord
+
+
+def chksums(name, size):
+    """Returns fake, but deterministic, checksums for the file `name`."""
+    rv = {'size': size}
+    for algorithm in Chksum.algorithms:
+        if algorithm == 'size':
+            continue
+        digest = hashlib.sha256(('%s:%s' % (algorithm, name)) \
+                                .encode('utf-8')).hexdigest()
+        bits = algorithm in ('md5',) and 128 or \
+               algorithm in ('sha1', 'rmd160') and 160 or 256
+        rv[algorithm] = int(digest, 16) >> (256 - bits)
+    return Chksum(**rv)
+
+
+def record(src, dest, patch_format='switching', dest_size=10000,
+           delta_size=1000, compression=None):
+    """Returns a DeltaDBRecord for a delta from `src` to `dest`."""
+    delta = '%s-%s.%s.xz' % (src, dest, patch_format)
+    return DeltaDBRecord(
+        DeltaDBFile(src, chksums=chksums(src, 9000),
+                    uchksums=chksums('u' + src, 36000)),
+        DeltaDBFile(dest, chksums=chksums(dest, dest_size),
+                    uchksums=chksums('u' + dest, 4 * dest_size),
+                    compression=compression),
+        DeltaDBFile(delta, chksums=chksums(delta, delta_size),
+                    uchksums=chksums('u' + delta, 4 * delta_size)))
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Test case with a temporary directory, `self.tmp_dir`."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='distpatch-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, *names):
+        return os.path.join(self.tmp_dir, *names)